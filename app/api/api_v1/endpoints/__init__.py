@@ -2,6 +2,7 @@ from fastapi import APIRouter
 from . import assignments
 from . import authorize
 from . import users
+from . import metrics
 
 ################### /api/v1/... 以下のエンドポイントの定義 ###################
 api_router = APIRouter()
@@ -12,4 +13,6 @@ api_router.include_router(
 api_router.include_router(authorize.router, prefix="/authorize", tags=["authorize"])
 
 api_router.include_router(users.router, prefix="/users", tags=["users"])
+
+api_router.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
 ##########################################################################
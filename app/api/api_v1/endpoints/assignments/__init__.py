@@ -6,6 +6,8 @@ from . import status
 from . import result
 from . import problem
 from . import lecture
+from . import rejudge
+from . import worker
 
 ############## /api/v1/assignments/...以下のエンドポイントの定義 ####################
 router = APIRouter()
@@ -16,4 +18,6 @@ router.include_router(status.router, prefix="/status", tags=["status"])
 router.include_router(result.router, prefix="/result", tags=["result"])
 router.include_router(problem.router, prefix="/problem", tags=["problem"])
 router.include_router(lecture.router, prefix="/lecture", tags=["lecture"])
+router.include_router(rejudge.router, prefix="/rejudge", tags=["rejudge"])
+router.include_router(worker.router, prefix="/worker", tags=["worker"])
 ################################################################################
@@ -10,12 +10,12 @@ from app.api.api_v1.endpoints import authenticate_util
 from pathlib import Path
 from app import constants as constant
 import shutil
-import tempfile
-from datetime import datetime
-from .util import unfold_zip
-import zipfile
-import pandas as pd
-import io
+from app.crud.db import SessionLocal
+from app.extract import ManabaArchiveLayout, read_manaba_archive_layout, extract_reportlist, extract_student_archive, get_extract_executor
+from app.jobs import batch_ingest_runner, ingesting_batch_ids, get_batch_dir
+from app.reportlist import iter_report_list
+from starlette.concurrency import run_in_threadpool
+import asyncio
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -25,52 +25,8 @@ router = APIRouter()
 /api/v1/assignments/batch/...以下のエンドポイントの定義
 """
 
-def get_report_list(report_list_path: Path) -> pd.DataFrame | None:
-    '''
-    reportlist.xlsx(またはreportlist.xls)を読み込み、
-    "# 学籍番号", "# ロール", "# 提出", "# 提出日時"の4列のみを取得する
-    '''
-    
-    if not report_list_path.exists():
-        return None
-    
-    # エクセルファイルを読み込む
-    df = pd.read_excel(report_list_path, header=None)
-    
-    # CSVに変換
-    csv_str = df.to_csv(index=False)
-    data_io = io.StringIO(csv_str)
-    
-    # 最初から、"# 内部コースID"で始まる箇所まで削除(pandasではなく、csvを直接操作する)
-    data_io.seek(0)
-    lines = data_io.readlines()
-    lines = [line.strip() for line in lines]
-    for i, line in enumerate(lines):
-        if line.startswith("# 内部コースID"):
-            break
-    lines = lines[i:]
-    
-    # "#end"で始まる行を見つけて、それ以降の行を削除
-    end_row = 0
-    for i, line in enumerate(lines):
-        if line.startswith("#end"):
-            end_row = i
-            break
-    lines = lines[:end_row]
-    
-    # print("first transform")
-    # for line in lines:
-    #     print(line)
-    
-    csv_str = "\n".join(lines)
-    data_io = io.StringIO(csv_str)
-    
-    df = pd.read_csv(data_io)
-    
-    columes_to_keep = ["# 学籍番号", "# ロール", "# 提出", "# 提出日時"]
-    df = df[columes_to_keep]
-    
-    return df
+# アップロードされたzipファイルを、取り込みが終わるまでbatch_dirに保存しておくときのファイル名
+BATCH_ARCHIVE_FILE_NAME = ".upload.zip"
 
 @router.post("/{lecture_id}", response_model=response.BatchSubmission)
 async def batch_judge(
@@ -86,6 +42,10 @@ async def batch_judge(
     """
     バッチ採点リクエストを受け付ける
 
+    アップロードされたzipファイルを保存し、構成を確認した時点でBatchSubmissionエントリを返す。
+    学生ごとの提出の展開と提出エントリの登録はバックグラウンドで行われ、
+    その間のBatchSubmissionのstatusは"ingesting"になる(GET /status/batch/id/{batch_id} で確認できる)。
+
     注) 採点用のエンドポイントで、学生が使うことを想定していない。
     """
     ############################### Vital #####################################
@@ -105,73 +65,82 @@ async def batch_judge(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="授業エントリが公開期間内ではありません",
             )
-    
-    problem_list = [problem for problem in lecture_entry.problems]
 
-    # バッチ採点のリクエストをBatchSubmissionテーブルに登録する
+    # バッチ採点のリクエストをBatchSubmissionテーブルに登録する(取り込みが終わるまではingesting)
     batch_submission_record = assignments.register_batch_submission(
         db=db,
         user_id=current_user.user_id,
-        lecture_id=lecture_id
+        lecture_id=lecture_id,
+        phase=schemas.BatchSubmissionPhase.INGESTING,
     )
 
     batch_id = batch_submission_record.id
-    total_judge = 0 # 採点対象のジャッジリクエストの数
     
-    error_message = ""
-    
-    batch_dir = Path(constant.UPLOAD_DIR) / "batch" / f"{batch_submission_record.ts.strftime('%Y-%m-%d-%H-%M-%S')}-{batch_submission_record.id}"
+    batch_dir = get_batch_dir(batch_id, batch_submission_record.ts)
     batch_dir.mkdir(parents=True, exist_ok=True)
     
-    with tempfile.TemporaryDirectory() as workspace_dir:
-        workspace_dir_path = Path(workspace_dir)
+    def reject(detail: str) -> HTTPException:
+        # batch_dirを削除して、取り込みに失敗したことを記録する
+        shutil.rmtree(batch_dir)
+        assignments.update_batch_submission_phase(
+            db=db, batch_id=batch_id, phase=schemas.BatchSubmissionPhase.FAILED, message=detail[:255]
+        )
+        return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
-        # アップロードされたzipファイルをworkspace_dirに展開する
-        try:
-            with zipfile.ZipFile(uploaded_zip_file.file, "r") as zip_ref:
-                zip_ref.extractall(workspace_dir_path)
-        except Exception as e:
-            shutil.rmtree(batch_dir)
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"zipファイルの展開に失敗しました: {e}",
-            )
+    # アップロードされたzipファイルをbatch_dirに保存する
+    # (取り込みはリクエストの処理が終わった後に行い、学生ごとの展開は別プロセスで行うため、ファイルとして残しておく)
+    archive_path = batch_dir / BATCH_ARCHIVE_FILE_NAME
+    with open(archive_path, "wb") as archive_file:
+        await run_in_threadpool(shutil.copyfileobj, uploaded_zip_file.file, archive_file)
+
+    # zipファイル全体は展開せず、メンバーの一覧からreportlistと学生ごとのフォルダを探す
+    try:
+        archive_layout = await run_in_threadpool(
+            read_manaba_archive_layout, archive_path, Path(uploaded_zip_file.filename).stem
+        )
+    except Exception as e:
+        raise reject(f"zipファイルの展開に失敗しました: {e}")
+
+    if archive_layout.reportlist_member is None:
+        raise reject("reportlist.xlsxまたはreportlist.xlsが存在しません")
+
+    # 取り込みが終わるまで、回収処理がこのプロセスでリースを更新する
+    ingesting_batch_ids.add(batch_id)
+    batch_ingest_runner.submit(ingest_batch_submission, batch_id, lecture_id, eval, batch_dir, archive_layout)
+
+    return response.BatchSubmission.model_validate(batch_submission_record)
 
-        current_dir = workspace_dir_path
-        if (
-            len(list(current_dir.iterdir())) == 1
-            and list(current_dir.iterdir())[0].is_dir()
-        ):
-            # 展開先のディレクトリで、フォルダが一個しかない場合
-            current_dir = list(current_dir.iterdir())[0]
-        elif (
-            len(list(current_dir.iterdir())) > 1
-            and (current_dir / Path(uploaded_zip_file.filename).stem).exists()
-            and (current_dir / Path(uploaded_zip_file.filename).stem).is_dir()
-        ):
-            # 展開後に、__MACOSXなどのメタフォルダとZIPファイル名のフォルダができている場合
-            # ZIPファイル名のフォルダをcurrent_dirとする
-            current_dir = current_dir / Path(uploaded_zip_file.filename).stem
+
+async def ingest_batch_submission(
+    batch_id: int, lecture_id: int, eval: bool, batch_dir: Path, archive_layout: ManabaArchiveLayout
+) -> None:
+    """
+    バッチ採点の取り込み(学生ごとの提出の展開、提出エントリの登録)を行う
+
+    batch_ingest_runnerで実行されるため、独自にDBセッションを作成する。
+    EvaluationStatusとSubmissionの登録は1つのトランザクションで行い、途中までの結果をコミットしない。
+    失敗した場合や、シャットダウンで中断された場合は、BatchSubmissionのphaseをfailedにして、
+    アップロードされたファイル(batch_dir)を削除する。
+    """
+    db = SessionLocal()
+    try:
+        archive_path = batch_dir / BATCH_ARCHIVE_FILE_NAME
 
         '''
-        この時点でのcurrent_dirの構成
+        zipファイルの構成
         .
         ├── 202211479@001202214795
         │   └── class{lecture_id}.zip 
         ├── 202211479@001202214795
         │   └── class{lecture_id}.zip 
-        ├── 202211479@001202214795
-        │   └── class{lecture_id}.zip 
-        ├── 202211479@001202214795
-        │   └── class{lecture_id}.zip
         ...
         └── reportlist.xlsx
         ''' 
     
         '''
-        current_dirにあるフォルダを読み込み、
+        学生ごとのフォルダを、
         {UPLOAD_DIR}/batch/{batch_submission_record.ts}-{batch_submission_record.id}/
-        に以下のような構成で配置する
+        に以下のような構成で展開する
         .
         ├── 202211479
         │   ├── report1.pdf
@@ -183,115 +152,133 @@ async def batch_judge(
         |   ├── Makefile
         |   ├── main.c
         |   └── func.c
-        ├── 202211479
-        │   ├── report1.pdf
-        |   ├── Makefile
-        |   ├── main.c
-        |   └── func.c
         ...
         └── reportlist.xlsx
         '''
-        
-        # reportlist.xlsxもしくはreportlist.xlsをbatch_dirにコピーする
-        reportlist_file_on_workspace = current_dir / "reportlist.xlsx"
-        if not reportlist_file_on_workspace.exists():
-            reportlist_file_on_workspace = current_dir / "reportlist.xls"
-            if not reportlist_file_on_workspace.exists():
-                # batch_dirを削除して、エラーメッセージを返す
-                shutil.rmtree(batch_dir)
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="reportlist.xlsxまたはreportlist.xlsが存在しません",
-                )
-        
-        # reportlist.xlsxもしくはreportlist.xlsをbatch_dirにコピーする
-        reportlist_file_on_batch = batch_dir / reportlist_file_on_workspace.name
-        reportlist_file_on_batch.write_bytes(reportlist_file_on_workspace.read_bytes())
-    
-        # 各ユーザのフォルダをbatch_dirにコピーする
-        for user_dir in current_dir.iterdir():
-            if not user_dir.is_dir() or '@' not in user_dir.name:
-                continue
-            
-            # {9桁の学籍番号}@{13桁のID}の{9桁の学籍番号}の部分を取得する
-            user_id = user_dir.name.split('@')[0]
-                
-            # ユーザがDBに登録されているかチェックする
-            if users.get_user(db, user_id) is None:
-                error_message += f"{user_id}はユーザDBに登録されていません\n"
-                continue
-            
-            # 展開先のディレクトリを作成する
-            user_zip_file_extract_dest = batch_dir / user_id
-            user_zip_file_extract_dest.mkdir(parents=True, exist_ok=True)
-            
-            # ユーザのclass{lecture_id}.zipの内容を展開し、
-            # {batch_dir}/{user_id}/に配置する
-            user_zip_file_on_workspace = user_dir / f"class{lecture_id}.zip"
-            if not user_zip_file_on_workspace.exists():
-                error_message += f"{user_id}は提出済みであるにも関わらず、class{lecture_id}.zipを提出していません\n"
-                ################## important ##################
-                # もし、class{lecture_id}.zipが存在しない場合は、他のファイルをなるべく展開先のディレクトリにコピーする
-                for file in user_dir.iterdir():
-                    # もしzipファイルなら、展開する
-                    if file.is_file() and file.name.endswith(".zip"):
-                        message = unfold_zip(file, user_zip_file_extract_dest)
-                        if message is not None:
-                            error_message += f"{user_id}のZipファイルの解凍中にエラーが発生しました: {message}\n"
-                            continue
-                    else:
-                        shutil.copy(file, user_zip_file_extract_dest)
-            else:
-                ################## important ##################
-                # class{lecture_id}.zipが存在する場合は、それを展開する
-                message = unfold_zip(user_zip_file_on_workspace, user_zip_file_extract_dest)
-                if message is not None:
-                    error_message += f"{user_id}のZipファイルの解凍中にエラーが発生しました: {message}\n"
-                    continue
-            
-            """
-            NOTE: .oファイルがあると、コンパイルエラーになり、本来はコンパイルできるはずのコードが
-            ジャッジされないことがあるため、.oファイルを削除しておく
-            例: 
-            main_binarytree.o: file not recognized: file format not recognized
-            collect2: error: ld returned 1 exit status
-            make: *** [<builtin>: binarytree] Error 1
-            """
-            for file in user_zip_file_extract_dest.glob("*.o"):
-                file.unlink()
+
+        # reportlist.xlsxもしくはreportlist.xlsをbatch_dirに展開する
+        await run_in_threadpool(extract_reportlist, archive_path, archive_layout.reportlist_member, batch_dir)
+
+        # ユーザがDBに登録されているかチェックする
+        student_dirs, error_message = await run_in_threadpool(
+            get_registered_student_dirs, db, archive_layout.student_dirs
+        )
+        # 展開を待つ間、DBへの接続をコネクションプールに返しておく
+        db.commit()
+
+        # 各ユーザのclass{lecture_id}.zipの内容を、学生ごとに並列に展開し、
+        # {batch_dir}/{user_id}/に配置する
+        loop = asyncio.get_running_loop()
+        executor = get_extract_executor()
+        extract_tasks = [
+            loop.run_in_executor(
+                executor,
+                extract_student_archive,
+                str(archive_path),
+                student_dir,
+                lecture_id,
+                str(batch_dir / user_id),
+            )
+            for student_dir, user_id in student_dirs
+        ]
+        for extract_error_message in await asyncio.gather(*extract_tasks):
+            error_message += extract_error_message
+
+        await run_in_threadpool(
+            register_batch_evaluations, db, batch_id, lecture_id, eval, batch_dir, error_message
+        )
+
+        # 展開が終わったので、アップロードされたzipファイルは削除する
+        archive_path.unlink(missing_ok=True)
+    except asyncio.CancelledError:
+        logging.warning(f"Ingestion of batch submission was cancelled (batch_id: {batch_id})")
+        # スレッドプールで実行中の処理がdbを使っている可能性があるので、別のセッションで失敗させる
+        cancel_db = SessionLocal()
+        try:
+            abort_batch_ingestion(cancel_db, batch_id, batch_dir, "サーバの停止により、取り込みを中断しました。再度アップロードしてください")
+        finally:
+            cancel_db.close()
+        raise
+    except Exception as e:
+        logging.error(f"Error while ingesting batch submission (batch_id: {batch_id}): {e}")
+        db.rollback()
+        abort_batch_ingestion(db, batch_id, batch_dir, f"バッチ採点の取り込み中にエラーが発生しました: {e}")
+    finally:
+        ingesting_batch_ids.discard(batch_id)
+        db.close()
+
+
+def abort_batch_ingestion(db: Session, batch_id: int, batch_dir: Path, message: str) -> None:
+    """
+    取り込み中のバッチ採点のphaseをfailedにして、アップロードされたファイル(batch_dir)を削除する
+
+    既に取り込みが完了していた場合は、何もしない
+    """
+    if assignments.fail_batch_ingestion(db, batch_id, message):
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def get_registered_student_dirs(db: Session, student_dirs: list[str]) -> tuple[list[tuple[str, str]], str]:
+    """
+    学生ごとのフォルダ({9桁の学籍番号}@{13桁のID})のうち、ユーザDBに登録されている学生のものを
+    (フォルダ, 学籍番号)のリストで返す。登録されていない学生はエラーメッセージに追加する
+    """
+    registered_student_dirs = []
+    error_message = ""
+    for student_dir in student_dirs:
+        # {9桁の学籍番号}@{13桁のID}の{9桁の学籍番号}の部分を取得する
+        user_id = Path(student_dir).name.split('@')[0]
+        if users.get_user(db, user_id) is None:
+            error_message += f"{user_id}はユーザDBに登録されていません\n"
+            continue
+        registered_student_dirs.append((student_dir, user_id))
+    return registered_student_dirs, error_message
+
+
+def register_batch_evaluations(
+    db: Session, batch_id: int, lecture_id: int, eval: bool, batch_dir: Path, error_message: str
+) -> None:
+    """
+    reportlistと展開された学生ごとの提出から、EvaluationStatusとSubmissionを登録し、ジャッジを開始する
+
+    全ての登録と、phaseのjudgingへの更新を1つのトランザクションで行い、最後に1回だけコミットする
+    (途中で失敗した場合は、呼び出し元でロールバックすれば、登録しかけた行は残らない)。
+    """
+    batch_submission_record = assignments.get_batch_submission_status(db, batch_id)
+    # 登録が終わるまでバッチ採点の行ロックを取り、回収処理に失敗させられないようにする
+    if not assignments.lock_ingesting_batch_submission(db, batch_id):
+        raise ValueError("取り込みのリースが切れたため、取り込みを中断しました")
+    problem_list = [problem for problem in assignments.get_lecture(db, lecture_id).problems]
+    total_judge = 0 # 採点対象のジャッジリクエストの数
 
     # reportlist.xlsxを読み込み、未提出も含めて、採点対象の学生のリストを取得する
     # 取得する情報、学籍番号、提出状況(提出済/受付終了後提出/未提出)、提出日時(None | datetime)
-    report_list_df = get_report_list(batch_dir / "reportlist.xlsx")
-
-    if report_list_df is None:
+    report_list_path = batch_dir / "reportlist.xlsx"
+    if not report_list_path.exists():
         # reportlist.xlsxが存在しない場合は、reportlist.xlsを試す
-        report_list_df = get_report_list(batch_dir / "reportlist.xls")
+        report_list_path = batch_dir / "reportlist.xls"
 
-    if report_list_df is None:
+    if not report_list_path.exists():
         # reportlist.xlsxもreportlist.xlsも存在しない場合は、エラーを返す
-        shutil.rmtree(batch_dir)
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="reportlist.xlsxまたはreportlist.xlsが存在しません",
-        )
-        
-    # "# ロール"の値が"履修生"である行のみ残す
-    report_list_df = report_list_df[report_list_df["# ロール"] == "履修生"]
+        raise ValueError("reportlist.xlsxまたはreportlist.xlsが存在しません")
 
     # ユーザの学籍番号をキーとして、そのユーザの提出状況を格納する
     # 未提出のユーザはNoneとする。
     evaluation_status_list: list[schemas.EvaluationStatus] = []
 
-    # report_list_dfの"# 学籍番号"の値(9桁の学籍番号)と"# 提出"の値(提出済/受付終了後提出/未提出)を参照し、
+    # reportlistの"# 学籍番号"の値(9桁の学籍番号)と"# 提出"の値(提出済/受付終了後提出/未提出)を参照し、
     # "未提出"でないなら、{9桁の学籍番号}@{13桁のID}のフォルダを探す。
     # そのフォルダが存在するなら、user_id_to_batch_submission_summaryにそのユーザの提出状況を格納する。
     # そのフォルダが存在しないなら、error_messageにエラーメッセージを追加する。
-    for index, row in report_list_df.iterrows():
-        user_id = str(row["# 学籍番号"]) if not pd.isna(row["# 学籍番号"]) else None
-        submission_status = str(row["# 提出"]) if not pd.isna(row["# 提出"]) else None
-        submit_date = datetime.strptime(str(row["# 提出日時"]), "%Y-%m-%d %H:%M:%S") if not pd.isna(row["# 提出日時"]) else None
-        # logging.info(f"user_id: {user_id}, submission_status: {submission_status}, submit_date: {submit_date}")
+    for row in iter_report_list(report_list_path):
+        # "# ロール"の値が"履修生"である行のみ対象とする
+        if row.role != "履修生":
+            continue
+
+        index = row.index
+        user_id = row.user_id
+        submission_status = row.submission_status
+        submit_date = row.submit_date
 
         if user_id is None:
             error_message += f"{index}行目の学籍番号が空です\n"
@@ -352,7 +339,9 @@ async def batch_judge(
         evaluation_status_list.append(evaluation_status_record)
         
     for evaluation_status_record in evaluation_status_list:
-        evaluation_status_record = assignments.register_evaluation_status(db=db, evaluation_status_record=evaluation_status_record)
+        evaluation_status_record = assignments.register_evaluation_status(
+            db=db, evaluation_status_record=evaluation_status_record, commit=False
+        )
         
         # 未提出の場合は、ジャッジを行わない
         if evaluation_status_record.status == schemas.StudentSubmissionStatus.NON_SUBMITTED:
@@ -363,7 +352,7 @@ async def batch_judge(
             error_message += f"{evaluation_status_record.user_id}の提出フォルダが存在しません\n"
             # 提出フォルダが存在しない場合は、非提出とする
             evaluation_status_record.status = schemas.StudentSubmissionStatus.NON_SUBMITTED
-            assignments.update_evaluation_status(db=db, evaluation_status_record=evaluation_status_record)
+            assignments.update_evaluation_status(db=db, evaluation_status_record=evaluation_status_record, commit=False)
             continue
         
         # 提出済みの場合は、ジャッジを行う
@@ -379,6 +368,7 @@ async def batch_judge(
                 assignment_id=problem_entry.assignment_id,
                 eval=eval,
                 upload_dir=evaluation_status_record.upload_dir,
+                commit=False,
             )
             
             total_judge += 1
@@ -388,11 +378,15 @@ async def batch_judge(
     # total_judgeの値を更新する
     batch_submission_record.complete_judge = 0
     batch_submission_record.total_judge = total_judge
+    # 取り込みが完了したので、ジャッジを開始する
+    batch_submission_record.phase = schemas.BatchSubmissionPhase.JUDGING
 
-    assignments.modify_batch_submission(db=db, batch_submission_record=batch_submission_record)
+    assignments.modify_batch_submission(db=db, batch_submission_record=batch_submission_record, commit=False)
     
     # 全てのSubmissionの進捗状況をqueuedに更新する
-    assignments.modify_all_submission_statuses_of_batch_submission(db=db, batch_id=batch_id, status=schemas.SubmissionProgressStatus.QUEUED)
-
-    return response.BatchSubmission.model_validate(batch_submission_record)
+    assignments.modify_all_submission_statuses_of_batch_submission(
+        db=db, batch_id=batch_id, status=schemas.SubmissionProgressStatus.QUEUED, commit=False
+    )
 
+    # 登録した全ての行を、まとめてコミットする
+    db.commit()
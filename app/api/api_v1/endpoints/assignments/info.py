@@ -1,14 +1,25 @@
 from app.crud.db import assignments
-from .util import lecture_is_public, access_sanitize
-from fastapi import APIRouter, Depends, Query, Security, HTTPException, status
+from .util import (
+    lecture_is_public,
+    access_sanitize,
+    get_resource_file_digest,
+    conditional_json_response,
+    is_not_modified,
+    make_etag,
+    CACHE_CONTROL_CATALOG,
+    CACHE_CONTROL_REVALIDATE,
+)
+from fastapi import APIRouter, Depends, Query, Request, Security, HTTPException, status
+from fastapi.responses import FileResponse, Response
 from app.classes import schemas, response
 import logging
-from typing import Annotated, List
+from typing import Annotated, List, Literal
 from sqlalchemy.orm import Session
 from app.dependencies import get_db
 from app.api.api_v1.endpoints import authenticate_util
 from pathlib import Path
 from app import constants as constant
+from app.resource_cache import resource_file_cache, problem_detail_cache, read_text_head
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -19,9 +30,86 @@ router = APIRouter()
 /api/v1/assignments/info/...以下のエンドポイントの定義
 """
 
+def read_test_case_file(path: Path, preview_bytes: int | None) -> tuple[str, response.ResourceFileInfo]:
+    """
+    テストケースのstdin, stdout, stderrのファイルの内容と、ファイルの情報を返す
+
+    preview_bytesが指定され、ファイルがそれより大きい場合は、先頭preview_bytesバイトのみを返す。
+    """
+    size = path.stat().st_size
+    truncated = preview_bytes is not None and size > preview_bytes
+    text = read_text_head(path, preview_bytes) if truncated else resource_file_cache.read_text(path)
+    return text, response.ResourceFileInfo(size=size, sha256=get_resource_file_digest(path), truncated=truncated)
+
+
+def build_problem_detail(problem_detail: schemas.Problem, preview_bytes: int | None = None) -> response.ProblemDetail:
+    """
+    課題の説明文とテストケースのstdin, stdout, stderrをファイルから読み込み、課題の詳細を組み立てる
+
+    preview_bytesが指定された場合、stdin, stdout, stderrはファイルの先頭preview_bytesバイトまでとする。
+    """
+    detail = response.ProblemDetail()
+    
+    # description_pathのファイルの内容を読み込む
+    try:
+        detail.description = resource_file_cache.read_text(Path(constant.RESOURCE_DIR) / problem_detail.description_path)
+    except FileNotFoundError:
+        pass
+    
+    # RequiredFilesを読み込む
+    for required_file in problem_detail.required_files:
+        detail.required_files.append(
+            response.RequiredFiles(
+                name=required_file.name
+            )
+        )
+    
+    # Executablesを読み込む
+    for executable in problem_detail.executables:
+        detail.executables.append(
+            response.Executables(
+                eval=executable.eval,
+                name=executable.name
+            )
+        )
+    
+    # 各TestCasesのstdin, stdout, stderrを読み込む
+    for test_case in problem_detail.test_cases:
+        test_case_record = response.TestCases(
+            id=test_case.id,
+            eval=test_case.eval,
+            type=test_case.type,
+            score=test_case.score,
+            title=test_case.title,
+            description=test_case.description,
+            command=test_case.command,
+            args=test_case.args,
+            # stdin, stdout, stderrは後でファイルから読み込む
+            exit_code=test_case.exit_code,
+        )
+        
+        # stdin, stdout, stderrを読み込む
+        if test_case.stdin_path is not None:
+            test_case_record.stdin, test_case_record.stdin_file = read_test_case_file(
+                Path(constant.RESOURCE_DIR) / test_case.stdin_path, preview_bytes
+            )
+        if test_case.stdout_path is not None:
+            test_case_record.stdout, test_case_record.stdout_file = read_test_case_file(
+                Path(constant.RESOURCE_DIR) / test_case.stdout_path, preview_bytes
+            )
+        if test_case.stderr_path is not None:
+            test_case_record.stderr, test_case_record.stderr_file = read_test_case_file(
+                Path(constant.RESOURCE_DIR) / test_case.stderr_path, preview_bytes
+            )
+        detail.test_cases.append(test_case_record)
+
+    return detail
+
+
 @router.get("", response_model=List[response.Lecture])
 async def read_lectures(
     all: Annotated[bool, Query(description="公開期間外含めた全ての授業エントリを取得する場合はTrue、そうでない場合はFalse")],  # 全ての授業エントリを取得するかどうか
+    request: Request,
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[
         schemas.UserRecord,
@@ -39,14 +127,16 @@ async def read_lectures(
 
     lecture_list = assignments.get_lecture_list(db)
     if all is True:
-        return lecture_list
+        lectures = [response.Lecture.model_validate(lecture) for lecture in lecture_list]
     else:
-        return [response.Lecture.model_validate(lecture) for lecture in lecture_list if lecture_is_public(lecture)]
+        lectures = [response.Lecture.model_validate(lecture) for lecture in lecture_list if lecture_is_public(lecture)]
+    return conditional_json_response(request, lectures, CACHE_CONTROL_CATALOG)
 
 
 @router.get("/{lecture_id}", response_model=response.Lecture)
 async def read_lecture_entry(
     lecture_id: int,
+    request: Request,
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[
         schemas.UserRecord,
@@ -63,7 +153,7 @@ async def read_lecture_entry(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="授業エントリが見つかりません",
         )
-    return response.Lecture.model_validate(lecture_entry)
+    return conditional_json_response(request, response.Lecture.model_validate(lecture_entry), CACHE_CONTROL_CATALOG)
 
 
 @router.get("/{lecture_id}/{assignment_id}/entry", response_model=response.Problem)
@@ -116,14 +206,21 @@ async def read_assignment_detail(
     lecture_id: int,
     assignment_id: int,
     eval: Annotated[bool, Query(description="採点リソースにアクセスするかどうか")],
+    request: Request,
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[
         schemas.UserRecord,
         Security(authenticate_util.get_current_active_user, scopes=["me"]),
     ],
+    preview: Annotated[bool, Query(description="Trueの場合、テストケースのstdin, stdout, stderrはファイルの先頭のみ(プレビュー)を返す。省略時(False)はファイル全体を返す")] = False,
 ) -> response.Problem:
     """
     授業エントリに紐づく練習問題のエントリの詳細(評価項目、テストケース)を取得する
+
+    previewを省略した場合(False)は、従来どおりテストケースのstdin, stdout, stderrのファイル全体を返す。
+    previewがTrueの場合、テストケースのstdin, stdout, stderrはファイルの先頭PROBLEM_DETAIL_PREVIEW_BYTESバイトまでとし、
+    stdin_fileなどにファイル全体のサイズとハッシュ値を含める。ファイル全体は
+    /{lecture_id}/{assignment_id}/testcases/{testcase_id}/{stream}で取得する。
     """
     ############################### Vital #####################################
     access_sanitize(eval=eval, role=current_user.role)
@@ -156,59 +253,88 @@ async def read_assignment_detail(
             detail="課題エントリが見つかりません",
         )
     
+    preview_bytes = constant.PROBLEM_DETAIL_PREVIEW_BYTES if preview else None
+    cache_key = (lecture_id, assignment_id, eval, problem_detail.version, preview_bytes)
+    # 課題データのバージョンがある場合は、ETagもバージョンから作り、一致すれば詳細を組み立てずに304を返す
+    # (バージョンを持たない古い課題データは、レスポンスの内容のハッシュ値をETagとする)
+    etag = make_etag(*cache_key) if problem_detail.version is not None else None
+    if etag is not None and is_not_modified(request, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag, "Cache-Control": CACHE_CONTROL_REVALIDATE},
+        )
+
     res = response.Problem.model_validate(problem_detail)
     
-    res.detail = response.ProblemDetail()
-    
-    # description_pathのファイルの内容を読み込む
-    description_path = Path(constant.RESOURCE_DIR) / problem_detail.description_path
-    if description_path.exists():
-        with open(description_path, "r") as f:
-            res.detail.description = f.read()
-    
-    # RequiredFilesを読み込む
-    for required_file in problem_detail.required_files:
-        res.detail.required_files.append(
-            response.RequiredFiles(
-                name=required_file.name
-            )
+    # 課題データのバージョンが同じ間は、組み立て済みの詳細を使い回す
+    # (バージョンを持たない古い課題データは、ファイルのキャッシュのみ使う)
+    detail = problem_detail_cache.get(cache_key) if problem_detail.version is not None else None
+    if detail is None:
+        detail = build_problem_detail(problem_detail, preview_bytes)
+        if problem_detail.version is not None:
+            problem_detail_cache.put(cache_key, detail)
+    res.detail = detail
+
+    return conditional_json_response(request, res, CACHE_CONTROL_REVALIDATE, etag)
+
+
+@router.get("/{lecture_id}/{assignment_id}/testcases/{testcase_id}/{stream}", response_class=FileResponse)
+async def download_test_case_file(
+    lecture_id: int,
+    assignment_id: int,
+    testcase_id: int,
+    stream: Literal["stdin", "stdout", "stderr"],
+    request: Request,
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["me"]),
+    ],
+) -> FileResponse:
+    """
+    テストケースのstdin, stdout, stderrのファイル全体を取得する
+
+    Rangeヘッダによる部分的な取得に対応する(課題の詳細のプレビューの続きを取得する場合など)。
+    """
+    lecture_entry = assignments.get_lecture(db, lecture_id)
+    if lecture_entry is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="授業エントリが見つかりません",
         )
-    
-    # Executablesを読み込む
-    for executable in problem_detail.executables:
-        res.detail.executables.append(
-            response.Executables(
-                eval=executable.eval,
-                name=executable.name
+
+    if current_user.role not in [schemas.Role.admin, schemas.Role.manager]:
+        if not lecture_is_public(lecture_entry=lecture_entry):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="授業エントリが公開期間内ではありません",
             )
+
+    test_case = assignments.get_test_case(db, lecture_id, assignment_id, testcase_id)
+    if test_case is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="テストケースが見つかりません",
         )
-    
-    # 各TestCasesのstdin, stdout, stderrを読み込む
-    for test_case in problem_detail.test_cases:
-        test_case_record = response.TestCases(
-            id=test_case.id,
-            eval=test_case.eval,
-            type=test_case.type,
-            score=test_case.score,
-            title=test_case.title,
-            description=test_case.description,
-            command=test_case.command,
-            args=test_case.args,
-            # stdin, stdout, stderrは後でファイルから読み込む
-            exit_code=test_case.exit_code,
-        )
-        
-        # stdin, stdout, stderrを読み込む
-        if test_case.stdin_path is not None:
-            with open(Path(constant.RESOURCE_DIR) / test_case.stdin_path, "r") as f:
-                test_case_record.stdin = f.read()
-        if test_case.stdout_path is not None:
-            with open(Path(constant.RESOURCE_DIR) / test_case.stdout_path, "r") as f:
-                test_case_record.stdout = f.read()
-        if test_case.stderr_path is not None:
-            with open(Path(constant.RESOURCE_DIR) / test_case.stderr_path, "r") as f:
-                test_case_record.stderr = f.read()
-        res.detail.test_cases.append(test_case_record)
 
-    return res
+    ############################### Vital #####################################
+    access_sanitize(eval=test_case.eval, role=current_user.role)
+    ############################### Vital #####################################
 
+    resource_path = getattr(test_case, f"{stream}_path")
+    if resource_path is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"テストケースに{stream}のファイルがありません",
+        )
+
+    file_path = Path(constant.RESOURCE_DIR) / resource_path
+    headers = {"ETag": f'"{get_resource_file_digest(file_path)}"', "Cache-Control": CACHE_CONTROL_REVALIDATE}
+    if is_not_modified(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(
+        file_path,
+        filename=file_path.name,
+        media_type="text/plain; charset=utf-8",
+        headers=headers,
+    )
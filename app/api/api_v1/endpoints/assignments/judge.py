@@ -1,5 +1,5 @@
 from app.crud.db import assignments
-from .util import lecture_is_public, access_sanitize
+from .util import lecture_is_public, access_sanitize, judge_admission_control
 from fastapi import APIRouter, Depends, Query, Security, HTTPException, status, UploadFile, File
 from app.classes import schemas, response
 import logging
@@ -12,7 +12,10 @@ from app import constants as constant
 import shutil
 import tempfile
 from datetime import datetime
-from .util import unfold_zip
+from .util import unfold_zip, make_judge_cache_key, save_upload_files, upload_file_names
+from app import blobstore
+import uuid
+from starlette.concurrency import run_in_threadpool
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -62,7 +65,7 @@ async def single_judge(
         lecture_id=lecture_id,
         assignment_id=assignment_id,
         eval=eval,
-        detail=False,
+        detail=True,
     )
     if problem_entry is None:
         raise HTTPException(
@@ -70,38 +73,68 @@ async def single_judge(
             detail="課題エントリが見つかりません",
         )
 
-    # ジャッジリクエストをSubmissionテーブルに登録する
-    submission_record = assignments.register_submission(
-        db=db,
-        evaluation_status_id=None,
-        user_id=current_user.user_id,
-        lecture_id=lecture_id,
-        assignment_id=assignment_id,
-        eval=eval,
-        upload_dir="/tmp" # 仮の値
-    )
+    # ファイル名が不正な提出は、流量制限のトークンを消費する前に400エラーを返す
+    upload_file_names(file_list)
 
-    # アップロードされたファイルを/upload/{current_user.user_id}/{submission_record.ts}-{submission_id}に配置する
-    upload_dir = Path(constant.UPLOAD_DIR) / f"{current_user.user_id}" / f"{submission_record.ts.strftime('%Y-%m-%d-%H-%M-%S')}-{submission_record.id}"
-    if upload_dir.exists():
-        shutil.rmtree(upload_dir)
+    # 流量制限(ファイルを書き込む前にチェックする)
+    judge_admission_control(db=db, user=current_user)
 
-    upload_dir.mkdir(parents=True, exist_ok=True)
-    
-    # upload_dirをSubmissionテーブルに登録する
-    submission_record.upload_dir = str(upload_dir.relative_to(Path(constant.UPLOAD_DIR)))
+    # アップロードされたファイルを、Submissionテーブルに登録する前に一時ディレクトリに書き込む
+    # (書き込みに失敗した場合に、ファイルのない提出エントリが残らないようにする)
+    staging_dir = Path(constant.UPLOAD_DIR) / f"{current_user.user_id}" / f".staging-{uuid.uuid4().hex}"
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        # ファイルはストアに直接書き込まれ、同じ内容のファイルは実体を共有する
+        digests = await save_upload_files(file_list, staging_dir)
+        # 提出内容のハッシュ値(キャッシュキーの計算に使う)を、ファイルを読み直さずにマニフェストから計算する
+        content_hash = await run_in_threadpool(blobstore.upload_store.store_directory, staging_dir, digests)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    try:
+        # ジャッジリクエストをSubmissionテーブルに登録する(コミットはキューに登録するときに行う)
+        submission_record = assignments.register_submission(
+            db=db,
+            evaluation_status_id=None,
+            user_id=current_user.user_id,
+            lecture_id=lecture_id,
+            assignment_id=assignment_id,
+            eval=eval,
+            upload_dir="/tmp", # 仮の値
+            commit=False,
+        )
 
-    for file in file_list:
-        with file.file as source_file:
-            # filenameがNoneの場合は"unnamed_file_{index}"という名前を付ける
-            filename = file.filename if file.filename is not None else f"unnamed_file_{file_list.index(file)}"
-            dest_path = upload_dir / filename
-            with open(dest_path, "wb") as dest_file:
-                shutil.copyfileobj(source_file, dest_file)
+        # アップロードされたファイルを/upload/{current_user.user_id}/{submission_record.ts}-{submission_id}に配置する
+        upload_dir = Path(constant.UPLOAD_DIR) / f"{current_user.user_id}" / f"{submission_record.ts.strftime('%Y-%m-%d-%H-%M-%S')}-{submission_record.id}"
+        if upload_dir.exists():
+            shutil.rmtree(upload_dir)
+        staging_dir.rename(upload_dir)
+    except Exception:
+        db.rollback()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
 
-    # 提出エントリをキューに登録する
-    submission_record.progress = schemas.SubmissionProgressStatus.QUEUED
-    assignments.modify_submission(db=db, submission=submission_record)
+    try:
+        # upload_dirをSubmissionテーブルに登録する
+        submission_record.upload_dir = str(upload_dir.relative_to(Path(constant.UPLOAD_DIR)))
+
+        # 提出内容と課題リソースが同じジャッジ結果があれば、それをコピーしてジャッジを省略する
+        submission_record.cache_key = make_judge_cache_key(content_hash, problem_entry, eval)
+        cached_submission = assignments.get_cached_submission(db=db, cache_key=submission_record.cache_key)
+        if cached_submission is not None:
+            submission_record = assignments.complete_submission_from_cache(
+                db=db, submission=submission_record, cached_submission=cached_submission
+            )
+        else:
+            # 提出エントリをキューに登録する
+            submission_record.progress = schemas.SubmissionProgressStatus.QUEUED
+            assignments.modify_submission(db=db, submission=submission_record)
+    except Exception:
+        # 提出エントリがコミットされなかったので、配置したファイルも削除する
+        db.rollback()
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
 
     return response.Submission.model_validate(submission_record)
 
@@ -141,6 +174,9 @@ async def judge_all_by_lecture(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"zipファイル名が不正です。class{lecture_id}.zipを提出してください",
         )
+    
+    # 流量制限(ファイルを書き込む前にチェックする)
+    judge_admission_control(db=db, user=current_user, num_submissions=len(problem_list))
         
     # zipファイルの内容を{UPLOAD_DIR}/{user_id}/format-check/{lecture_id}/{current_timestamp}に配置する
     upload_dir = Path(constant.UPLOAD_DIR) / current_user.user_id / "format-check" / str(lecture_id) / datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
@@ -154,8 +190,9 @@ async def judge_all_by_lecture(
         temp_uploaded_zip_file_path = Path(temp_dir) / uploaded_zip_file.filename
         with open(temp_uploaded_zip_file_path, "wb") as temp_uploaded_zip_file:
             shutil.copyfileobj(uploaded_zip_file.file, temp_uploaded_zip_file)
-        # アップロードされたzipファイルをtemp_dirに解凍する
-        unzip_result = unfold_zip(temp_uploaded_zip_file_path, upload_dir)
+        # アップロードされたzipファイルをupload_dirに解凍する(展開したファイルはストアに登録される)
+        digests: dict[Path, str] = {}
+        unzip_result = unfold_zip(temp_uploaded_zip_file_path, upload_dir, digests)
         if unzip_result is not None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -213,6 +250,9 @@ async def judge_all_by_lecture(
 
     submission_record_list = []
     
+    # 提出ファイルをストアに登録し、提出内容のハッシュ値を得る(各Problemエントリのキャッシュキーの計算に使う)
+    content_hash = blobstore.upload_store.store_directory(workspace_dir, digests)
+    
     # 各Problemエントリごとに、Submissionエントリを作成する
     for problem_entry in problem_list:
         # ジャッジリクエストをSubmissionテーブルに登録する
@@ -225,6 +265,24 @@ async def judge_all_by_lecture(
             eval=eval,
             upload_dir=str(upload_dir.relative_to(Path(constant.UPLOAD_DIR)))
         )
+        
+        # 提出内容と課題リソースが同じジャッジ結果があれば、それをコピーしてジャッジを省略する
+        problem_detail = assignments.get_problem(
+            db=db,
+            lecture_id=problem_entry.lecture_id,
+            assignment_id=problem_entry.assignment_id,
+            eval=eval,
+            detail=True,
+        )
+        submission_record.cache_key = make_judge_cache_key(content_hash, problem_detail, eval)
+        cached_submission = assignments.get_cached_submission(db=db, cache_key=submission_record.cache_key)
+        if cached_submission is not None:
+            submission_record = assignments.complete_submission_from_cache(
+                db=db, submission=submission_record, cached_submission=cached_submission
+            )
+            submission_record_list.append(response.Submission.model_validate(submission_record))
+            continue
+        
         # 提出エントリをキューに登録する
         submission_record.progress = schemas.SubmissionProgressStatus.QUEUED
         assignments.modify_submission(db=db, submission=submission_record)
@@ -1,25 +1,110 @@
 from app.crud.db import assignments
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, Query, Security, File
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Request, status, UploadFile, Query, Security, File
+from fastapi.responses import FileResponse, Response
 from app.api.api_v1.endpoints import authenticate_util
 import logging
 from app.classes import schemas, response
-import jsonschema
-from jsonschema import exceptions as jsonschema_exceptions
+from jsonschema import validators as jsonschema_validators
+from jsonschema.protocols import Validator
 import json
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from app import constants as constant
-import tempfile
-from typing import Annotated, Optional, List
+from typing import Annotated, Iterator, NamedTuple, Optional, List
 from app.dependencies import get_db
 from sqlalchemy.orm import Session
 import zipfile
 import shutil
 from pydantic import ValidationError, BaseModel, Field, model_validator
 from datetime import datetime
+from .util import (
+    invalidate_arranged_files_bundles,
+    get_resource_file_digest,
+    is_not_modified,
+    CACHE_CONTROL_REVALIDATE,
+    CACHE_CONTROL_TEMPLATE,
+)
+from app.blobstore import resource_store
+from app.resource_cache import problem_detail_cache
+import uuid
+from starlette.concurrency import run_in_threadpool
 logging.basicConfig(level=logging.DEBUG)
 
 
+# 設定JSONファイルのスキーマから作ったバリデータ
+# ((スキーマファイルの更新時刻, サイズ), バリデータ)
+_problem_schema_validator_cache: tuple[tuple[int, int], Validator] | None = None
+
+
+def get_problem_schema_validator() -> Validator:
+    """
+    RESOURCE_DIR/schema.jsonから作ったバリデータを返す
+
+    スキーマファイルが更新されない限り、同じバリデータを使い回す。
+    """
+    global _problem_schema_validator_cache
+    schema_path = Path(constant.RESOURCE_DIR) / "schema.json"
+    stat_result = schema_path.stat()
+    cache_key = (stat_result.st_mtime_ns, stat_result.st_size)
+    if _problem_schema_validator_cache is None or _problem_schema_validator_cache[0] != cache_key:
+        with open(schema_path, "r") as f:
+            schema = json.load(f)
+        validator_class = jsonschema_validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        _problem_schema_validator_cache = (cache_key, validator_class(schema))
+    return _problem_schema_validator_cache[1]
+
+
+def validate_problem_data(problem_data: dict) -> None:
+    """
+    設定JSONファイル(init.json)の内容をスキーマで検証する
+
+    スキーマに違反する箇所が複数ある場合は、全ての箇所をまとめて400エラーで返す。
+    """
+    errors = sorted(
+        get_problem_schema_validator().iter_errors(problem_data),
+        key=lambda error: [str(key) for key in error.absolute_path],
+    )
+    if len(errors) > 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="\n".join(
+                f"{'/'.join(str(key) for key in error.absolute_path) or '(root)'}: {error.message}"
+                for error in errors
+            ),
+        )
+
+
+def store_problem_version(lecture_id: int, assignment_id: int, package_dir: Path) -> tuple[str, Path]:
+    """
+    展開した課題データをストアに登録し、(バージョン, バージョンのディレクトリ)を返す
+
+    バージョンは課題データの全ファイルの(相対パス, 内容, パーミッション)から計算したハッシュ値で、
+    RESOURCE_DIR/lec-{lecture_id}/problem-{assignment_id}/v-{バージョン}/extracted/に
+    ストアの実体へのハードリンクとして配置する。
+    前のバージョンから変わっていないファイルは実体を共有するので、更新時にはディスクへの書き込みは
+    変更のあったファイルの分だけになる。同じ内容の課題データが既に配置されている場合は、そのまま使う。
+    """
+    version = resource_store.store_directory(package_dir)
+    archive_dir = Path(constant.RESOURCE_DIR) / f"lec-{lecture_id}" / f"problem-{assignment_id}" / f"v-{version}"
+    target_dir = archive_dir / "extracted"
+    if not target_dir.exists():
+        # 書きかけのディレクトリが見えないように、一時ディレクトリに配置してからリネームする
+        staging_dir = archive_dir / f".extracted-{uuid.uuid4().hex}"
+        staging_dir.mkdir(parents=True)
+        try:
+            if not resource_store.materialize(version, staging_dir):
+                shutil.rmtree(staging_dir)
+                shutil.copytree(package_dir, staging_dir)
+            staging_dir.rename(target_dir)
+        except OSError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not target_dir.exists():
+                raise
+    return version, archive_dir
+
+
 class ProblemData(BaseModel):
     sub_id: int
     title: str
@@ -58,13 +143,261 @@ class TestCaseData(BaseModel):
         return self
 
 
+class ProblemPackage(NamedTuple):
+    """
+    検証済みの課題データ(ステージングディレクトリに展開されたもの)
+    """
+    problem_data: ProblemData
+    package_dir: Path
+
+
+@contextmanager
+def timed_step(timings: dict[str, float], step: str) -> Iterator[None]:
+    """
+    withブロックの処理時間(ミリ秒)をtimings[step]に記録する
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def load_problem_package(staging_dir: Path, zip_path: Path) -> ProblemPackage:
+    """
+    課題データのzipファイルをステージングディレクトリに展開し、設定JSONファイルと各ファイルの存在を検証する
+
+    問題がある場合は、全ての問題をまとめて400エラーで返す。
+    """
+    extract_dir = staging_dir / "extracted"
+    extract_dir.mkdir()
+    try:
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            zip_ref.extractall(extract_dir)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="zipファイルが壊れています")
+
+    current_dir = extract_dir
+    top_level_entries = list(current_dir.iterdir())
+    if len(top_level_entries) == 1 and top_level_entries[0].is_dir():
+        # トップにフォルダ一つのみなら、そのフォルダ以下をカレントディレクトリとする
+        current_dir = top_level_entries[0]
+    elif len(top_level_entries) > 1 and (current_dir / zip_path.stem).exists():
+        # トップにフォルダ一つのみでなく、かつ、ファイル名がフォルダ名と一致するファイルが存在する場合、そのファイルをカレントディレクトリとする
+        # 例: __MACOSXなどのメタ情報フォルダが含まれるケース
+        current_dir = current_dir / zip_path.stem
+
+    json_files = [f for f in current_dir.iterdir() if f.is_file() and f.suffix == ".json"]
+    if len(json_files) == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="JSONファイルがありません")
+
+    init_json_path = current_dir / "init.json"
+    if not init_json_path.exists():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="init.jsonがありません")
+
+    # ファイルの内容を読み込む
+    try:
+        with open(init_json_path, "r") as f:
+            problem_data = json.load(f)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"init.jsonの読み込みに失敗しました: {e}")
+
+    # schema validationを行う
+    validate_problem_data(problem_data)
+
+    # データをProblemDataに変換する
+    try:
+        problem_data = ProblemData.model_validate(problem_data)
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    error_message = ""
+    # problem_data.md_fileのパスにファイルがあるか確かめる
+    if not (current_dir / problem_data.md_file).exists():
+        error_message += f"md_fileのパス({problem_data.md_file})にファイルがありません\n"
+
+    # problem_data.test_filesのパスにファイルがあるか確かめる
+    for test_file in problem_data.test_files:
+        if not (current_dir / test_file).exists():
+            error_message += f"test_fileのパス({test_file})にファイルがありません\n"
+        # ファイルの拡張子が".sh"の場合、パーミッションに"x"をつける
+        elif test_file.suffix == ".sh":
+            (current_dir / test_file).chmod(0o755)
+
+    # problem_data.buildとproblem_data.judgeのstdin, stdout, stderrのパスにファイルがあるか確かめる
+    for test_case in problem_data.build + problem_data.judge:
+        for stream, path in [("stdin", test_case.stdin), ("stdout", test_case.stdout), ("stderr", test_case.stderr)]:
+            if path is not None and not (current_dir / path).exists():
+                error_message += f"testcase_[{test_case.title}]の{stream}のパス({path})にファイルがありません\n"
+
+    if error_message != "":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_message)
+
+    return ProblemPackage(problem_data=problem_data, package_dir=current_dir)
+
+
+def build_problem_record(lecture_id: int, problem_data: ProblemData, version: str, target_dir: Path) -> schemas.Problem:
+    """
+    課題データのバージョンのディレクトリ(target_dir)に配置した課題データから、Problemテーブルに登録する内容を作る
+    """
+    def resource_path(path: Path | None) -> str | None:
+        return str((target_dir / path).relative_to(constant.RESOURCE_DIR)) if path is not None else None
+
+    return schemas.Problem(
+        lecture_id=lecture_id,
+        assignment_id=problem_data.sub_id,
+        title=problem_data.title,
+        description_path=resource_path(problem_data.md_file),
+        timeMS=problem_data.time_ms,
+        memoryMB=problem_data.memory_mb,
+        version=version,
+        executables=[],
+        arranged_files=[
+            schemas.ArrangedFiles(
+                lecture_id=lecture_id,
+                assignment_id=problem_data.sub_id,
+                eval=False,
+                path=resource_path(test_file)
+            )
+            for test_file in problem_data.test_files
+        ],
+        required_files=[
+            schemas.RequiredFiles(
+                lecture_id=lecture_id,
+                assignment_id=problem_data.sub_id,
+                name=str(required_file)
+            )
+            for required_file in problem_data.required_files
+        ],
+        test_cases=[
+            schemas.TestCases(
+                lecture_id=lecture_id,
+                assignment_id=problem_data.sub_id,
+                eval=test_case.eval_only,
+                type=evaluation_type,
+                score=0,
+                title=test_case.title,
+                description=test_case.description,
+                message_on_fail=test_case.message_on_fail,
+                command=test_case.command,
+                args=None,
+                stdin_path=resource_path(test_case.stdin),
+                stdout_path=resource_path(test_case.stdout),
+                stderr_path=resource_path(test_case.stderr),
+                exit_code=test_case.exit
+            )
+            for evaluation_type, test_cases in [
+                (schemas.EvaluationType.Built, problem_data.build),
+                (schemas.EvaluationType.Judge, problem_data.judge),
+            ]
+            for test_case in test_cases
+        ]
+    )
+
+
+def diff_problem_versions(diff: schemas.ProblemDiff, previous_version: str | None, version: str) -> None:
+    """
+    前のバージョンと新しいバージョンのマニフェストを比べて、追加・削除・変更されたファイルをdiffに記録する
+    """
+    if previous_version is None or previous_version == version:
+        return
+    previous_manifest = resource_store.read_manifest(previous_version)
+    manifest = resource_store.read_manifest(version)
+    if previous_manifest is None or manifest is None:
+        return
+    diff.added_files = sorted(manifest.keys() - previous_manifest.keys())
+    diff.removed_files = sorted(previous_manifest.keys() - manifest.keys())
+    diff.changed_files = sorted(
+        relative_path
+        for relative_path in manifest.keys() & previous_manifest.keys()
+        if manifest[relative_path] != previous_manifest[relative_path]
+    )
+
+
+def ingest_problem_package(
+    db: Session, lecture_id: int, upload_file: UploadFile, allow_replace: bool
+) -> response.ProblemIngestResult:
+    """
+    課題データのzipファイルを取り込み、Problemテーブルと子テーブルに登録する(追加APIと更新APIで共通)
+
+    1. upload: zipファイルを{RESOURCE_DIR}/temp/{uuid}/(ステージングディレクトリ)に保存する
+    2. validate: ステージングディレクトリに展開し、設定JSONファイルと各ファイルを検証する
+    3. store: 課題データのバージョンのディレクトリ(v-{バージョン})に配置する
+    4. commit: Problemテーブルと子テーブル、ProblemZipPathテーブルを一つのトランザクションで置き換える
+    5. invalidate: 古い課題データから作ったarranged_filesのZIPファイルを削除する
+
+    検証が終わるまでは既存の課題データに触れず、古いバージョンのディレクトリも削除しないので、
+    演習中に更新しても、小課題が存在しない時間や、採点中の提出から課題データが見えなくなる時間はない。
+    allow_replaceがFalseの場合は、小課題が既に存在するときに400エラーを返す。
+    各段階の処理時間(ミリ秒)は、ログに出力し、レスポンスのtimingsにも含める。
+    ファイルの読み書きとDBへのアクセスを同期的に行うので、エンドポイントからはrun_in_threadpoolで呼び出すこと。
+    """
+    timings: dict[str, float] = {}
+    # ZIPファイルはarchive_dir/{ファイル名}に保存するので、ディレクトリを含むファイル名の部分は使わない
+    zip_name = Path(upload_file.filename).name if upload_file.filename is not None else ""
+    if zip_name in ("", ".", "..") or "\x00" in zip_name:
+        zip_name = f"problem_data_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.zip"
+    # 同じファイル名のzipファイルが同時にアップロードされても衝突しないように、リクエストごとのディレクトリを使う
+    # (RESOURCE_DIRと同じファイルシステム上に置き、ストアへの登録をハードリンクで行えるようにする)
+    staging_dir = Path(constant.RESOURCE_DIR) / "temp" / uuid.uuid4().hex
+    staging_dir.mkdir(parents=True)
+    try:
+        with timed_step(timings, "upload"):
+            temporary_zip_path = staging_dir / zip_name
+            with open(temporary_zip_path, "wb") as f:
+                shutil.copyfileobj(upload_file.file, f)
+
+        with timed_step(timings, "validate"):
+            package = load_problem_package(staging_dir, temporary_zip_path)
+            problem_data = package.problem_data
+            current_problem = assignments.get_problem(db, lecture_id, problem_data.sub_id)
+            if current_problem is not None and not allow_replace:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="小課題IDが既に存在します")
+
+        with timed_step(timings, "store"):
+            # current_dirの中身のファイル全てを、課題データのバージョンのディレクトリに配置する
+            version, archive_dir = store_problem_version(lecture_id, problem_data.sub_id, package.package_dir)
+            problem_record = build_problem_record(lecture_id, problem_data, version, archive_dir / "extracted")
+            # ZIPファイルをarchive_dirに配置する(同じZIPファイルは実体を共有する)
+            resource_store.store_file(temporary_zip_path, archive_dir / zip_name)
+
+        with timed_step(timings, "commit"):
+            diff = assignments.replace_problem(db, problem_record, schemas.ProblemZipPath(
+                lecture_id=lecture_id,
+                assignment_id=problem_data.sub_id,
+                zip_path=str((archive_dir / zip_name).relative_to(constant.RESOURCE_DIR))
+            ))
+            diff_problem_versions(diff, diff.previous_version, version)
+
+        with timed_step(timings, "invalidate"):
+            # 古い課題データから作ったarranged_filesのZIPファイルと、組み立て済みの詳細を削除する
+            invalidate_arranged_files_bundles(lecture_id, problem_data.sub_id)
+            problem_detail_cache.invalidate_problem(lecture_id, problem_data.sub_id)
+    finally:
+        # 一時ファイルを削除する
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    logging.info(
+        f"Ingested problem package lecture_id={lecture_id} assignment_id={problem_data.sub_id} "
+        f"version={version} timings(ms)={timings}"
+    )
+    return response.ProblemIngestResult(
+        message="課題データを登録しました" if diff.created else "課題データを更新しました",
+        lecture_id=lecture_id,
+        assignment_id=problem_data.sub_id,
+        version=version,
+        diff=diff,
+        timings=timings,
+    )
+
+
 router = APIRouter()
 
 """
 /api/v1/assignments/problem/...以下のエンドポイントの定義
 """
 
-@router.post("/add", response_model=response.Message)
+@router.post("/add", response_model=response.ProblemIngestResult | response.Message)
 async def add_problem(
     lecture_id: Annotated[int, Query(description="編集対象の課題データの講義ID")],
     lecture_title: Annotated[str, Query(description="編集対象の課題データの講義タイトル")],
@@ -74,7 +407,7 @@ async def add_problem(
     is_update: Annotated[bool, Query(description="trueの場合は、upload_fileの内容を元にProblemテーブルに小課題データを登録する")],
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[schemas.UserRecord, Security(authenticate_util.get_current_active_user, scopes=["batch"])]
-) -> response.Message:
+) -> response.ProblemIngestResult | response.Message:
     """
     課題データの追加API
     
@@ -99,362 +432,34 @@ async def add_problem(
     if is_update is False:
         return response.Message(message="lectureの内容のみ更新されました")
     
-    # zipファイルを{RESOURCE_DIR}/temp/に配置する
-    temporary_zip_path = Path(constant.RESOURCE_DIR) / "temp" / (upload_file.filename if upload_file.filename is not None else f"problem_data_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.zip")
-    temporary_zip_path.parent.mkdir(parents=True, exist_ok=True)
-    # zipファイルをtemporary_zip_pathに配置する
-    with open(temporary_zip_path, "wb") as f:
-        shutil.copyfileobj(upload_file.file, f)
-    
-    # zipファイルをtemporaryディレクトリに展開する
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(temporary_zip_path, "r") as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        current_dir = Path(temp_dir)
-        
-        if len(list(current_dir.iterdir())) == 1 and list(current_dir.iterdir())[0].is_dir():
-            # トップにフォルダ一つのみなら、そのフォルダ以下をカレントディレクトリとする
-            current_dir = list(current_dir.iterdir())[0]
-        elif len(list(current_dir.iterdir())) > 1 and (current_dir / Path(upload_file.filename).stem).exists():
-            # トップにフォルダ一つのみでなく、かつ、ファイル名がフォルダ名と一致するファイルが存在する場合、そのファイルをカレントディレクトリとする
-            # 例: __MACOSXなどのメタ情報フォルダが含まれるケース
-            current_dir = current_dir / Path(upload_file.filename).stem
-        
-        json_files = [f for f in current_dir.iterdir() if f.is_file() and f.suffix == ".json"]
-        if len(json_files) == 0:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="JSONファイルがありません")
-        
-        init_json_path = current_dir / "init.json"
-        if not init_json_path.exists():
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="init.jsonがありません")
-        
-        # ファイルの内容を読み込む
-        with open(init_json_path, "r") as f:
-            problem_data = json.load(f)
-        
-        # 設定JSONファイルのスキーマファイルを読み込む
-        with open(Path(constant.RESOURCE_DIR) / "schema.json", "r") as f:
-            schema = json.load(f)
-        
-        # schema validationを行う
-        try:
-            jsonschema.validate(problem_data, schema)
-        except jsonschema_exceptions.ValidationError as e:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
-        
-        # データをProblemDataに変換する
-        try:
-            problem_data = ProblemData.model_validate(problem_data)
-        except ValidationError as e:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
-
-        # sub_idが既に存在するか調べる
-        if assignments.get_problem(db, lecture.id, problem_data.sub_id) is not None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="小課題IDが既に存在します")
-        
-        error_message = ""
-        # problem_data.md_fileのパスにファイルがあるか確かめる
-        if not (current_dir / problem_data.md_file).exists():
-            error_message += f"md_fileのパス({problem_data.md_file})にファイルがありません\n"
-            
-        # problem_data.test_filesのパスにファイルがあるか確かめる
-        for test_file in problem_data.test_files:
-            if not (current_dir / test_file).exists():
-                error_message += f"test_fileのパス({test_file})にファイルがありません\n"
-            # ファイルの拡張子が".sh"の場合、パーミッションに"x"をつける
-            elif test_file.suffix == ".sh":
-                (current_dir / test_file).chmod(0o755)
-        
-        # problem_data.buildとproblem_data.judgeのstdin, stdout, stderrのパスにファイルがあるか確かめる
-        for test_case in problem_data.build + problem_data.judge:
-            if test_case.stdin is not None and not (current_dir / test_case.stdin).exists():
-                error_message += f"testcase_[{test_case.title}]のstdinのパス({test_case.stdin})にファイルがありません\n"
-            if test_case.stdout is not None and not (current_dir / test_case.stdout).exists():
-                error_message += f"testcase_[{test_case.title}]のstdoutのパス({test_case.stdout})にファイルがありません\n"
-            if test_case.stderr is not None and not (current_dir / test_case.stderr).exists():
-                error_message += f"testcase_[{test_case.title}]のstderrのパス({test_case.stderr})にファイルがありません\n"
-        
-        if error_message != "":
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_message)
-        
-        archive_dir = Path(constant.RESOURCE_DIR) / f"lec-{lecture.id}" / f"problem-{problem_data.sub_id}" / f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-        # current_dirの中身のファイル全てを、RESOURCE_DIR/lec-{lecture_id}/problem-{problem_data.sub_id}/{YYYY-MM-DD_HH-MM-SS}/extracted/にコピーする
-        target_dir = archive_dir / "extracted"
-        shutil.copytree(current_dir, target_dir)
-        
-        # 小課題データを登録する
-        problem_record = schemas.Problem(
-            lecture_id=lecture.id,
-            assignment_id=problem_data.sub_id,
-            title=problem_data.title,
-            description_path=str((target_dir / problem_data.md_file).relative_to(constant.RESOURCE_DIR)),
-            timeMS=problem_data.time_ms,
-            memoryMB=problem_data.memory_mb,
-            executables=[],
-            arranged_files=[
-                schemas.ArrangedFiles(
-                    lecture_id=lecture.id,
-                    assignment_id=problem_data.sub_id,
-                    eval=False,
-                    path=str((target_dir / test_file).relative_to(constant.RESOURCE_DIR))
-                )
-                for test_file in problem_data.test_files
-            ],
-            required_files=[
-                schemas.RequiredFiles(
-                    lecture_id=lecture.id,
-                    assignment_id=problem_data.sub_id,
-                    name=str(required_file)
-                )
-                for required_file in problem_data.required_files
-            ],
-            test_cases=
-                [
-                    schemas.TestCases(
-                        lecture_id=lecture.id,
-                        assignment_id=problem_data.sub_id,
-                        eval=test_case.eval_only,
-                        type=schemas.EvaluationType.Built,
-                        score=0,
-                        title=test_case.title,
-                        description=test_case.description,
-                        message_on_fail=test_case.message_on_fail,
-                        command=test_case.command,
-                        args=None,
-                        stdin_path=str((target_dir / test_case.stdin).relative_to(constant.RESOURCE_DIR)) if test_case.stdin is not None else None,
-                        stdout_path=str((target_dir / test_case.stdout).relative_to(constant.RESOURCE_DIR)) if test_case.stdout is not None else None,
-                        stderr_path=str((target_dir / test_case.stderr).relative_to(constant.RESOURCE_DIR)) if test_case.stderr is not None else None,
-                        exit_code=test_case.exit
-                    )
-                    for test_case in problem_data.build
-                ] + [
-                    schemas.TestCases(
-                        lecture_id=lecture.id,
-                        assignment_id=problem_data.sub_id,
-                        eval=test_case.eval_only,
-                        type=schemas.EvaluationType.Judge,
-                        score=0,
-                        title=test_case.title,
-                        description=test_case.description,
-                        message_on_fail=test_case.message_on_fail,
-                        command=test_case.command,
-                        args=None,
-                        stdin_path=str((target_dir / test_case.stdin).relative_to(constant.RESOURCE_DIR)) if test_case.stdin is not None else None,
-                        stdout_path=str((target_dir / test_case.stdout).relative_to(constant.RESOURCE_DIR)) if test_case.stdout is not None else None,
-                        stderr_path=str((target_dir / test_case.stderr).relative_to(constant.RESOURCE_DIR)) if test_case.stderr is not None else None,
-                        exit_code=test_case.exit
-                    )
-                    for test_case in problem_data.judge
-                ]
-        )
-        
-        assignments.register_problem(db, problem_record)
-        
-        # ZIPファイルをarchive_dirにコピーする
-        shutil.copyfile(temporary_zip_path, archive_dir / temporary_zip_path.name)
-        
-        # 登録情報をProblemZipPathに登録する
-        assignments.register_problem_zip_path(db, schemas.ProblemZipPath(
-            lecture_id=lecture.id,
-            assignment_id=problem_data.sub_id,
-            zip_path=str((archive_dir / temporary_zip_path.name).relative_to(constant.RESOURCE_DIR))
-        ))
-        
-        # 一時ファイルを削除する
-        temporary_zip_path.unlink()
-
-        return response.Message(message="課題データを登録しました")
+    return await run_in_threadpool(ingest_problem_package, db, lecture.id, upload_file, allow_replace=False)
 
 
-@router.post("/update", response_model=response.Message)
+@router.post("/update", response_model=response.ProblemIngestResult)
 async def update_problem(
     lecture_id: Annotated[int, Query(description="編集対象の小課題のlecture_id")],
     upload_file: Annotated[UploadFile, File(description="課題データのソースコード、テストケース、設定JSONファイルを含むzipファイル")],
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[schemas.UserRecord, Security(authenticate_util.get_current_active_user, scopes=["batch"])]
-) -> response.Message:
+) -> response.ProblemIngestResult:
     """
     課題データの更新API
+
+    小課題が存在しない場合は、新しく登録する。
     """
     
     lecture = assignments.get_lecture(db, lecture_id)
     if lecture is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="指定されたlecture_idの課題エントリが存在しません")
     
-    # zipファイルを{RESOURCE_DIR}/temp/に配置する
-    temporary_zip_path = Path(constant.RESOURCE_DIR) / "temp" / (upload_file.filename if upload_file.filename is not None else f"problem_data_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.zip")
-    temporary_zip_path.parent.mkdir(parents=True, exist_ok=True)
-    # zipファイルをtemporary_zip_pathに配置する
-    with open(temporary_zip_path, "wb") as f:
-        shutil.copyfileobj(upload_file.file, f)
-
-    # zipファイルをtemporaryディレクトリに展開する
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(temporary_zip_path, "r") as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        current_dir = Path(temp_dir)
-        
-        if len(list(current_dir.iterdir())) == 1 and list(current_dir.iterdir())[0].is_dir():
-            # トップにフォルダ一つのみなら、そのフォルダ以下をカレントディレクトリとする
-            current_dir = list(current_dir.iterdir())[0]
-        elif len(list(current_dir.iterdir())) > 1 and (current_dir / Path(upload_file.filename).stem).exists():
-            # トップにフォルダ一つのみでなく、かつ、ファイル名がフォルダ名と一致するファイルが存在する場合、そのファイルをカレントディレクトリとする
-            # 例: __MACOSXなどのメタ情報フォルダが含まれるケース
-            current_dir = current_dir / Path(upload_file.filename).stem
-        
-        json_files = [f for f in current_dir.iterdir() if f.is_file() and f.suffix == ".json"]
-        if len(json_files) == 0:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="JSONファイルがありません")
-        
-        init_json_path = current_dir / "init.json"
-        if not init_json_path.exists():
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="init.jsonがありません")
-        
-        # ファイルの内容を読み込む
-        with open(init_json_path, "r") as f:
-            problem_data = json.load(f)
-        
-        # 設定JSONファイルのスキーマファイルを読み込む
-        with open(Path(constant.RESOURCE_DIR) / "schema.json", "r") as f:
-            schema = json.load(f)
-        
-        # schema validationを行う
-        try:
-            jsonschema.validate(problem_data, schema)
-        except jsonschema_exceptions.ValidationError as e:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
-        
-        # データをProblemDataに変換する
-        try:
-            problem_data = ProblemData.model_validate(problem_data)
-        except ValidationError as e:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
-        
-        
-        error_message = ""
-        # problem_data.md_fileのパスにファイルがあるか確かめる
-        if not (current_dir / problem_data.md_file).exists():
-            error_message += f"md_fileのパス({problem_data.md_file})にファイルがありません\n"
-        
-        # problem_data.test_filesのパスにファイルがあるか確かめる
-        for test_file in problem_data.test_files:
-            if not (current_dir / test_file).exists():
-                error_message += f"test_fileのパス({test_file})にファイルがありません\n"
-            # ファイルの拡張子が".sh"の場合、パーミッションに"x"をつける
-            elif test_file.suffix == ".sh":
-                (current_dir / test_file).chmod(0o755)
-        
-        # Problemテーブルに該当する小課題があるなら、それを削除する
-        if assignments.get_problem(db, lecture_id, problem_data.sub_id) is not None:
-            assignments.delete_problem(db, lecture_id, problem_data.sub_id)
-
-        # problem_data.buildとproblem_data.judgeのstdin, stdout, stderrのパスにファイルがあるか確かめる
-        for test_case in problem_data.build + problem_data.judge:
-            if test_case.stdin is not None and not (current_dir / test_case.stdin).exists():
-                error_message += f"testcase_[{test_case.title}]のstdinのパス({test_case.stdin})にファイルがありません\n"
-            if test_case.stdout is not None and not (current_dir / test_case.stdout).exists():
-                error_message += f"testcase_[{test_case.title}]のstdoutのパス({test_case.stdout})にファイルがありません\n"
-            if test_case.stderr is not None and not (current_dir / test_case.stderr).exists():
-                error_message += f"testcase_[{test_case.title}]のstderrのパス({test_case.stderr})にファイルがありません\n"
-        
-        if error_message != "":
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error_message)
-        
-        archive_dir = Path(constant.RESOURCE_DIR) / f"lec-{lecture.id}" / f"problem-{problem_data.sub_id}" / f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
-        # current_dirの中身のファイル全てを、RESOURCE_DIR/lec-{lecture_id}/problem-{problem_data.sub_id}/{YYYY-MM-DD_HH-MM-SS}/extracted/にコピーする
-        target_dir = archive_dir / "extracted"
-        shutil.copytree(current_dir, target_dir)
-        
-        # 小課題データを登録する
-        problem_record = schemas.Problem(
-            lecture_id=lecture.id,
-            assignment_id=problem_data.sub_id,
-            title=problem_data.title,
-            description_path=str((target_dir / problem_data.md_file).relative_to(constant.RESOURCE_DIR)),
-            timeMS=problem_data.time_ms,
-            memoryMB=problem_data.memory_mb,
-            executables=[],
-            arranged_files=[
-                schemas.ArrangedFiles(
-                    lecture_id=lecture.id,
-                    assignment_id=problem_data.sub_id,
-                    eval=False,
-                    path=str((target_dir / test_file).relative_to(constant.RESOURCE_DIR))
-                )
-                for test_file in problem_data.test_files
-            ],
-            required_files=[
-                schemas.RequiredFiles(
-                    lecture_id=lecture.id,
-                    assignment_id=problem_data.sub_id,
-                    name=str(required_file)
-                )
-                for required_file in problem_data.required_files
-            ],
-            test_cases=
-                [
-                    schemas.TestCases(
-                        lecture_id=lecture.id,
-                        assignment_id=problem_data.sub_id,
-                        eval=test_case.eval_only,
-                        type=schemas.EvaluationType.Built,
-                        score=0,
-                        title=test_case.title,
-                        description=test_case.description,
-                        message_on_fail=test_case.message_on_fail,
-                        command=test_case.command,
-                        args=None,
-                        stdin_path=str((target_dir / test_case.stdin).relative_to(constant.RESOURCE_DIR)) if test_case.stdin is not None else None,
-                        stdout_path=str((target_dir / test_case.stdout).relative_to(constant.RESOURCE_DIR)) if test_case.stdout is not None else None,
-                        stderr_path=str((target_dir / test_case.stderr).relative_to(constant.RESOURCE_DIR)) if test_case.stderr is not None else None,
-                        exit_code=test_case.exit
-                    )
-                    for test_case in problem_data.build
-                ] + [
-                    schemas.TestCases(
-                        lecture_id=lecture.id,
-                        assignment_id=problem_data.sub_id,
-                        eval=test_case.eval_only,
-                        type=schemas.EvaluationType.Judge,
-                        score=0,
-                        title=test_case.title,
-                        description=test_case.description,
-                        message_on_fail=test_case.message_on_fail,
-                        command=test_case.command,
-                        args=None,
-                        stdin_path=str((target_dir / test_case.stdin).relative_to(constant.RESOURCE_DIR)) if test_case.stdin is not None else None,
-                        stdout_path=str((target_dir / test_case.stdout).relative_to(constant.RESOURCE_DIR)) if test_case.stdout is not None else None,
-                        stderr_path=str((target_dir / test_case.stderr).relative_to(constant.RESOURCE_DIR)) if test_case.stderr is not None else None,
-                        exit_code=test_case.exit
-                    )
-                    for test_case in problem_data.judge
-                ]
-        )
-        
-        assignments.register_problem(db, problem_record)
-        
-        # ZIPファイルをarchive_dirにコピーする
-        shutil.copyfile(temporary_zip_path, archive_dir / temporary_zip_path.name)
-        
-        # 登録情報をProblemZipPathに登録する
-        assignments.register_problem_zip_path(db, schemas.ProblemZipPath(
-            lecture_id=lecture.id,
-            assignment_id=problem_data.sub_id,
-            zip_path=str((archive_dir / temporary_zip_path.name).relative_to(constant.RESOURCE_DIR))
-        ))
-        
-        # 一時ファイルを削除する
-        temporary_zip_path.unlink()
-
-        return response.Message(message="課題データを更新しました")
+    return await run_in_threadpool(ingest_problem_package, db, lecture.id, upload_file, allow_replace=True)
 
 
 @router.get("/download", response_class=FileResponse)
 async def download_problem(
     lecture_id: Annotated[int, Query(description="ダウンロード対象の小課題のlecture_id")],
     problem_id: Annotated[int, Query(description="ダウンロード対象の小課題のproblem_id")],
+    request: Request,
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[schemas.UserRecord, Security(authenticate_util.get_current_active_user, scopes=["batch"])]
 ) -> FileResponse:
@@ -469,18 +474,26 @@ async def download_problem(
     # 最もts(timestamp)が最新のZIPファイルのパスを取得する
     latest_problem_zip_path = sorted(problem_zip_paths, key=lambda x: x.ts, reverse=True)[0]
     
-    return FileResponse(Path(constant.RESOURCE_DIR) / latest_problem_zip_path.zip_path, filename=Path(latest_problem_zip_path.zip_path).name, media_type="application/zip")
+    zip_path = Path(constant.RESOURCE_DIR) / latest_problem_zip_path.zip_path
+    headers = {"ETag": f'"{get_resource_file_digest(zip_path)}"', "Cache-Control": CACHE_CONTROL_REVALIDATE}
+    if is_not_modified(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(zip_path, filename=zip_path.name, media_type="application/zip", headers=headers)
 
 
 @router.get("/template", response_class=FileResponse)
 async def download_template(
+    request: Request,
     current_user: Annotated[schemas.UserRecord, Security(authenticate_util.get_current_active_user, scopes=["batch"])]
 ) -> FileResponse:
     """
     課題データのテンプレートダウンロードAPI
     """
     template_path = Path(constant.RESOURCE_DIR) / "template.zip"
-    return FileResponse(template_path, filename=template_path.name, media_type="application/zip")
+    headers = {"ETag": f'"{get_resource_file_digest(template_path)}"', "Cache-Control": CACHE_CONTROL_TEMPLATE}
+    if is_not_modified(request, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(template_path, filename=template_path.name, media_type="application/zip", headers=headers)
 
 
 @router.delete("/delete", response_model=response.Message)
@@ -498,5 +511,7 @@ async def delete_problem(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="指定された小課題が存在しません")
     
     assignments.delete_problem(db, lecture_id, problem_id)
+    invalidate_arranged_files_bundles(lecture_id, problem_id)
+    problem_detail_cache.invalidate_problem(lecture_id, problem_id)
     
     return response.Message(message="課題データを削除しました")
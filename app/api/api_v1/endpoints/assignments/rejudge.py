@@ -0,0 +1,145 @@
+from app.crud.db import assignments
+from app.crud.db import SessionLocal
+from fastapi import APIRouter, BackgroundTasks, Depends, Query, Security, HTTPException, status
+from app.classes import schemas, response
+import logging
+from typing import Annotated, Literal, Optional
+from sqlalchemy.orm import Session
+from app.dependencies import get_db
+from app.api.api_v1.endpoints import authenticate_util
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+router = APIRouter()
+
+"""
+/api/v1/assignments/rejudge/...以下のエンドポイントの定義
+"""
+
+# 再ジャッジする提出の優先度(通常の提出(0)より後にジャッジされる)
+REJUDGE_PRIORITY = -1
+# 1回のUPDATEで再ジャッジ対象にする提出の数
+# Submissionテーブルを長時間ロックしないように、小分けにしてコミットする
+REJUDGE_CHUNK_SIZE = 200
+
+
+def run_rejudge(rejudge_id: int) -> None:
+    """
+    一括再ジャッジを実行する
+
+    対象の提出をIDの昇順にREJUDGE_CHUNK_SIZE件ずつ取得し、ジャッジ結果を削除してキューに積み直す。
+    リクエストのレスポンスを返した後にバックグラウンドで実行されるため、独自にDBセッションを作成する。
+    """
+    db = SessionLocal()
+    try:
+        rejudge_request = assignments.get_rejudge_request(db, rejudge_id)
+        if rejudge_request is None:
+            return
+
+        assignments.update_rejudge_request_progress(
+            db, rejudge_id, schemas.RejudgeProgressStatus.RUNNING
+        )
+
+        last_id = 0
+        while True:
+            submission_ids = assignments.get_rejudge_target_ids(
+                db, rejudge_request, after_id=last_id, limit=REJUDGE_CHUNK_SIZE
+            )
+            if len(submission_ids) == 0:
+                break
+
+            assignments.requeue_submissions_for_rejudge(db, submission_ids, priority=REJUDGE_PRIORITY)
+            assignments.update_rejudge_request_progress(
+                db,
+                rejudge_id,
+                schemas.RejudgeProgressStatus.RUNNING,
+                processed_increment=len(submission_ids),
+            )
+            last_id = submission_ids[-1]
+
+        assignments.update_rejudge_request_progress(
+            db, rejudge_id, schemas.RejudgeProgressStatus.DONE
+        )
+    except Exception as e:
+        logging.error(f"Error while rejudging (rejudge_id: {rejudge_id}): {e}")
+        db.rollback()
+        assignments.update_rejudge_request_progress(
+            db,
+            rejudge_id,
+            schemas.RejudgeProgressStatus.FAILED,
+            message=f"再ジャッジ中にエラーが発生しました: {e}"[:255],
+        )
+    finally:
+        db.close()
+
+
+@router.post("", response_model=response.RejudgeRequest)
+async def request_rejudge(
+    lecture_id: Annotated[int, Query(description="再ジャッジ対象の提出の講義ID")],
+    background_tasks: BackgroundTasks,
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["batch"]),
+    ],
+    assignment_id: Optional[int] = Query(default=None, description="再ジャッジ対象の提出の課題ID"),
+    batch_id: Optional[int] = Query(default=None, description="再ジャッジ対象のバッチ採点のID"),
+    result: Optional[Literal["AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN"]] = Query(default=None, description="再ジャッジ対象の提出結果"),
+) -> response.RejudgeRequest:
+    """
+    ジャッジが完了した提出を条件で絞り込み、一括で再ジャッジする
+
+    課題データの更新(テストケースの修正など)の後に、既存の提出をジャッジし直すために使う。
+    再ジャッジは通常の提出より低い優先度でキューに積まれる。
+    進捗状況は GET /rejudge/{rejudge_id} で取得できる。
+    """
+    if assignments.get_lecture(db, lecture_id) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="授業エントリが見つかりません",
+        )
+
+    if batch_id is not None:
+        batch_submission = assignments.get_batch_submission_status(db, batch_id)
+        if batch_submission is None or batch_submission.lecture_id != lecture_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="バッチ採点エントリが見つかりません",
+            )
+
+    rejudge_request = schemas.RejudgeRequest(
+        user_id=current_user.user_id,
+        lecture_id=lecture_id,
+        assignment_id=assignment_id,
+        batch_id=batch_id,
+        result=schemas.SubmissionSummaryStatus(result) if result is not None else None,
+    )
+    rejudge_request.total = assignments.count_rejudge_targets(db, rejudge_request)
+    rejudge_request = assignments.register_rejudge_request(db, rejudge_request)
+
+    background_tasks.add_task(run_rejudge, rejudge_request.id)
+
+    return response.RejudgeRequest.model_validate(rejudge_request)
+
+
+@router.get("/{rejudge_id}", response_model=response.RejudgeRequest)
+async def read_rejudge_status(
+    rejudge_id: int,
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["batch"]),
+    ],
+) -> response.RejudgeRequest:
+    """
+    一括再ジャッジの進捗状況を取得する
+    """
+    rejudge_request = assignments.get_rejudge_request(db, rejudge_id)
+    if rejudge_request is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="再ジャッジのリクエストが見つかりません",
+        )
+
+    return response.RejudgeRequest.model_validate(rejudge_request)
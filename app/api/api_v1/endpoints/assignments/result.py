@@ -1,17 +1,17 @@
 from app.crud.db import assignments, users
-from fastapi import APIRouter, Depends, Query, Security, HTTPException, status
-from fastapi.responses import FileResponse
-from starlette.background import BackgroundTask
-from app.classes import schemas, response
+from fastapi import APIRouter, Depends, Query, Request, Security, HTTPException, status
+from fastapi.responses import FileResponse, StreamingResponse
+from app.classes import schemas, response, mapping
+from app.responses import FastJSONResponse, jsonable
 import logging
 from typing import Annotated, List, Literal, Optional
 from sqlalchemy.orm import Session
 from app.dependencies import get_db
+from app.crud.db import SessionLocal
 from app.api.api_v1.endpoints import authenticate_util
 from pathlib import Path
 from app import constants as constant
-import tempfile
-import zipfile
+from .util import zip_streaming_response, conditional_json_response, CACHE_CONTROL_REVALIDATE
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -22,9 +22,6 @@ router = APIRouter()
 /api/v1/assignments/result/...以下のエンドポイントの定義
 """
 
-def delete_temp_dir(temp_dir: tempfile.TemporaryDirectory):
-    temp_dir.cleanup()
-
 @router.get("/submissions/id/{submission_id}", response_model=response.Submission)
 async def read_submission_summary(
     submission_id: int,
@@ -79,20 +76,17 @@ async def read_submission_summary(
     return res
 
 
-@router.get("/batch/id/{batch_id}", response_model=response.BatchSubmissionDetailItem)
-async def read_batch_submission_summary(
-    batch_id: int,
-    db: Annotated[Session, Depends(get_db)],
-    current_user: Annotated[
-        schemas.UserRecord,
-        Security(authenticate_util.get_current_active_user, scopes=["batch"]),
-    ],
-) -> response.BatchSubmissionDetailItem:
+EvaluationStatusSortKey = Literal["user_id", "username", "status", "result", "submit_date"]
+StudentSubmissionStatusFilter = Literal["submitted", "delay", "non-submitted"]
+SubmissionResultFilter = Literal["AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN"]
+
+
+def get_completed_batch_submission(db: Session, batch_id: int) -> tuple[schemas.BatchSubmission, response.Lecture]:
     """
-    特定のバッチ採点のジャッジ結果を取得する
-    
-    詳細は(テストケース毎にかかった時間、メモリ使用量など)取得しない、全体の結果のみ取得される
-    BatchSubmission -{ EvaluationStatus -{ Submission の粒度まで取得する
+    ジャッジが完了したバッチ採点エントリと、その授業エントリを取得する
+
+    完了していない場合は403、存在しない場合は404のHTTPExceptionを送出する。
+    学生ごとの結果は、バッチ採点のジャッジが完了したときに集計済み(assignments.aggregate_evaluation_results)。
     """
     batch_submission_record = assignments.get_batch_submission_status(db, batch_id)
     if batch_submission_record is None:
@@ -109,71 +103,136 @@ async def read_batch_submission_summary(
             detail="バッチ採点が完了していません",
         )
     
-    batch_submission_detail = assignments.get_batch_submission_detail(db, batch_id)
-    if batch_submission_detail is None:
+    lecture_record = assignments.get_lecture(db, batch_submission_record.lecture_id)
+    if lecture_record is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="バッチ採点エントリが見つかりません",
+            detail="授業エントリが見つかりません",
         )
+    # 授業エントリは全ての学生の採点結果で共有する(responseのモデルへの変換は1回だけ行う)
+    return batch_submission_record, response.Lecture.model_validate(lecture_record)
+
+
+@router.get("/batch/id/{batch_id}", response_model=response.BatchSubmissionDetailItem)
+async def read_batch_submission_summary(
+    batch_id: int,
+    request: Request,
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["batch"]),
+    ],
+    page: Optional[int] = Query(default=None, ge=1, description="学生の採点結果のページ(指定しない場合は全ての学生の採点結果を返す)"),
+    page_size: int = Query(default=50, ge=1, le=500, description="1ページあたりの学生の数"),
+    sort_by: EvaluationStatusSortKey = Query(default="user_id", description="ソートするカラムを指定する(resultは結果の重大度順)"),
+    sort_order: Literal["asc", "desc"] = Query(default="asc", description="ソート順を指定する"),
+    status_filter: Optional[StudentSubmissionStatusFilter] = Query(default=None, alias="status", description="提出状況の条件"),
+    result: Optional[SubmissionResultFilter] = Query(default=None, description="採点結果の条件"),
+    user: Optional[str] = Query(default=None, description="user_idまたはusernameの部分一致検索"),
+) -> response.BatchSubmissionDetailItem:
+    """
+    特定のバッチ採点のジャッジ結果を取得する
     
-    # 完了していて、かつEvaluationStatusのresultが更新されていない場合は、更新する
-    if len(batch_submission_detail.evaluation_statuses) > 0 and batch_submission_detail.evaluation_statuses[0].result is None:
-        for evaluation_status in batch_submission_detail.evaluation_statuses:
-            # 全Submissionのresultをaggregationする
-            submission_results = [
-                submission.result for submission in evaluation_status.submissions
-            ]
-            
-            if len(submission_results) == 0:
-                # 課題が未提出の場合は、"None"とする
-                evaluation_status.result = None
-                assignments.update_evaluation_status(db, evaluation_status)
-                continue
-            
-            aggregation_result = schemas.SubmissionSummaryStatus.AC
-            for submission_result in submission_results:
-                aggregation_result = max(aggregation_result, submission_result)
-            
-            evaluation_status.result = aggregation_result
-            
-            assignments.update_evaluation_status(db, evaluation_status)
-    users_map = {user.user_id: user.username for user in users.get_users(db=db, user_id=None, roles=None)}
-    lecture_map = {
-        lecture.id: response.Lecture.model_validate(lecture)
-        for lecture in assignments.get_lecture_list(db=db)
-    }
-    detail_item_data = response.BatchSubmissionDetailItem(
-        id=batch_submission_detail.id,
-        ts=batch_submission_detail.ts,
-        user_id=batch_submission_detail.user_id,
-        username=users_map.get(batch_submission_detail.user_id),
-        lecture_id=batch_submission_detail.lecture_id,
-        lecture=lecture_map.get(batch_submission_detail.lecture_id),
-        message=batch_submission_detail.message,
-        complete_judge=batch_submission_detail.complete_judge,
-        total_judge=batch_submission_detail.total_judge,
-        evaluation_statuses=[
-            response.EvaluationStatus(
-                id=es.id,
-                batch_id=es.batch_id,
-                user_id=es.user_id,
-                username=users_map.get(es.user_id),
-                lecture_id=batch_submission_detail.lecture_id,
-                lecture=lecture_map.get(batch_submission_detail.lecture_id),
-                status=es.status,
-                result=es.result,
-                upload_file_exists=es.upload_dir is not None,
-                report_exists=es.report_path is not None,
-                submit_date=es.submit_date,
-                submissions=es.submissions
-            )
-            for es in batch_submission_detail.evaluation_statuses
-        ]
+    詳細は(テストケース毎にかかった時間、メモリ使用量など)取得しない、全体の結果のみ取得される
+    BatchSubmission -{ EvaluationStatus -{ Submission の粒度まで取得する
+    pageを指定した場合は、条件に一致する学生の採点結果のうち、そのページの学生の分だけを返す
+    """
+    batch_submission_record, lecture = get_completed_batch_submission(db, batch_id)
+
+    evaluation_statuses, total_count = assignments.get_evaluation_status_page(
+        db=db,
+        batch_id=batch_id,
+        lecture=lecture,
+        limit=page_size if page is not None else None,
+        offset=(page - 1) * page_size if page is not None else 0,
+        sort_by=sort_by,
+        sort_order=sort_order,
+        status=status_filter,
+        result=result,
+        user=user,
     )
+    owner = users.get_user(db, batch_submission_record.user_id)
+    detail_item = mapping.batch_submission_detail_item(
+        batch_submission_record,
+        username=owner.username if owner is not None else "不明",
+        lecture=lecture,
+        evaluation_statuses=evaluation_statuses,
+        total_items=total_count,
+        current_page=page,
+        page_size=page_size if page is not None else None,
+    )
+
+    # 完了したバッチ採点の結果は再採点されない限り変わらないので、内容のハッシュ値をETagとして返す
+    return conditional_json_response(request, detail_item, CACHE_CONTROL_REVALIDATE)
+
+
+@router.get("/batch/id/{batch_id}/export", response_class=StreamingResponse)
+async def export_batch_submission_summary(
+    batch_id: int,
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["batch"]),
+    ],
+    sort_by: EvaluationStatusSortKey = Query(default="user_id", description="ソートするカラムを指定する(resultは結果の重大度順)"),
+    sort_order: Literal["asc", "desc"] = Query(default="asc", description="ソート順を指定する"),
+    status_filter: Optional[StudentSubmissionStatusFilter] = Query(default=None, alias="status", description="提出状況の条件"),
+    result: Optional[SubmissionResultFilter] = Query(default=None, description="採点結果の条件"),
+    user: Optional[str] = Query(default=None, description="user_idまたはusernameの部分一致検索"),
+) -> StreamingResponse:
+    """
+    特定のバッチ採点のジャッジ結果を、NDJSON(1行に1つのJSON)で全て出力する
     
-    detail_item = response.BatchSubmissionDetailItem.model_validate(detail_item_data)
+    1行目はバッチ採点エントリ(evaluation_statusesは空)、2行目以降は学生ごとの採点結果
+    (lectureは1行目と同じなので含めない)。
+    学生の採点結果はBATCH_EXPORT_CHUNK_SIZE人ずつ読み込み、読み込んだ分から送信する。
+    """
+    batch_submission_record, lecture = get_completed_batch_submission(db, batch_id)
+    owner = users.get_user(db, batch_submission_record.user_id)
+    header = mapping.batch_submission_detail_item(
+        batch_submission_record,
+        username=owner.username if owner is not None else "不明",
+        lecture=lecture,
+        evaluation_statuses=[],
+        total_items=assignments.count_evaluation_statuses(
+            db, batch_id, status=status_filter, result=result, user=user
+        ),
+    )
 
-    return detail_item
+    def generate_lines():
+        # レスポンスの送信中はリクエストのDBセッションが閉じられているため、独自にDBセッションを作成する
+        export_db = SessionLocal()
+        try:
+            yield header.model_dump_json().encode() + b"\n"
+            offset = 0
+            while True:
+                evaluation_statuses, _ = assignments.get_evaluation_status_page(
+                    db=export_db,
+                    batch_id=batch_id,
+                    lecture=lecture,
+                    limit=constant.BATCH_EXPORT_CHUNK_SIZE,
+                    offset=offset,
+                    sort_by=sort_by,
+                    sort_order=sort_order,
+                    status=status_filter,
+                    result=result,
+                    user=user,
+                )
+                if len(evaluation_statuses) == 0:
+                    break
+                yield b"".join(
+                    evaluation_status.model_dump_json(exclude={"lecture"}).encode() + b"\n"
+                    for evaluation_status in evaluation_statuses
+                )
+                offset += len(evaluation_statuses)
+        finally:
+            export_db.close()
+
+    return StreamingResponse(
+        generate_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="batch_{batch_id}.ndjson"'},
+    )
 
 
 @router.get("/batch/id/{batch_id}/user/{user_id}", response_model=response.EvaluationStatus)
@@ -207,24 +266,27 @@ async def read_evaluation_status_for_batch_user(
     # バッチ提出から講義情報を取得
     batch_submission = assignments.get_batch_submission_status(db, batch_id)
     lecture_id = batch_submission.lecture_id if batch_submission else None
-    lecture = assignments.get_lecture(db, lecture_id) if lecture_id else None
-    
-    # dictとして必要な情報を追加
-    evaluation_status_dict = {
-        **evaluation_status_detail.dict(),
-        "username": username,
-        "lecture_id": lecture_id,
-        "lecture": lecture
-    }
+    lecture_record = assignments.get_lecture(db, lecture_id) if lecture_id else None
+    if lecture_record is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="授業エントリが見つかりません",
+        )
     
-    ret = response.EvaluationStatus.model_validate(evaluation_status_dict)
-    ret.upload_file_exists = evaluation_status_detail.upload_dir is not None
-    ret.report_exists = evaluation_status_detail.report_path is not None
-
-    return ret
+    evaluation_status_item = mapping.evaluation_status(
+        evaluation_status_detail,
+        username=username,
+        lecture=response.Lecture.model_validate(lecture_record),
+        submissions=[
+            mapping.submission(submission, judge_results=submission.judge_results)
+            for submission in evaluation_status_detail.submissions
+        ],
+    )
+    # response_modelによる検証と変換を行わず、組み立て済みのモデルをそのままJSONに変換する
+    return FastJSONResponse(jsonable(evaluation_status_item))
 
 
-@router.get("/batch/{batch_id}/files/uploaded/{user_id}", response_class=FileResponse)
+@router.get("/batch/{batch_id}/files/uploaded/{user_id}", response_class=StreamingResponse)
 async def fetch_uploaded_files_of_evaluation_status(
     batch_id: int,
     user_id: str,
@@ -233,7 +295,7 @@ async def fetch_uploaded_files_of_evaluation_status(
         schemas.UserRecord,
         Security(authenticate_util.get_current_active_user, scopes=["batch"]),
     ],
-) -> FileResponse:
+) -> StreamingResponse:
     """
     特定のバッチ採点のアップロードされたファイルを取得する
     """
@@ -261,18 +323,12 @@ async def fetch_uploaded_files_of_evaluation_status(
         
     upload_dir_path = Path(constant.UPLOAD_DIR) / upload_dir
     
-    temp_dir = tempfile.TemporaryDirectory()
-    temp_dir_path = Path(temp_dir.name)
-    
-    # upload_dirのファイルの内容をtemp_dirに置いたZIPファイルに書き込む
-    zip_file_path = temp_dir_path / f"uploaded_files.zip"
-    with zipfile.ZipFile(zip_file_path, "w") as zipf:
-        for file_path in upload_dir_path.rglob("*"):
-            if file_path.is_file():
-                arcname = file_path.relative_to(upload_dir_path)
-                zipf.write(file_path, arcname=arcname)
-    
-    return FileResponse(zip_file_path, filename="uploaded_files.zip", media_type="application/zip", background=BackgroundTask(delete_temp_dir, temp_dir))
+    # upload_dirのファイルの内容をZIPファイルにして送る
+    files = [
+        (file_path, str(file_path.relative_to(upload_dir_path)))
+        for file_path in upload_dir_path.rglob("*") if file_path.is_file()
+    ]
+    return zip_streaming_response(files, filename="uploaded_files.zip")
 
 
 @router.get("/batch/{batch_id}/files/report/{user_id}", response_class=FileResponse)
@@ -1,8 +1,9 @@
 from app.crud.db import assignments, users
-from fastapi import APIRouter, Depends, Query, Security, HTTPException, status
-from fastapi.responses import FileResponse
-from starlette.background import BackgroundTask
-from app.classes import schemas, response
+from fastapi import APIRouter, Depends, Query, Request, Response, Security, HTTPException, status
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.classes import schemas, response, mapping
+from app.responses import FastJSONResponse
 import logging
 from typing import Annotated, List, Literal, Optional
 from sqlalchemy.orm import Session
@@ -10,8 +11,8 @@ from app.dependencies import get_db
 from app.api.api_v1.endpoints import authenticate_util
 from pathlib import Path
 from app import constants as constant
-import tempfile
-import zipfile
+from app.api.api_v1.endpoints.metrics import compute_judge_queue_status
+from .util import zip_streaming_response, get_arranged_files_bundle, is_not_modified, http_date
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -22,9 +23,6 @@ router = APIRouter()
 /api/v1/assignments/status/...以下のエンドポイントの定義
 """
 
-def delete_temp_dir(temp_dir: tempfile.TemporaryDirectory):
-    temp_dir.cleanup()
-
 @router.get("/submissions/view", response_model=List[response.Submission])
 async def read_all_submission_status_of_me(
     page: int,
@@ -65,7 +63,7 @@ async def read_all_submission_status_of_me(
                 detail="管理者のみが全てのユーザの提出の進捗状況を取得できます",
             )
 
-    submission_record_list = assignments.get_submission_list(
+    submission_list = assignments.get_submission_list(
         db=db,
         limit=10,
         offset=(page - 1) * 10,
@@ -80,14 +78,38 @@ async def read_all_submission_status_of_me(
         result=result,
     )
 
-    return [
-        response.Submission.model_validate(
-            submission_record.model_dump(
-                exclude={"problem", "judge_results"}
+    # response_modelによる検証と変換を行わず、組み立て済みの提出エントリをそのままJSONに変換する
+    return FastJSONResponse(mapping.submission_list_adapter.dump_python(submission_list, mode="json"))
+
+
+@router.get("/queue", response_model=response.JudgeQueueStatus)
+async def read_judge_queue_status(
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["me"]),
+    ],
+    submission_id: Optional[int] = Query(default=None, description="ジャッジ開始までの推定時間を取得する提出ID"),
+) -> response.JudgeQueueStatus:
+    """
+    ジャッジキューの混雑状況と、キューを処理し終えるまでの推定時間を取得する
+
+    submission_idには、Admin, Manager以外はログインユーザの提出のみ指定できる。
+    """
+    if submission_id is not None:
+        submission_record = assignments.get_submission(db, submission_id)
+        if submission_record is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="提出エントリが見つかりません",
+            )
+        if current_user.role not in [schemas.Role.admin, schemas.Role.manager] and submission_record.user_id != current_user.user_id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="ログインユーザの提出ではありません",
             )
-        )
-        for submission_record in submission_record_list
-    ]
+
+    return compute_judge_queue_status(db, submission_id=submission_id)
 
 
 @router.get("/submissions/id/{submission_id}", response_model=response.Submission)
@@ -134,16 +156,17 @@ async def read_submission_status(
     return response.Submission.model_validate(submission_record)
 
 
-@router.get("/submissions/id/{submission_id}/files/zip", response_class=FileResponse)
+@router.get("/submissions/id/{submission_id}/files/zip", response_class=StreamingResponse)
 async def read_uploaded_file_list(
     submission_id: int,
     type: Literal["uploaded", "arranged"],
+    request: Request,
     db: Annotated[Session, Depends(get_db)],
     current_user: Annotated[
         schemas.UserRecord,
         Security(authenticate_util.get_current_active_user, scopes=["me"]),
     ],
-) -> FileResponse:
+) -> StreamingResponse:
     """
     特定の提出のファイルのアップロードされたファイルをZIPファイルとして取得する
     """
@@ -177,27 +200,30 @@ async def read_uploaded_file_list(
             )
 
     if type == "uploaded":
-        temp_dir = tempfile.TemporaryDirectory()
-        temp_dir_path = Path(temp_dir.name)
-        zip_file_path = temp_dir_path / "uploaded_files.zip"
         upload_dir = Path(constant.UPLOAD_DIR) / submission_record.upload_dir
         # upload_dirの中身まるごとzipファイルにする
-        with zipfile.ZipFile(zip_file_path, "w") as zipf:
-            for file in upload_dir.glob("**/*"):
-                if file.is_file():
-                    zipf.write(file, arcname=file.relative_to(upload_dir))
-        return FileResponse(zip_file_path, filename="uploaded_files.zip", media_type="application/zip", background=BackgroundTask(delete_temp_dir, temp_dir))
+        files = [
+            (file, str(file.relative_to(upload_dir)))
+            for file in upload_dir.glob("**/*") if file.is_file()
+        ]
+        return zip_streaming_response(files, filename="uploaded_files.zip")
     elif type == "arranged":
         # arranged_filesのファイル全てをzipファイルにする
-        temp_dir = tempfile.TemporaryDirectory()
-        temp_dir_path = Path(temp_dir.name)
-        zip_file_path = temp_dir_path / "arranged_files.zip"
+        # 課題データが更新されるまで内容は変わらないので、一度作ったZIPファイルを使い回す
         file_list = assignments.get_arranged_files(db=db, lecture_id=submission_record.lecture_id, assignment_id=submission_record.assignment_id, eval=submission_record.eval)
-        with zipfile.ZipFile(zip_file_path, "w") as zipf:
-            for file in file_list:
-                file_path = Path(constant.RESOURCE_DIR) / file.path
-                zipf.write(file_path, arcname=file_path.name)
-        return FileResponse(zip_file_path, filename="arranged_files.zip", media_type="application/zip", background=BackgroundTask(delete_temp_dir, temp_dir))
+        bundle_path, digest = await run_in_threadpool(
+            get_arranged_files_bundle,
+            submission_record.lecture_id,
+            submission_record.assignment_id,
+            submission_record.eval,
+            file_list,
+        )
+        etag = f'"{digest}"'
+        last_modified = bundle_path.stat().st_mtime
+        headers = {"ETag": etag, "Last-Modified": http_date(last_modified), "Cache-Control": "private, no-cache"}
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return FileResponse(bundle_path, filename="arranged_files.zip", media_type="application/zip", headers=headers)
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -257,7 +283,8 @@ async def read_all_batch_status(
             "lecture_title": lecture_map.get(record.lecture_id, "不明"),
             "message": record.message,
             "complete_judge": record.complete_judge,
-            "total_judge": record.total_judge
+            "total_judge": record.total_judge,
+            "phase": record.phase,
         })
         batch_submission_items.append(item)
     
@@ -1,7 +1,24 @@
 from app.classes import schemas
 from app.api.api_v1.endpoints import authenticate_util
-from fastapi import HTTPException, status
+from app.crud.db import assignments
+from app import constants as constant
+from app.ratelimit import get_rate_limit_store
+from app import blobstore
+from app.resource_cache import resource_digest_cache
+from app.extract import unfold_zip
+from fastapi import HTTPException, Request, status, UploadFile
+from fastapi.responses import Response, StreamingResponse
+from app.responses import FastJSONResponse, jsonable
+from email.utils import formatdate, parsedate_to_datetime
+import os
+import uuid
+from typing import Any, Iterable, Iterator
+import time
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
 from pathlib import Path
+import hashlib
+import math
 import zipfile
 import shutil
 
@@ -36,76 +53,374 @@ def access_sanitize(
             )
 
 
-def get_zip_file_size(path: Path) -> int:
+def judge_admission_control(
+    db: Session,
+    user: schemas.UserRecord,
+    num_submissions: int = 1,  # このリクエストで登録される提出エントリの数
+) -> None:
     """
-    zipファイルの容量をMB単位で返す
+    ジャッジリクエストの流量制限を行う
+    
+    ユーザごと・ロールごとのトークンバケットと、ユーザごとの未完了の提出数の上限をチェックし、
+    超えている場合はRetry-After付きの429エラーを返す。
+    アップロードされたファイルを書き込む前に呼び出すこと。
     """
-    with zipfile.ZipFile(path, "r") as zip_ref:
-        return sum([zinfo.file_size for zinfo in zip_ref.filelist]) / 1024 / 1024 # MB
+    role = user.role.value
+    # 未完了の提出数の上限を先に確認する(上限で拒否したリクエストでトークンを消費しないようにする)
+    max_inflight = constant.JUDGE_MAX_INFLIGHT_SUBMISSIONS[role]
+    if assignments.count_inflight_submissions(db, user.user_id) + num_submissions > max_inflight:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"ジャッジ待ちの提出が多すぎます(上限: {max_inflight}件)。ジャッジが終わってから再度提出してください",
+            headers={"Retry-After": "10"},
+        )
+
+    user_capacity, user_refill_rate = constant.JUDGE_USER_RATE_LIMITS[role]
+    role_capacity, role_refill_rate = constant.JUDGE_ROLE_RATE_LIMITS[role]
+    retry_after = get_rate_limit_store().consume([
+        (f"judge:user:{user.user_id}", user_capacity, user_refill_rate, 1),
+        (f"judge:role:{role}", role_capacity, role_refill_rate, 1),
+    ])
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="ジャッジリクエストが多すぎます。しばらく待ってから再度提出してください",
+            headers={"Retry-After": str(min(math.ceil(retry_after), 3600))},
+        )
 
 
-def unfold_zip(uploaded_zip_file: Path, dest_dir: Path) -> str | None:
+def get_resource_file_digest(path: Path) -> str:
     """
-    uploaded_zip_fileが以下の条件を満たすかチェックしながら、dest_dirにファイルを配置していく。
-    * 拡張子がzipであること
-    * 展開後、以下のパターンしか想定しない
-        * フォルダが存在しないパターン(zipファイルに直接ファイルを配置していたケース)
-        * フォルダが一個しかないパターン(zipファイルにフォルダごと配置していたケース)
-        * フォルダが2個以上あるが、zipファイルの名前と同じ名前のフォルダが存在するパターン
-          (__MACOSXなどのメタ情報フォルダも含めてzipファイルに配置していたケース)
-        
-    何も問題が無ければNoneを返し、問題があればエラーメッセージを返す。
+    課題リソースファイルの内容のsha256ハッシュ値を返す(更新時刻とサイズが同じ間はキャッシュする)
     """
-    # zip提出の場合
-    if not uploaded_zip_file.name.endswith(".zip"):
-        return "zipファイルを提出してください。",
+    return resource_digest_cache.digest(path)
 
-    # zipファイルの容量が30MBを超える場合はエラー
-    if get_zip_file_size(uploaded_zip_file) > 30:
-        return "zipファイルの展開後の容量が30MBを超えています。"
 
-    # 展開する
-    try:
-        with zipfile.ZipFile(uploaded_zip_file, "r") as zip_ref:
-            zip_ref.extractall(dest_dir)
-    except Exception as e:
-        return f"zipファイルの展開に失敗しました: {e}"
+def hash_problem_resources(problem: schemas.Problem) -> str:
+    """
+    課題エントリの設定(required_files, executables, テストケースの配点やメッセージを含む)と、
+    テストケースのリソースファイル(stdin, stdout, stderr, arranged_files)の内容からsha256ハッシュ値を計算する
+    
+    problemはdetail=Trueで取得したもの(採点リソースのフィルタリング済み)を渡すこと
+    課題データのバージョンがある場合は、バージョンが課題データの全ファイルの内容を表すので、
+    リソースファイルを読まずにバージョンとテストケースの設定から計算する
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{problem.lecture_id}:{problem.assignment_id}:{problem.timeMS}:{problem.memoryMB}".encode())
+    if problem.version is not None:
+        hasher.update(f":{problem.version}".encode())
     
-    # 空の場合
-    if len(list(dest_dir.iterdir())) == 0:
-        return "提出ファイルが空です。"
+    def update_with_resource(resource_path: str | None) -> None:
+        if resource_path is None:
+            hasher.update(b"-")
+            return
+        if problem.version is not None:
+            hasher.update(resource_path.encode())
+            return
+        file_path = Path(constant.RESOURCE_DIR) / resource_path
+        hasher.update(get_resource_file_digest(file_path).encode() if file_path.exists() else b"?")
     
-    # dest_dir下に1つのフォルダのみがある場合、そのフォルダの中身をdest_dirに移動する
-    # (ex "temp_dir/dir"のみ)
-    if len(list(dest_dir.iterdir())) == 1 and list(dest_dir.iterdir())[0].is_dir():
-        folded_dir = list(dest_dir.iterdir())[0]
+    for test_case in sorted(problem.test_cases, key=lambda test_case: test_case.id):
+        hasher.update(
+            test_case.model_dump_json(
+                include={"eval", "type", "score", "title", "message_on_fail", "command", "args", "exit_code"}
+            ).encode()
+        )
+        update_with_resource(test_case.stdin_path)
+        update_with_resource(test_case.stdout_path)
+        update_with_resource(test_case.stderr_path)
+    
+    for required_file in sorted(problem.required_files, key=lambda required_file: required_file.name):
+        hasher.update(f"required:{required_file.name}".encode())
+    
+    for executable in sorted(problem.executables, key=lambda executable: (executable.name, executable.eval)):
+        hasher.update(f"executable:{executable.name}:{executable.eval}".encode())
+    
+    for arranged_file in sorted(problem.arranged_files, key=lambda arranged_file: arranged_file.path):
+        hasher.update(Path(arranged_file.path).name.encode())
+        update_with_resource(arranged_file.path)
+    
+    return hasher.hexdigest()
+
+
+def make_judge_cache_key(content_hash: str, problem: schemas.Problem, eval: bool) -> str:
+    """
+    提出ファイルのハッシュ値と課題リソースのハッシュ値から、ジャッジ結果のキャッシュキーを作成する
+    """
+    return hashlib.sha256(
+        f"{content_hash}:{hash_problem_resources(problem)}:{int(eval)}".encode()
+    ).hexdigest()
+
+
+def upload_file_names(file_list: list[UploadFile]) -> list[str]:
+    """
+    アップロードされたファイルの、dest_dirに書き込むときのファイル名のリストを返す
+
+    * filenameがNoneの場合は"unnamed_file_{index}"という名前を付ける
+    * ディレクトリを含むファイル名でdest_dirの外に書き込まれないように、ファイル名の部分のみを使う
+    ファイル名の部分が空・"."・".."になる場合や、同じファイル名が重複する場合(互いに上書きされる)は、
+    何も書き込まずに400エラーを返す。
+    """
+    filenames = []
+    for index, file in enumerate(file_list):
+        filename = Path(file.filename).name if file.filename else f"unnamed_file_{index}"
+        if filename in ("", ".", "..") or "\x00" in filename:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"不正なファイル名です: {file.filename}",
+            )
+        if filename in filenames:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"同じ名前のファイルが複数アップロードされています: {filename}",
+            )
+        filenames.append(filename)
+    return filenames
+
+
+async def save_upload_files(
+    file_list: list[UploadFile],
+    dest_dir: Path,
+    max_file_bytes: int = constant.UPLOAD_MAX_FILE_BYTES,
+    max_total_bytes: int = constant.UPLOAD_MAX_TOTAL_BYTES,
+) -> dict[Path, str]:
+    """
+    アップロードされたファイルを、アップロード用のストアにチャンク単位で書き込み、dest_dirに配置する
+
+    書き込みながらハッシュ値を計算し、ストアの実体へのハードリンクをdest_dirに置くので、
+    ファイルを読み直さずにストアに登録できる。配置したファイルの{パス: ハッシュ値}を返す
+    (store_directoryのdigestsに渡す)。dest_dirはUPLOAD_DIRと同じファイルシステム上に置くこと。
+    読み込みはUploadFile.read、書き込みはスレッドプールで行い、イベントループをブロックしない。
+    ファイル1つあたりのサイズと合計サイズの上限を、書き込みながら確認し、
+    超えた場合は413エラーを返す(配置済みのファイルは呼び出し元でdest_dirごと削除すること)。
+    """
+    filenames = upload_file_names(file_list)
+    digests: dict[Path, str] = {}
+    total_bytes = 0
+    for file, filename in zip(file_list, filenames):
+        writer = await run_in_threadpool(blobstore.upload_store.writer)
+        try:
+            while chunk := await file.read(constant.UPLOAD_CHUNK_BYTES):
+                total_bytes += len(chunk)
+                if writer.size + len(chunk) > max_file_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"{filename}のサイズが上限({max_file_bytes}バイト)を超えています",
+                    )
+                if total_bytes > max_total_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"アップロードされたファイルの合計サイズが上限({max_total_bytes}バイト)を超えています",
+                    )
+                await run_in_threadpool(writer.write, chunk)
+            dest_path = dest_dir / filename
+            digests[dest_path] = await run_in_threadpool(writer.commit, dest_path)
+        finally:
+            await run_in_threadpool(writer.discard)
+            await file.close()
+    return digests
+
+
+# 既に圧縮されている(再圧縮しても小さくならない)ファイルの拡張子
+# ZIPに格納するときは無圧縮(ZIP_STORED)にする
+ALREADY_COMPRESSED_SUFFIXES = {
+    ".pdf", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".xlsx", ".docx", ".pptx",
+}
+
+# ZIPファイルを送る単位(バイト)
+ZIP_STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class _ZipStreamBuffer:
+    """
+    ZipFileの書き込み先。書き込まれたバイト列を溜めておき、drainで取り出す
+
+    seekできないストリームとして振る舞うので、ZipFileはローカルヘッダの後にデータディスクリプタを書く
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def seekable(self) -> bool:
+        return False
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip_stream(files: Iterable[tuple[Path, str]]) -> Iterator[bytes]:
+    """
+    (ファイルのパス, ZIP内でのパス)のリストからZIPファイルを作り、チャンク単位で返す
+
+    一時ファイルを作らず、ファイルを少しずつ読み込んで圧縮しながら返すので、メモリ使用量は一定になる。
+    既に圧縮されているファイル(PDFなど)は無圧縮で格納する。
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for file_path, arcname in files:
+            stat = file_path.stat()
+            zip_info = zipfile.ZipInfo(str(arcname), date_time=time.localtime(stat.st_mtime)[:6])
+            zip_info.compress_type = (
+                zipfile.ZIP_STORED
+                if file_path.suffix.lower() in ALREADY_COMPRESSED_SUFFIXES
+                else zipfile.ZIP_DEFLATED
+            )
+            zip_info.external_attr = (stat.st_mode & 0xFFFF) << 16
+            with open(file_path, "rb") as source_file, zip_file.open(zip_info, "w", force_zip64=stat.st_size > 0x7FFFFFFF) as dest_file:
+                while chunk := source_file.read(ZIP_STREAM_CHUNK_BYTES):
+                    dest_file.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    # セントラルディレクトリを送る
+    yield buffer.drain()
+
+
+def zip_streaming_response(files: Iterable[tuple[Path, str]], filename: str) -> StreamingResponse:
+    """
+    iter_zip_streamで作ったZIPファイルを、ダウンロード用のレスポンスとして返す
+    """
+    return StreamingResponse(
+        # 同期ジェネレータなので、starletteがスレッドプールで実行する(イベントループをブロックしない)
+        iter_zip_stream(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def _arranged_files_bundle_dir(lecture_id: int, assignment_id: int) -> Path:
+    return Path(constant.CACHE_DIR) / "arranged" / f"lec-{lecture_id}" / f"problem-{assignment_id}"
+
+
+def get_arranged_files_bundle(
+    lecture_id: int, assignment_id: int, eval: bool, arranged_files: list[schemas.ArrangedFiles]
+) -> tuple[Path, str]:
+    """
+    課題のarranged_filesをまとめたZIPファイル(バンドル)のパスと、そのハッシュ値を返す
+
+    バンドルは(lecture_id, assignment_id, eval, ファイル名と内容のハッシュ値)ごとに一度だけ作り、
+    CACHE_DIRに保存して使い回す。課題データが更新されるとハッシュ値が変わるため、古いバンドルが返ることはない。
+    """
+    hasher = hashlib.sha256()
+    files = []
+    for arranged_file in sorted(arranged_files, key=lambda arranged_file: arranged_file.path):
+        file_path = Path(constant.RESOURCE_DIR) / arranged_file.path
+        hasher.update(file_path.name.encode())
+        hasher.update(b"\0")
+        hasher.update(get_resource_file_digest(file_path).encode())
+        hasher.update(b"\0")
+        files.append((file_path, file_path.name))
+    digest = hasher.hexdigest()
+
+    bundle_dir = _arranged_files_bundle_dir(lecture_id, assignment_id) / ("eval" if eval else "public")
+    bundle_path = bundle_dir / f"{digest}.zip"
+    if not bundle_path.exists():
+        bundle_dir.mkdir(parents=True, exist_ok=True)
+        # 書き込み途中のファイルが返らないように、一時ファイルに書き込んでから置き換える
+        temporary_path = bundle_dir / f".{digest}-{uuid.uuid4().hex}.tmp"
         try:
-            for file in folded_dir.iterdir():
-                shutil.move(file, dest_dir)
-        except Exception as e:
-            return f"zipファイル名と同じ名前のフォルダがあるため、展開時にエラーが発生しました。"
-        
-        # folded_dirを削除する
-        if len(list(folded_dir.iterdir())) > 0:
-            return "フォルダの展開に失敗しました。"
-        shutil.rmtree(folded_dir)
-    elif (
-        len(list(dest_dir.iterdir())) > 1
-        and (dest_dir / uploaded_zip_file.stem).exists()
-        and (dest_dir / uploaded_zip_file.stem).is_dir()
-    ):
-        # フォルダが2個以上あるが、zipファイルの名前と同じ名前のフォルダが存在する場合
-        # zipファイルの名前と同じフォルダをdest_dirに移動
+            with open(temporary_path, "wb") as f:
+                for chunk in iter_zip_stream(files):
+                    f.write(chunk)
+            os.replace(temporary_path, bundle_path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+    return bundle_path, digest
+
+
+def invalidate_arranged_files_bundles(lecture_id: int, assignment_id: int) -> None:
+    """
+    課題のarranged_filesのバンドルを全て削除する(課題データの更新時、削除時に呼ぶ)
+    """
+    shutil.rmtree(_arranged_files_bundle_dir(lecture_id, assignment_id), ignore_errors=True)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: float | None = None) -> bool:
+    """
+    条件付きリクエスト(If-None-Match, If-Modified-Since)に対して、304 Not Modifiedを返せるかどうかを判定する
+
+    If-None-Matchがある場合はそれだけで判定する(RFC 9110)。
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # 弱いETag(W/"...")も同じものとして扱う
+        return "*" in tags or etag in [tag.removeprefix("W/") for tag in tags]
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and last_modified is not None:
         try:
-            for file in (dest_dir / uploaded_zip_file.stem).iterdir():
-                shutil.move(file, dest_dir)
-        except Exception as e:
-            return f"zipファイルの名前と同じ名前のフォルダがあるため、展開時にエラーが発生しました。"
-        shutil.rmtree((dest_dir / uploaded_zip_file.stem))
-    
-    # 'makefile', 'GNUMakefile'を見つけたら、'Makefile'にリネームする
-    for file in dest_dir.iterdir():
-        if file.is_file() and file.name in ['makefile', 'GNUMakefile']:
-            file.rename(dest_dir / 'Makefile')
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def http_date(timestamp: float) -> str:
+    """
+    UNIX時刻をHTTPの日付形式(Last-Modifiedなど)に変換する
+    """
+    return formatdate(timestamp, usegmt=True)
 
-    return None
+
+# 読み取りが中心のAPIのCache-Controlヘッダ
+# ログインユーザの権限によって内容が変わるため、共有キャッシュ(ゲートウェイなど)には保存させない
+# 毎回ETagで検証させる(内容が変わったらすぐに反映させたいもの)
+CACHE_CONTROL_REVALIDATE = "private, no-cache"
+# 授業エントリ: 一定時間はサーバに問い合わせずに使い回させる
+CACHE_CONTROL_CATALOG = (
+    f"private, max-age={constant.HTTP_CATALOG_MAX_AGE_SECONDS}"
+    if constant.HTTP_CATALOG_MAX_AGE_SECONDS > 0 else CACHE_CONTROL_REVALIDATE
+)
+# 課題データのテンプレート
+CACHE_CONTROL_TEMPLATE = f"private, max-age={constant.HTTP_TEMPLATE_MAX_AGE_SECONDS}"
+
+
+def make_etag(*parts: object) -> str:
+    """
+    行のバージョンなど、内容を決める値の並びから強いETagを作る
+    """
+    return '"' + hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest() + '"'
+
+
+def conditional_json_response(
+    request: Request, content: Any, cache_control: str, etag: str | None = None
+) -> Response:
+    """
+    contentをJSONで返すレスポンスを作る。If-None-MatchがETagと一致する場合は304 Not Modifiedを返す
+
+    etagを指定しない場合は、JSONの内容のハッシュ値をETagとする(転送量のみ削減できる)。
+    行のバージョンなどからetagを指定した場合は、一致したときにcontentをJSONに変換しない。
+    response_modelによる変換は行われないので、contentはレスポンスのモデルに変換済みのものを渡すこと。
+    """
+    headers = {"Cache-Control": cache_control}
+    json_response = None
+    if etag is None:
+        json_response = FastJSONResponse(jsonable(content))
+        etag = f'"{hashlib.sha256(json_response.body).hexdigest()}"'
+    headers["ETag"] = etag
+    if is_not_modified(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if json_response is None:
+        json_response = FastJSONResponse(jsonable(content))
+    json_response.headers.update(headers)
+    return json_response
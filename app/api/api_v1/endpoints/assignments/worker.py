@@ -0,0 +1,60 @@
+from app.crud.db import assignments
+from fastapi import APIRouter, Depends, Security, HTTPException, status
+from app.classes import schemas, response
+import logging
+from typing import Annotated
+from sqlalchemy.orm import Session
+from app.dependencies import get_db
+from app.api.api_v1.endpoints import authenticate_util
+
+
+logging.basicConfig(level=logging.DEBUG)
+
+router = APIRouter()
+
+"""
+/api/v1/assignments/worker/...以下のエンドポイントの定義
+
+ジャッジワーカーがジャッジの進捗状況と結果を書き込むためのエンドポイント
+"""
+
+
+@router.post("/ingest", response_model=response.Message)
+async def ingest_judge_results(
+    batch: schemas.JudgeIngestBatch,
+    db: Annotated[Session, Depends(get_db)],
+    current_user: Annotated[
+        schemas.UserRecord,
+        Security(authenticate_util.get_current_active_user, scopes=["batch"]),
+    ],
+) -> response.Message:
+    """
+    テストケースの実行結果と提出エントリの進捗状況の更新をまとめて書き込む
+
+    1つ以上の提出に対する複数のテストケースの実行結果を受け取り、1つのトランザクションで書き込む。
+    テストケースごとにコミットする必要がないため、ジャッジワーカーは結果を溜めてから送ることができる。
+
+    submissionsには、結果を書き込む提出ごとに、キューから取り出したときのclaim_tokenを含める。
+    running状態でない提出や、claim_tokenが一致しない提出(積み直された後に別のワーカーが取り出した提出など)に
+    対する結果は書き込まず、skipped_submissionsとして返す。
+    """
+    submission_ids = list(
+        {judge_result.submission_id for judge_result in batch.judge_results}
+        | {progress_update.submission_id for progress_update in batch.submissions}
+    )
+    missing_ids = set(submission_ids) - assignments.get_existing_submission_ids(db, submission_ids)
+    if len(missing_ids) > 0:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"提出エントリが見つかりません: {sorted(missing_ids)}",
+        )
+
+    inserted, updated, skipped = assignments.ingest_judge_batch(db, batch)
+    if len(skipped) > 0:
+        logging.warning(f"Skipped judge results from a stale claim (submission_ids: {skipped})")
+    return response.Message(
+        message="ジャッジ結果を書き込みました",
+        inserted_judge_results=inserted,
+        updated_submissions=updated,
+        skipped_submissions=skipped,
+    )
@@ -0,0 +1,188 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.orm import Session
+from app.crud.db import assignments
+from app.classes import schemas, response
+from app.dependencies import get_db
+from app import constants
+from typing import Annotated
+from datetime import timedelta
+import hmac
+import time
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+router = APIRouter()
+
+"""
+/api/v1/metrics 以下のエンドポイントの定義
+
+ジャッジパイプラインのメトリクスをPrometheusのテキスト形式で返す。
+値は全てDBから集計するので、複数のuvicorn workerのどれが応答しても同じ値になる。
+ユーザのJWTではなく、Prometheus用の固定のトークン(METRICS_TOKEN)で認証する。
+"""
+
+# 提出からジャッジ開始までの待ち時間のヒストグラムのバケット(秒)
+QUEUE_WAIT_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+# ジャッジ開始から完了までのジャッジ時間のヒストグラムのバケット(秒)
+JUDGE_DURATION_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60, 120, 300]
+# スループットを計算する時間窓(秒)
+THROUGHPUT_WINDOW_SECONDS = 300
+# 集計結果を使い回す時間(秒)、スクレイプが集中してもDBへのクエリが増えないようにする
+METRICS_CACHE_SECONDS = 5.0
+
+_metrics_cache: tuple[float, str] | None = None
+
+_metrics_bearer = HTTPBearer(auto_error=False)
+
+
+def verify_metrics_token(
+    credentials: Annotated[HTTPAuthorizationCredentials | None, Depends(_metrics_bearer)],
+) -> None:
+    """
+    Authorizationヘッダのトークンが、METRICS_TOKENと一致するかを確認する
+
+    METRICS_TOKENが設定されていない場合は、エンドポイントが存在しないものとして404を返す
+    """
+    if not constants.METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if credentials is None or not hmac.compare_digest(
+        credentials.credentials.encode(), constants.METRICS_TOKEN.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="メトリクスを取得する権限がありません",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+def compute_judge_queue_status(db: Session, submission_id: int | None = None) -> response.JudgeQueueStatus:
+    """
+    ジャッジキューの混雑状況(スループット、キューを処理し終えるまでの推定時間など)を計算する
+    """
+    counts = assignments.get_submission_progress_counts(db)
+    queued = sum(count for progress, _, count in counts if progress == schemas.SubmissionProgressStatus.QUEUED.value)
+    running = sum(count for progress, _, count in counts if progress == schemas.SubmissionProgressStatus.RUNNING.value)
+
+    now = assignments.get_db_current_time(db)
+    finished = assignments.count_submissions_finished_since(db, now - timedelta(seconds=THROUGHPUT_WINDOW_SECONDS))
+    throughput = finished / THROUGHPUT_WINDOW_SECONDS
+
+    oldest_queued_ts = assignments.get_oldest_queued_ts(db)
+    oldest_queued_seconds = max(0.0, (now - oldest_queued_ts).total_seconds()) if oldest_queued_ts is not None else 0.0
+
+    queue_status = response.JudgeQueueStatus(
+        queued=queued,
+        running=running,
+        throughput_per_second=throughput,
+        oldest_queued_seconds=oldest_queued_seconds,
+        estimated_drain_seconds=(queued + running) / throughput if throughput > 0 else None,
+    )
+
+    if submission_id is not None:
+        queue_status.position = assignments.get_queue_position(db, submission_id)
+        if queue_status.position is not None and throughput > 0:
+            queue_status.estimated_wait_seconds = queue_status.position / throughput
+
+    return queue_status
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _render_histogram(
+    lines: list[str], name: str, help_text: str, buckets: list[float], result: tuple[list[int], float, int]
+) -> None:
+    bucket_counts, total_seconds, count = result
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for bucket, bucket_count in zip(buckets, bucket_counts):
+        lines.append(f'{name}_bucket{{le="{_format_value(float(bucket))}"}} {bucket_count}')
+    lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+    lines.append(f"{name}_sum {_format_value(total_seconds)}")
+    lines.append(f"{name}_count {count}")
+
+
+def render_metrics(db: Session) -> str:
+    """
+    ジャッジパイプラインのメトリクスをPrometheusのテキスト形式で出力する
+    """
+    lines: list[str] = []
+    # ヒストグラムは直近METRICS_HISTOGRAM_WINDOW_SECONDS秒の提出だけを集計する
+    histogram_since = assignments.get_db_current_time(db) - timedelta(
+        seconds=constants.METRICS_HISTOGRAM_WINDOW_SECONDS
+    )
+
+    lines.append("# HELP dsa_submissions Number of unfinished submissions by progress and priority class")
+    lines.append("# TYPE dsa_submissions gauge")
+    counts = {
+        (progress, priority): count
+        for progress, priority, count in assignments.get_submission_progress_counts(db)
+    }
+    for progress in [
+        schemas.SubmissionProgressStatus.PENDING.value,
+        schemas.SubmissionProgressStatus.QUEUED.value,
+        schemas.SubmissionProgressStatus.RUNNING.value,
+    ]:
+        for priority in ["single", "batch", "rejudge"]:
+            lines.append(
+                f'dsa_submissions{{progress="{progress}",priority_class="{priority}"}} {counts.get((progress, priority), 0)}'
+            )
+
+    _render_histogram(
+        lines,
+        "dsa_judge_queue_wait_seconds",
+        f"Time from submission (ts) to judge start (started_at), judges started in the last {constants.METRICS_HISTOGRAM_WINDOW_SECONDS} seconds",
+        QUEUE_WAIT_BUCKETS,
+        assignments.get_queue_wait_histogram(db, QUEUE_WAIT_BUCKETS, histogram_since),
+    )
+    _render_histogram(
+        lines,
+        "dsa_judge_duration_seconds",
+        f"Time from judge start (started_at) to completion (finished_at), judges finished in the last {constants.METRICS_HISTOGRAM_WINDOW_SECONDS} seconds",
+        JUDGE_DURATION_BUCKETS,
+        assignments.get_judge_duration_histogram(db, JUDGE_DURATION_BUCKETS, histogram_since),
+    )
+
+    # バックプレッシャーの指標
+    queue_status = compute_judge_queue_status(db)
+    lines.append(f"# HELP dsa_judge_throughput_per_second Judged submissions per second over the last {THROUGHPUT_WINDOW_SECONDS} seconds")
+    lines.append("# TYPE dsa_judge_throughput_per_second gauge")
+    lines.append(f"dsa_judge_throughput_per_second {_format_value(queue_status.throughput_per_second)}")
+    lines.append("# HELP dsa_judge_queue_oldest_seconds Age of the oldest queued submission")
+    lines.append("# TYPE dsa_judge_queue_oldest_seconds gauge")
+    lines.append(f"dsa_judge_queue_oldest_seconds {_format_value(queue_status.oldest_queued_seconds)}")
+    lines.append("# HELP dsa_judge_queue_drain_seconds Estimated time to judge every queued and running submission")
+    lines.append("# TYPE dsa_judge_queue_drain_seconds gauge")
+    lines.append(
+        "dsa_judge_queue_drain_seconds "
+        + _format_value(
+            queue_status.estimated_drain_seconds
+            if queue_status.estimated_drain_seconds is not None
+            else (0.0 if queue_status.queued + queue_status.running == 0 else float("inf"))
+        )
+    )
+
+    return "\n".join(lines) + "\n"
+
+
+@router.get("", response_class=PlainTextResponse)
+async def read_metrics(
+    db: Annotated[Session, Depends(get_db)],
+    _: Annotated[None, Depends(verify_metrics_token)],
+) -> PlainTextResponse:
+    """
+    ジャッジパイプラインのメトリクスを取得する(Prometheusのスクレイプ用)
+
+    METRICS_TOKENをBearerトークンとして送る必要がある(設定されていない場合は404)。
+    """
+    global _metrics_cache
+    now = time.monotonic()
+    if _metrics_cache is None or now - _metrics_cache[0] > METRICS_CACHE_SECONDS:
+        _metrics_cache = (now, render_metrics(db))
+    return PlainTextResponse(_metrics_cache[1], media_type="text/plain; version=0.0.4")
@@ -14,7 +14,7 @@ from ....classes.schemas import UserCreate, UserDelete, UserUpdatePassword
 from typing import List
 import logging
 from pydantic import ValidationError
-import pandas as pd
+from app.userlist import read_user_list_csv, read_user_list_xlsx, write_user_list_xlsx, to_datetime, to_str
 from app.api.api_v1.endpoints import authenticate_util
 from app.classes import schemas, response
 from datetime import timedelta
@@ -96,9 +96,9 @@ async def register_multiple_users(
     ],
 ) -> FileResponse:
     if upload_file.filename.endswith(".csv"):
-        df = pd.read_csv(upload_file.file)
+        header, rows = read_user_list_csv(upload_file.file)
     elif upload_file.filename.endswith(".xlsx"):
-        df = pd.read_excel(upload_file.file)
+        header, rows = read_user_list_xlsx(upload_file.file)
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -114,7 +114,7 @@ async def register_multiple_users(
         "active_start_date",
         "active_end_date",
     ]
-    missing_columns = [col for col in required_columns if col not in df.columns]
+    missing_columns = [col for col in required_columns if col not in header]
     if missing_columns:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -123,16 +123,19 @@ async def register_multiple_users(
 
     error_messages = []
     current_time = authenticate_util.get_current_time()
-    for index, row in df.iterrows():
-        if pd.isna(row["password"]) or row["password"] == "":
+    tokyo = pytz.timezone("Asia/Tokyo")
+    for row in rows:
+        if row["password"] is None or row["password"] == "":
             generated_password = authenticate_util.generate_password()
-            df.at[index, "password"] = generated_password
+            row["password"] = generated_password
         else:
-            generated_password = row["password"]
+            generated_password = str(row["password"])
 
         try:
+            active_start_date = to_datetime(row["active_start_date"])
+            active_end_date = to_datetime(row["active_end_date"])
             user_data = schemas.UserRecord(
-                user_id=str(row["user_id"]),
+                user_id=to_str(row["user_id"]),
                 username=row["username"],
                 email=row["email"],
                 hashed_password=authenticate_util.get_password_hash(generated_password),
@@ -141,13 +144,13 @@ async def register_multiple_users(
                 created_at=current_time,
                 updated_at=current_time,
                 active_start_date=(
-                    pd.to_datetime(row["active_start_date"]).tz_localize("Asia/Tokyo")
-                    if pd.notna(row["active_start_date"])
+                    tokyo.localize(active_start_date)
+                    if active_start_date is not None
                     else current_time
                 ),
                 active_end_date=(
-                    pd.to_datetime(row["active_end_date"]).tz_localize("Asia/Tokyo")
-                    if pd.notna(row["active_end_date"])
+                    tokyo.localize(active_end_date)
+                    if active_end_date is not None
                     else current_time + timedelta(days=365)
                 ),
             )
@@ -156,12 +159,12 @@ async def register_multiple_users(
         except Exception as e:
             error_messages.append(f"Error creating user {row['user_id']}: {str(e)}")
 
-    # updateしたdfをcsvに出力、{RESOURCE_DIR}/users/{YYYY-MM-DD-HH-MM-SS}.csv
+    # 生成したパスワードを書き込んだ表をxlsxに出力、{RESOURCE_DIR}/users/{YYYY-MM-DD-HH-MM-SS}.xlsx
     # ファイル名は、現在時刻をフォーマットしたものとする
     user_file_dir = Path(constant.UPLOAD_DIR) / "users"
     user_file_dir.mkdir(parents=True, exist_ok=True)
-    file_path = user_file_dir / f"{datetime.now(tz=pytz.timezone('Asia/Tokyo')).strftime('%Y-%m-%d-%H-%M-%S')}.xlsx"
-    df.to_excel(file_path, index=False)
+    file_path = user_file_dir / f"{datetime.now(tz=tokyo).strftime('%Y-%m-%d-%H-%M-%S')}.xlsx"
+    write_user_list_xlsx(file_path, header, rows)
 
     # Return the updated file to the client
     return FileResponse(file_path, filename=file_path.name)
@@ -0,0 +1,370 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from app import constants
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+"""
+ファイルの内容アドレス方式(content-addressed)のストア
+
+同じ課題に対して同じファイル(Makefileや配布されたソースコードなど)が何度も提出され、
+課題データも更新のたびにほとんどのファイルが変わらないため、
+ファイルの実体を内容のsha256ハッシュ値をキーとして一つだけ保持し、各ディレクトリからは
+ハードリンクで参照する。
+
+{ストアのディレクトリ}
+├── objects
+│   └── {digest[:2]}
+│       └── {digest}          ファイルの実体
+├── manifests
+│   └── {digest[:2]}
+│       └── {digest}.json     ディレクトリの構成({相対パス: {"digest": ファイルのハッシュ値, "mode": パーミッション}})
+└── tmp
+    └── {uuid}.tmp            BlobWriterで書き込み中のファイル
+
+* upload_store: 提出されたファイル(UPLOAD_DIRと同じファイルシステム上に置く)
+* resource_store: 課題データのファイル(RESOURCE_DIRと同じファイルシステム上に置く)
+
+ストアを使うディレクトリはハードリンクからなる通常のディレクトリのままなので、
+ジャッジサーバなどディレクトリを読むプログラムは変更不要である。
+ハードリンクされたファイルは他の提出や課題データのバージョンと実体(inode)を共有しているので、
+ストアに登録したファイルは書き込み権限を外した読み込み専用のファイルにする。
+書き換える場合は上書きせずに、新しいファイルで置き換える(削除してから作成する)こと。
+ジャッジサーバをrootで実行する場合はパーミッションでは書き込みを防げないので、
+UPLOAD_DIRとRESOURCE_DIRを読み込み専用でマウントするか、ファイルをコピーしてから使うこと。
+
+どのディレクトリからも参照されなくなった実体は、collect_garbageで削除する
+(アプリケーションの起動中、BLOB_GC_INTERVAL_SECONDSごとに実行する)。
+"""
+
+# BlobWriterの一時ファイルのうち、この秒数より古いものは書き込みが中断されたものとして削除する
+STALE_TEMP_SECONDS = 24 * 60 * 60
+
+
+def compute_file_digest(path: Path) -> str:
+    """
+    ファイル内容のsha256ハッシュ値を返す
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def readonly_mode(mode: int) -> int:
+    """
+    ストアに登録するファイルのパーミッション(書き込み権限を外したもの)を返す
+    """
+    return mode & 0o555
+
+
+def _link_or_copy(src: Path, dest: Path) -> None:
+    """
+    srcのハードリンクをdestに作成する(別のファイルシステムなどでリンクできない場合はコピーする)
+    """
+    try:
+        os.link(src, dest)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dest)
+        shutil.copymode(src, dest)
+
+
+def _replace_with_link(src: Path, dest_path: Path) -> None:
+    """
+    dest_pathを、srcのハードリンク(できない場合はコピー)に置き換える
+    """
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = dest_path.parent / f".{dest_path.name}.{uuid.uuid4().hex}.tmp"
+    try:
+        _link_or_copy(src, temp_path)
+        os.replace(temp_path, dest_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+class BlobWriter:
+    """
+    ファイルの内容を、sha256ハッシュ値を計算しながらストアの一時ファイルに書き込む
+
+    commitで一時ファイルをストアの実体として登録し、dest_pathに実体へのハードリンクを配置する。
+    アップロードやzipファイルの展開で受け取ったデータを一度だけ書き込み、後から読み直さずに済むようにする。
+
+        with store.writer() as writer:
+            writer.write(chunk)
+            digest = writer.commit(dest_path)
+    """
+
+    def __init__(self, store: "BlobStore"):
+        self._store = store
+        temp_dir = store.root / "tmp"
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        self._temp_path = temp_dir / f"{uuid.uuid4().hex}.tmp"
+        self._file = open(self._temp_path, "wb")
+        self._hasher = hashlib.sha256()
+        self.size = 0
+
+    def __enter__(self) -> "BlobWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.discard()
+
+    def write(self, chunk: bytes) -> None:
+        self._hasher.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self, dest_path: Path, mode: int = 0o644) -> str:
+        """
+        書き込んだ内容をストアに登録し、dest_pathに実体へのハードリンクを配置してハッシュ値を返す
+
+        modeの書き込み権限は外す。同じ内容でパーミッションが異なる実体が既にある場合は、
+        一時ファイルをdest_pathに移して、実体を共有しないファイルにする。
+        """
+        self._file.close()
+        digest = self._hasher.hexdigest()
+        mode = readonly_mode(mode)
+        os.chmod(self._temp_path, mode)
+        object_path = self._store._object_path(digest)
+
+        if self._store._object_mode(object_path) == mode:
+            try:
+                _replace_with_link(object_path, dest_path)
+                self._temp_path.unlink()
+                return digest
+            except FileNotFoundError:
+                # リンクする前にcollect_garbageで削除された
+                pass
+
+        # 先にdest_pathからリンクしてから実体として登録するので、collect_garbageに
+        # リンク数が1の状態の実体を見られることはない
+        _replace_with_link(self._temp_path, dest_path)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(self._temp_path, object_path)
+        except FileExistsError:
+            # 同時に同じ内容が登録された場合や、パーミッションが異なる場合は、dest_pathは実体を共有しない
+            pass
+        except OSError as e:
+            logging.warning(f"Failed to store {dest_path} in the blob store: {e}")
+        self._temp_path.unlink()
+        return digest
+
+    def discard(self) -> None:
+        """
+        commitしていない一時ファイルを削除する
+        """
+        if not self._file.closed:
+            self._file.close()
+        self._temp_path.unlink(missing_ok=True)
+
+
+class BlobStore:
+    def __init__(self, root: Path):
+        self.root = root
+
+    def _object_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / digest
+
+    def _manifest_path(self, digest: str) -> Path:
+        return self.root / "manifests" / digest[:2] / f"{digest}.json"
+
+    def _object_mode(self, object_path: Path) -> int | None:
+        """
+        実体のパーミッションを返す(実体が存在しない場合はNone)
+
+        読み込み専用にする前に登録された実体は、ここで書き込み権限を外す。
+        """
+        try:
+            mode = object_path.stat().st_mode & 0o777
+        except FileNotFoundError:
+            return None
+        if mode != readonly_mode(mode):
+            mode = readonly_mode(mode)
+            object_path.chmod(mode)
+        return mode
+
+    def writer(self) -> BlobWriter:
+        """
+        内容をストアに直接書き込むBlobWriterを返す
+        """
+        return BlobWriter(self)
+
+    def put_file(self, path: Path) -> str:
+        """
+        ファイルをストアに登録し、可能であればpathをストアの実体へのハードリンクに置き換える
+
+        ファイル内容のsha256ハッシュ値を返す。pathは書き込み権限を外した読み込み専用のファイルにする。
+        ハードリンクにできない場合(別のファイルシステム、リンク数の上限、パーミッションの違いなど)は、
+        pathはそのまま残す。
+        内容が分かっているデータを書き込む場合は、読み直さずに済むようにwriterを使うこと。
+        """
+        digest = compute_file_digest(path)
+        path.chmod(readonly_mode(path.stat().st_mode))
+        object_path = self._object_path(digest)
+
+        if not object_path.exists():
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            # 書きかけの実体が見えないように、一時ファイルを作ってからリネームする
+            temp_path = object_path.parent / f".{digest}.{uuid.uuid4().hex}.tmp"
+            try:
+                _link_or_copy(path, temp_path)
+                os.replace(temp_path, object_path)
+            except OSError as e:
+                temp_path.unlink(missing_ok=True)
+                logging.warning(f"Failed to store {path} in the blob store: {e}")
+                return digest
+
+        # pathの実体をそのままストアに登録した場合は、置き換える必要はない
+        path_stat = path.stat()
+        try:
+            object_stat = object_path.stat()
+        except FileNotFoundError:
+            return digest
+        if path_stat.st_ino == object_stat.st_ino and path_stat.st_dev == object_stat.st_dev:
+            return digest
+        if (path_stat.st_mode & 0o777) != self._object_mode(object_path):
+            # 実行権限などが異なるファイルは実体を共有できない
+            return digest
+
+        # pathを実体へのハードリンクに置き換える
+        temp_path = path.parent / f".{path.name}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(object_path, temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            temp_path.unlink(missing_ok=True)
+            if e.errno not in (errno.EXDEV, errno.EMLINK):
+                logging.warning(f"Failed to deduplicate {path}: {e}")
+        return digest
+
+    def store_file(self, path: Path, dest_path: Path) -> str:
+        """
+        ファイルをストアに登録し、dest_pathに実体へのハードリンクを作成する(ハッシュ値を返す)
+        """
+        digest = self.put_file(path)
+        object_path = self._object_path(digest)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        dest_path.unlink(missing_ok=True)
+        _link_or_copy(object_path if object_path.exists() else path, dest_path)
+        return digest
+
+    def store_directory(self, dir_path: Path, digests: dict[Path, str] | None = None) -> str:
+        """
+        dir_path以下の全ファイルをストアに登録し、ディレクトリの構成(マニフェスト)のハッシュ値を返す
+
+        ハッシュ値は全ファイルの(相対パス, 内容のハッシュ値, パーミッション)から計算するので、
+        同じ内容のディレクトリは同じハッシュ値になり、実行権限だけが変わった場合も別のハッシュ値になる
+        (ジャッジ結果のキャッシュキーや、課題データのバージョンとして使える)。
+        unfold_zipによる正規化後のディレクトリに対して呼ぶことを想定している
+        digestsには、writerで登録済みのファイルの{パス: ハッシュ値}を渡す(それらのファイルは読み直さない)。
+        """
+        digests = digests or {}
+        manifest: dict[str, dict] = {}
+        for file_path in sorted(p for p in dir_path.rglob("*") if p.is_file()):
+            digest = digests.get(file_path)
+            manifest[str(file_path.relative_to(dir_path))] = {
+                "digest": digest if digest is not None else self.put_file(file_path),
+                "mode": file_path.stat().st_mode & 0o777,
+            }
+
+        hasher = hashlib.sha256()
+        for relative_path, entry in manifest.items():
+            hasher.update(relative_path.encode())
+            hasher.update(b"\0")
+            hasher.update(entry["digest"].encode())
+            hasher.update(b"\0")
+            hasher.update(f"{entry['mode']:o}".encode())
+            hasher.update(b"\0")
+        manifest_digest = hasher.hexdigest()
+
+        manifest_path = self._manifest_path(manifest_digest)
+        if not manifest_path.exists():
+            manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = manifest_path.parent / f".{manifest_digest}.{uuid.uuid4().hex}.tmp"
+            temp_path.write_text(json.dumps(manifest, ensure_ascii=False))
+            os.replace(temp_path, manifest_path)
+
+        return manifest_digest
+
+    def read_manifest(self, manifest_digest: str) -> dict[str, dict] | None:
+        """
+        マニフェスト({相対パス: {"digest": ファイルのハッシュ値, "mode": パーミッション}})を返す
+
+        マニフェストが存在しない場合はNoneを返す。
+        """
+        manifest_path = self._manifest_path(manifest_digest)
+        if not manifest_path.exists():
+            return None
+        return json.loads(manifest_path.read_text())
+
+    def materialize(self, manifest_digest: str, dest_dir: Path) -> bool:
+        """
+        マニフェストのハッシュ値から、ディレクトリをハードリンクで復元する
+
+        マニフェストが存在しない、もしくは実体が欠けている場合はFalseを返す。
+        """
+        manifest = self.read_manifest(manifest_digest)
+        if manifest is None:
+            return False
+        if not all(self._object_path(entry["digest"]).exists() for entry in manifest.values()):
+            return False
+
+        for relative_path, entry in manifest.items():
+            object_path = self._object_path(entry["digest"])
+            dest_path = dest_dir / relative_path
+            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            if (object_path.stat().st_mode & 0o777) == entry["mode"]:
+                _link_or_copy(object_path, dest_path)
+            else:
+                # 同じ内容でパーミッションが異なるファイルは、コピーしてパーミッションを設定する
+                shutil.copyfile(object_path, dest_path)
+                dest_path.chmod(entry["mode"])
+        return True
+
+    def collect_garbage(self) -> int:
+        """
+        どのディレクトリからも参照されなくなった(リンク数が1の)実体を削除し、削除した数を返す
+
+        ディレクトリを削除した後に、定期的に実行することを想定している。
+        書き込みが中断されたBlobWriterの古い一時ファイルも削除する。
+        実体が消えたマニフェストはmaterializeでFalseを返すだけなので、マニフェストは削除しない。
+        """
+        removed = 0
+        temp_dir = self.root / "tmp"
+        if temp_dir.exists():
+            expire_at = time.time() - STALE_TEMP_SECONDS
+            for temp_path in temp_dir.glob("*.tmp"):
+                try:
+                    if temp_path.stat().st_mtime < expire_at:
+                        temp_path.unlink()
+                except FileNotFoundError:
+                    continue
+        objects_dir = self.root / "objects"
+        if not objects_dir.exists():
+            return 0
+        for object_path in objects_dir.glob("*/*"):
+            if object_path.name.startswith("."):
+                continue
+            try:
+                if object_path.stat().st_nlink == 1:
+                    object_path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+upload_store = BlobStore(Path(constants.BLOB_STORE_DIR))
+resource_store = BlobStore(Path(constants.RESOURCE_BLOB_STORE_DIR))
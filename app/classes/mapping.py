@@ -0,0 +1,137 @@
+from typing import Any, Iterable
+from pydantic import TypeAdapter
+from app.classes import response
+from app.classes.schemas import (
+    BatchSubmissionPhase,
+    SingleJudgeStatus,
+    StudentSubmissionStatus,
+    SubmissionProgressStatus,
+    SubmissionSummaryStatus,
+)
+
+"""
+DBの行からresponseのモデルを直接組み立てる関数
+
+DBから読み込んだ値は型が保証されているので、pydanticの検証(model_validate)を行わず、
+model_constructで1回だけ組み立てる(schemasのモデルを経由してから、もう一度responseのモデルとして検証しない)。
+Enumのカラムは文字列で読み込まれるので、ここでEnumに変換する。
+
+引数の行(row)には、ORMのインスタンス、select()の結果の行、schemasのモデルのいずれも渡せる
+(いずれもカラム名と同じ名前の属性を持つ)。
+ユーザの入力など、信頼できない値から組み立てる場合は、これらの関数ではなくmodel_validateを使うこと。
+"""
+
+
+# 提出エントリのリストをJSONに変換するためのTypeAdapter(モジュールの読み込み時に1回だけ作る)
+submission_list_adapter = TypeAdapter(list[response.Submission])
+
+
+def _optional_enum(enum_class, value):
+    return enum_class(value) if value is not None else None
+
+
+def judge_result(row: Any) -> response.JudgeResult:
+    return response.JudgeResult.model_construct(
+        id=row.id,
+        submission_id=row.submission_id,
+        testcase_id=row.testcase_id,
+        result=SingleJudgeStatus(row.result),
+        command=row.command,
+        timeMS=row.timeMS,
+        memoryKB=row.memoryKB,
+        exit_code=row.exit_code,
+        stdout=row.stdout,
+        stderr=row.stderr,
+    )
+
+
+def submission(row: Any, judge_results: Iterable[Any] = ()) -> response.Submission:
+    """
+    提出エントリを組み立てる(judge_resultsを渡した場合は、各テストケースの結果も含める)
+    """
+    return response.Submission.model_construct(
+        id=row.id,
+        ts=row.ts,
+        evaluation_status_id=row.evaluation_status_id,
+        user_id=row.user_id,
+        lecture_id=row.lecture_id,
+        assignment_id=row.assignment_id,
+        eval=row.eval,
+        progress=SubmissionProgressStatus(row.progress),
+        total_task=row.total_task,
+        completed_task=row.completed_task,
+        result=_optional_enum(SubmissionSummaryStatus, row.result),
+        message=row.message,
+        detail=row.detail,
+        score=row.score,
+        timeMS=row.timeMS,
+        memoryKB=row.memoryKB,
+        judge_results=[judge_result(result) for result in judge_results],
+    )
+
+
+def evaluation_status(
+    row: Any,
+    username: str,
+    lecture: response.Lecture,
+    submissions: list[response.Submission],
+) -> response.EvaluationStatus:
+    """
+    バッチ採点の学生ごとの採点結果を組み立てる
+
+    lecture_idは授業エントリ(lecture)から設定する。
+    """
+    return response.EvaluationStatus.model_construct(
+        id=row.id,
+        batch_id=row.batch_id,
+        user_id=row.user_id,
+        username=username,
+        lecture_id=lecture.id,
+        lecture=lecture,
+        status=StudentSubmissionStatus(row.status),
+        result=_optional_enum(SubmissionSummaryStatus, row.result),
+        upload_file_exists=row.upload_dir is not None,
+        report_exists=row.report_path is not None,
+        submit_date=row.submit_date,
+        submissions=submissions,
+    )
+
+
+def batch_submission_detail_item(
+    row: Any,
+    username: str,
+    lecture: response.Lecture,
+    evaluation_statuses: list[response.EvaluationStatus],
+    total_items: int | None = None,
+    current_page: int | None = None,
+    page_size: int | None = None,
+) -> response.BatchSubmissionDetailItem:
+    """
+    バッチ採点の詳細を組み立てる(statusはphaseとジャッジの進捗から求める)
+
+    evaluation_statusesがページの一部の場合は、total_items, current_page, page_sizeを渡す。
+    """
+    if total_items is None:
+        total_items = len(evaluation_statuses)
+    total_pages = None
+    if current_page is not None and page_size is not None:
+        total_pages = (total_items + page_size - 1) // page_size
+    phase = BatchSubmissionPhase(row.phase)
+    return response.BatchSubmissionDetailItem.model_construct(
+        id=row.id,
+        ts=row.ts,
+        user_id=row.user_id,
+        username=username,
+        lecture_id=row.lecture_id,
+        lecture=lecture,
+        message=row.message,
+        status=response.batch_submission_status(phase, row.complete_judge, row.total_judge),
+        complete_judge=row.complete_judge,
+        total_judge=row.total_judge,
+        phase=phase,
+        evaluation_statuses=evaluation_statuses,
+        total_items=total_items,
+        current_page=current_page,
+        page_size=page_size,
+        total_pages=total_pages,
+    )
@@ -1,10 +1,12 @@
+import sqlalchemy
 from sqlalchemy import (
     Integer,
     String,
-    DateTime,
     ForeignKey,
     Boolean,
     Enum,
+    Index,
+    TypeDecorator,
     text,
 )
 from sqlalchemy.orm import (
@@ -16,6 +18,22 @@ from datetime import datetime
 class Base(DeclarativeBase):
     pass
 
+
+class DateTime(TypeDecorator):
+    """
+    DATETIME型
+
+    schemasのfield_serializerでISO形式の文字列に変換された日時も受け付ける。
+    MySQLは文字列をそのまま解釈できるが、SQLiteはdatetime型しか受け付けないため、ここで変換する。
+    """
+    impl = sqlalchemy.DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return datetime.fromisoformat(value)
+        return value
+
 class Lecture(Base):
     __tablename__ = "Lecture"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -37,6 +55,8 @@ class Problem(Base):
     description_path: Mapped[str] = mapped_column(String(255), nullable=False)
     timeMS: Mapped[int] = mapped_column(Integer, nullable=False)
     memoryMB: Mapped[int] = mapped_column(Integer, nullable=False)
+    # 課題データのバージョン(展開した課題データのディレクトリのハッシュ値)
+    version: Mapped[str | None] = mapped_column(String(64), nullable=True, default=None)
     
     # Problemレコードと1-NまたはN-1関係にあるレコードへの参照
     lecture: Mapped["Lecture"] = relationship(back_populates="problems")
@@ -64,6 +84,17 @@ class Problem(Base):
                                                         ))
 
 
+class CatalogVersion(Base):
+    """
+    授業エントリ・課題エントリ(Lecture, Problemと子テーブル)を変更するたびに1増やすバージョン(id=1の1行のみ)
+
+    各uvicorn workerは、このバージョンが変わったときにプロセス内のキャッシュを読み直す。
+    """
+    __tablename__ = "CatalogVersion"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
 class ProblemZipPath(Base):
     __tablename__ = "ProblemZipPath"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -129,13 +160,13 @@ class TestCases(Base):
     type: Mapped[str] = mapped_column(Enum("Built", "Judge"), nullable=False)
     score: Mapped[int] = mapped_column(Integer, nullable=False)
     title: Mapped[str] = mapped_column(String(255), nullable=False)
-    description: Mapped[str] = mapped_column(String)
-    message_on_fail: Mapped[str] = mapped_column(String(255))
+    description: Mapped[str | None] = mapped_column(String, nullable=True)
+    message_on_fail: Mapped[str | None] = mapped_column(String(255), nullable=True)
     command: Mapped[str] = mapped_column(String(255), nullable=False)
-    args: Mapped[str] = mapped_column(String(255))
-    stdin_path: Mapped[str] = mapped_column(String(255))
-    stdout_path: Mapped[str] = mapped_column(String(255))
-    stderr_path: Mapped[str] = mapped_column(String(255))
+    args: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    stdin_path: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    stdout_path: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    stderr_path: Mapped[str | None] = mapped_column(String(255), nullable=True)
     exit_code: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
     problem: Mapped["Problem"] = relationship(back_populates="test_cases", 
                                                 primaryjoin=(
@@ -183,6 +214,10 @@ class BatchSubmission(Base):
     message: Mapped[str] = mapped_column(String(255), nullable=True)
     complete_judge: Mapped[int] = mapped_column(Integer, nullable=True)
     total_judge: Mapped[int] = mapped_column(Integer, nullable=True)
+    # 取り込み中(ingesting) -> ジャッジ中(judging)、取り込みに失敗した場合はfailed
+    phase: Mapped[str] = mapped_column(Enum("ingesting", "judging", "failed"), nullable=False, default="judging", server_default="judging")
+    # 取り込みを実行しているプロセスが生存していることを示す最終更新時刻(リース)。取り込み中に定期的にCURRENT_TIMESTAMPで更新する
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, default=None)
 
     # BatchSubmissionレコードと1-N関係にあるEvaluationStatusレコードへの参照
     evaluation_statuses: Mapped[List["EvaluationStatus"]] = relationship(back_populates="batch_submission")
@@ -224,6 +259,26 @@ class Submission(Base):
     score: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
     timeMS: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
     memoryKB: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
+    # ジャッジの優先度。ジャッジワーカーは(priority DESC, id ASC)の順にキューから取り出す
+    priority: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # ジャッジの開始(running)時刻と完了(done)時刻。ジャッジワーカーがCURRENT_TIMESTAMPで設定する
+    # (メトリクスで直近の提出だけを集計するため、それぞれインデックスを張る)
+    started_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, default=None, index=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, default=None, index=True)
+    # 提出ファイルの内容と課題のテストケースリソースから計算したハッシュ値(ジャッジ結果のキャッシュキー)
+    cache_key: Mapped[str | None] = mapped_column(String(64), nullable=True, default=None, index=True)
+    # ジャッジワーカーが生存していることを示す最終更新時刻(リース)。ジャッジ中に定期的にCURRENT_TIMESTAMPで更新する
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True, default=None)
+    # ジャッジが停止したとみなしてキューに積み直した回数
+    retry_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # ジャッジワーカーがキューから取り出すたびに1増やす値(取り出しトークン)
+    # 積み直された後や再ジャッジされた後に、以前取り出したワーカーから届いた結果を書き込まないために使う
+    claim_token: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    
+    # running状態のまま停止した提出を探すためのインデックス
+    __table_args__ = (
+        Index("ix_Submission_progress_started_at", "progress", "started_at"),
+    )
     
     # Submissionレコードと1-1関係(他方から見たら1-N関係)にあるProblemレコードへの参照
     problem: Mapped["Problem"] = relationship(
@@ -234,6 +289,23 @@ class Submission(Base):
     judge_results: Mapped[List["JudgeResult"]] = relationship()
 
 
+class RejudgeRequest(Base):
+    __tablename__ = "RejudgeRequest"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    ts: Mapped[datetime] = mapped_column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
+    user_id: Mapped[str] = mapped_column(String(255), ForeignKey("Users.user_id"), nullable=False)
+    # 再ジャッジ対象の提出の絞り込み条件
+    lecture_id: Mapped[int] = mapped_column(Integer, ForeignKey("Lecture.id"), nullable=False)
+    assignment_id: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
+    batch_id: Mapped[int | None] = mapped_column(Integer, ForeignKey("BatchSubmission.id"), nullable=True, default=None)
+    result: Mapped[str | None] = mapped_column(Enum("AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN"), nullable=True, default=None)
+    # 進捗状況
+    progress: Mapped[str] = mapped_column(Enum("queued", "running", "done", "failed"), nullable=False, default="queued")
+    total: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    processed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    message: Mapped[str | None] = mapped_column(String(255), nullable=True, default=None)
+
+
 class JudgeResult(Base):
     __tablename__ = "JudgeResult"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
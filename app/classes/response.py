@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import List, Optional, Dict, Literal
 from enum import Enum
 import logging
-from app.classes.schemas import EvaluationType, StudentSubmissionStatus, SubmissionSummaryStatus, SubmissionProgressStatus, SingleJudgeStatus, Role
+from app.classes.schemas import EvaluationType, StudentSubmissionStatus, SubmissionSummaryStatus, SubmissionProgressStatus, SingleJudgeStatus, Role, RejudgeProgressStatus, BatchSubmissionPhase, ProblemDiff
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -14,6 +14,17 @@ class Message(BaseModel):
     model_config = {"extra": "allow"}
 
 
+class ProblemIngestResult(Message):
+    """
+    課題データの追加・更新APIのレスポンス
+    """
+    lecture_id: int
+    assignment_id: int
+    version: str # 課題データのバージョン
+    diff: ProblemDiff # 前のバージョンとの差分
+    timings: Dict[str, float] # 各段階の処理時間(ミリ秒)
+
+
 class Lecture(BaseModel):
     id: int
     title: str
@@ -40,6 +51,7 @@ class Problem(BaseModel):
     # description_pathはレスポンスには含めない。
     timeMS: int
     memoryMB: int
+    version: str | None = Field(default=None) # 課題データのバージョン
     
     detail: Optional["ProblemDetail"] = Field(default=None)
 
@@ -89,6 +101,10 @@ class TestCases(BaseModel):
     stdin: str | None = Field(default=None) # response時にファイルから読み込む
     stdout: str | None = Field(default=None) # response時にファイルから読み込む
     stderr: str | None = Field(default=None) # response時にファイルから読み込む
+    # stdin, stdout, stderrのファイルの情報(プレビューの場合、ファイル全体は別のAPIで取得する)
+    stdin_file: Optional["ResourceFileInfo"] = Field(default=None)
+    stdout_file: Optional["ResourceFileInfo"] = Field(default=None)
+    stderr_file: Optional["ResourceFileInfo"] = Field(default=None)
     exit_code: int
     
     model_config = {"from_attributes": True}
@@ -98,15 +114,42 @@ class TestCases(BaseModel):
         return type.value
 
 
+class ResourceFileInfo(BaseModel):
+    size: int # ファイル全体のサイズ(バイト)
+    sha256: str # ファイル全体の内容のハッシュ値
+    truncated: bool # 内容がファイルの先頭のみ(プレビュー)の場合はTrue
+
+
+BatchSubmissionStatus = Literal["ingesting", "queued", "running", "done", "failed"]
+
+
+def batch_submission_status(
+    phase: BatchSubmissionPhase, complete_judge: int | None, total_judge: int | None
+) -> BatchSubmissionStatus:
+    """
+    バッチ採点の段階とジャッジの進捗から、バッチ採点の状態を求める
+    """
+    if phase == BatchSubmissionPhase.INGESTING:
+        return "ingesting"
+    if phase == BatchSubmissionPhase.FAILED:
+        return "failed"
+    if complete_judge is None or total_judge is None:
+        return "queued"
+    if complete_judge == total_judge:
+        return "done"
+    return "running"
+
+
 class BatchSubmission(BaseModel):
     id: int
     ts: datetime
     user_id: str
     lecture_id: int
     message: str | None
-    status: Literal["queued", "running", "done"] = Field(default="queued")
+    status: BatchSubmissionStatus = Field(default="queued")
     complete_judge: int | None
     total_judge: int | None
+    phase: BatchSubmissionPhase = Field(default=BatchSubmissionPhase.JUDGING)
     
     evaluation_statuses: list["EvaluationStatus"] = Field(default_factory=list)
     
@@ -118,12 +161,7 @@ class BatchSubmission(BaseModel):
     
     @model_validator(mode='after')
     def set_status(self):
-        if self.complete_judge is None or self.total_judge is None:
-            self.status = "queued"
-        elif self.complete_judge == self.total_judge:
-            self.status = "done"
-        else:
-            self.status = "running"
+        self.status = batch_submission_status(self.phase, self.complete_judge, self.total_judge)
         return self
 
 class BatchSubmissionItemForListView(BaseModel):
@@ -134,9 +172,10 @@ class BatchSubmissionItemForListView(BaseModel):
     lecture_id: int
     lecture_title: str
     message: str | None
-    status: Literal["queued", "running", "done"] = Field(default="queued")
+    status: BatchSubmissionStatus = Field(default="queued")
     complete_judge: int | None
     total_judge: int | None
+    phase: BatchSubmissionPhase = Field(default=BatchSubmissionPhase.JUDGING)
     
     evaluation_statuses: list["EvaluationStatus"] = Field(default_factory=list)
     
@@ -148,12 +187,7 @@ class BatchSubmissionItemForListView(BaseModel):
     
     @model_validator(mode='after')
     def set_status(self):
-        if self.complete_judge is None or self.total_judge is None:
-            self.status = "queued"
-        elif self.complete_judge == self.total_judge:
-            self.status = "done"
-        else:
-            self.status = "running"
+        self.status = batch_submission_status(self.phase, self.complete_judge, self.total_judge)
         return self
 
 class BatchSubmissionItemsForListView(BaseModel):
@@ -174,11 +208,18 @@ class BatchSubmissionDetailItem(BaseModel):
     lecture_id: int
     lecture: Lecture
     message: str | None
-    status: Literal["queued", "running", "done"] = Field(default="queued")
+    status: BatchSubmissionStatus = Field(default="queued")
     complete_judge: int | None
     total_judge: int | None
+    phase: BatchSubmissionPhase = Field(default=BatchSubmissionPhase.JUDGING)
     
     evaluation_statuses: list["EvaluationStatus"] = Field(default_factory=list)
+    # 条件に一致する学生の採点結果の総数と、evaluation_statusesのページ
+    # (ページを指定しなかった場合は、current_page, page_size, total_pagesはNone)
+    total_items: int = Field(default=0)
+    current_page: int | None = Field(default=None)
+    page_size: int | None = Field(default=None)
+    total_pages: int | None = Field(default=None)
     
     model_config = {"from_attributes": True}
     
@@ -188,12 +229,7 @@ class BatchSubmissionDetailItem(BaseModel):
     
     @model_validator(mode='after')
     def set_status(self):
-        if self.complete_judge is None or self.total_judge is None:
-            self.status = "queued"
-        elif self.complete_judge == self.total_judge:
-            self.status = "done"
-        else:
-            self.status = "running"
+        self.status = batch_submission_status(self.phase, self.complete_judge, self.total_judge)
         return self
 
 # バッチ採点の各ユーザの採点結果
@@ -288,6 +324,52 @@ class JudgeResult(BaseModel):
         return result.value
 
 
+# 一括再ジャッジのリクエストとその進捗状況
+class RejudgeRequest(BaseModel):
+    id: int
+    ts: datetime
+    user_id: str
+    lecture_id: int
+    assignment_id: int | None
+    batch_id: int | None
+    result: SubmissionSummaryStatus | None
+    progress: RejudgeProgressStatus
+    total: int
+    processed: int
+    message: str | None
+
+    model_config = {"from_attributes": True}
+
+    @field_serializer("ts")
+    def serialize_ts(self, ts: datetime, _info):
+        return ts.isoformat()
+
+    @field_serializer("result")
+    def serialize_result(self, result: SubmissionSummaryStatus | None, _info):
+        return result.value if result is not None else None
+
+    @field_serializer("progress")
+    def serialize_progress(self, progress: RejudgeProgressStatus, _info):
+        return progress.value
+
+
+# ジャッジキューの混雑状況(フロントエンドでの待ち時間の表示用)
+class JudgeQueueStatus(BaseModel):
+    queued: int
+    running: int
+    # 直近の1秒あたりのジャッジ完了数
+    throughput_per_second: float
+    # 最も古いキュー待ちの提出の待ち時間(秒)
+    oldest_queued_seconds: float
+    # 現在のキューを全て処理し終えるまでの推定時間(秒)、スループットが0の場合はNone
+    estimated_drain_seconds: float | None = Field(default=None)
+    # submission_idが指定された場合、その提出より先にジャッジされるキュー待ちの提出の数
+    # (その提出がキュー待ちでない場合はNone)
+    position: int | None = Field(default=None)
+    # submission_idが指定された場合、その提出のジャッジが始まるまでの推定時間(秒)
+    estimated_wait_seconds: float | None = Field(default=None)
+
+
 class User(BaseModel):
     user_id: str
     username: str
@@ -108,6 +108,7 @@ class Problem(BaseModel):
     description_path: str
     timeMS: int
     memoryMB: int
+    version: str | None = Field(default=None)
 
     executables: list["Executables"] = Field(default_factory=list)
     arranged_files: list["ArrangedFiles"] = Field(default_factory=list)
@@ -131,6 +132,23 @@ class ProblemZipPath(BaseModel):
     }
 
 
+class ProblemDiff(BaseModel):
+    """
+    課題データを登録・更新した際の、前のバージョンとの差分
+
+    ファイルのパスは課題データ(zipファイルの展開先)内の相対パスで表す。
+    """
+    created: bool = Field(default=False) # 新しく登録された小課題の場合はTrue
+    previous_version: str | None = Field(default=None)
+    changed_fields: list[str] = Field(default_factory=list) # 値が変わったProblemテーブルの列
+    added_test_cases: list[str] = Field(default_factory=list) # テストケースのタイトル
+    removed_test_cases: list[str] = Field(default_factory=list)
+    changed_test_cases: list[str] = Field(default_factory=list)
+    added_files: list[str] = Field(default_factory=list)
+    removed_files: list[str] = Field(default_factory=list)
+    changed_files: list[str] = Field(default_factory=list)
+
+
 class Executables(BaseModel):
     id: int = Field(default=0)
     lecture_id: int
@@ -197,6 +215,12 @@ class TestCases(BaseModel):
         return type.value
 
 
+class BatchSubmissionPhase(Enum):
+    INGESTING = "ingesting" # アップロードされたzipファイルを展開し、提出エントリを登録している
+    JUDGING = "judging" # 提出エントリの登録が完了し、ジャッジしている
+    FAILED = "failed" # 取り込みに失敗した
+
+
 class BatchSubmission(BaseModel):
     id: int = Field(default=0)
     ts: datetime = Field(default=datetime(year=1998, month=6, day=6))
@@ -205,6 +229,7 @@ class BatchSubmission(BaseModel):
     message: str | None
     complete_judge: int | None
     total_judge: int | None
+    phase: BatchSubmissionPhase = Field(default=BatchSubmissionPhase.JUDGING)
 
     evaluation_statuses: list["EvaluationStatus"] = Field(default_factory=list)
 
@@ -271,6 +296,13 @@ class Submission(BaseModel):
     score: int | None = Field(default=None)
     timeMS: int | None = Field(default=None)
     memoryKB: int | None = Field(default=None)
+    priority: int = Field(default=0)
+    started_at: datetime | None = Field(default=None)
+    finished_at: datetime | None = Field(default=None)
+    cache_key: str | None = Field(default=None)
+    heartbeat_at: datetime | None = Field(default=None)
+    retry_count: int = Field(default=0)
+    claim_token: int = Field(default=0)
 
     problem: Problem | None = Field(default=None)
 
@@ -317,6 +349,54 @@ class JudgeResult(BaseModel):
         return result.value
 
 
+# ジャッジワーカーからまとめて送られてくる、提出エントリの進捗状況の更新
+class SubmissionProgressUpdate(BaseModel):
+    submission_id: int
+    # キューから取り出したときの提出エントリのclaim_token。一致しない場合(別のワーカーが取り出し直した場合など)は書き込まない
+    claim_token: int
+    progress: SubmissionProgressStatus | None = Field(default=None)
+    total_task: int | None = Field(default=None)
+    result: SubmissionSummaryStatus | None = Field(default=None)
+    message: str | None = Field(default=None)
+    detail: str | None = Field(default=None)
+    score: int | None = Field(default=None)
+    timeMS: int | None = Field(default=None)
+    memoryKB: int | None = Field(default=None)
+
+
+# ジャッジワーカーからまとめて送られてくる、テストケースの実行結果と進捗状況の更新
+class JudgeIngestBatch(BaseModel):
+    # テストケースの実行結果は、submissionsにclaim_tokenを含む更新がある提出のもののみ書き込む
+    judge_results: List[JudgeResult] = Field(default_factory=list)
+    # 同じ提出に対する更新が複数含まれる場合、後のものが優先される
+    submissions: List[SubmissionProgressUpdate] = Field(default_factory=list)
+
+
+class RejudgeProgressStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class RejudgeRequest(BaseModel):
+    id: int = Field(default=0)
+    ts: datetime = Field(default=datetime(year=1998, month=6, day=6))
+    user_id: str
+    lecture_id: int
+    assignment_id: int | None = Field(default=None)
+    batch_id: int | None = Field(default=None)
+    result: SubmissionSummaryStatus | None = Field(default=None)
+    progress: RejudgeProgressStatus = Field(default=RejudgeProgressStatus.QUEUED)
+    total: int = Field(default=0)
+    processed: int = Field(default=0)
+    message: str | None = Field(default=None)
+
+    model_config = {
+        "from_attributes": True
+    }
+
+
 class LoginHistory(BaseModel):
     user_id: str
     login_at: datetime
@@ -0,0 +1,166 @@
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:  # brotliがインストールされていない場合は、gzipのみ使う
+        brotli = None
+
+"""
+レスポンスの圧縮(Accept-Encodingに応じてbr, gzipを選ぶ)
+
+starletteのGZipMiddlewareと同じく、minimum_sizeより小さいレスポンスや、
+既にContent-Encodingが設定されたレスポンスは圧縮しない。
+加えて、ZIPファイルなど既に圧縮されているレスポンスと、Rangeリクエストに対する部分的なレスポンスも圧縮しない。
+starletteの内部のクラス(GZipResponderなど)には依存せず、ASGIのメッセージを直接扱う。
+"""
+
+# 圧縮しないContent-Type
+EXCLUDED_CONTENT_TYPES = (
+    "text/event-stream",
+    "application/zip",
+    "application/gzip",
+    "application/octet-stream",
+    "image/",
+)
+
+
+def _accepted_encodings(accept_encoding: str) -> set[str]:
+    """
+    Accept-Encodingヘッダから、受け付ける(q=0でない)エンコーディングの集合を返す
+    """
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+class _GZipCompressor:
+    encoding = "gzip"
+
+    def __init__(self, level: int) -> None:
+        # wbitsに16を足すと、gzip形式(ヘッダとCRC付き)で出力する
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, body: bytes, *, more_body: bool) -> bytes:
+        compressed = self._compressor.compress(body)
+        if not more_body:
+            compressed += self._compressor.flush()
+        return compressed
+
+
+class _BrotliCompressor:
+    encoding = "br"
+
+    def __init__(self, quality: int) -> None:
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, body: bytes, *, more_body: bool) -> bytes:
+        compressed = self._compressor.process(body)
+        if not more_body:
+            compressed += self._compressor.finish()
+        return compressed
+
+
+class _CompressionResponder:
+    """
+    1つのリクエストに対するレスポンスを、compressorで圧縮して送る(compressorがNoneの場合は圧縮しない)
+
+    http.response.startのメッセージは、最初のbodyを受け取って圧縮するかどうかを決めるまで送らずに保持する。
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int, compressor: _GZipCompressor | _BrotliCompressor | None) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compressor = compressor
+        self.send: Send | None = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.excluded = False
+        self.compressing = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_with_compression)
+
+    async def send_with_compression(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            self.excluded = (
+                "content-encoding" in headers
+                or "content-range" in headers
+                or headers.get("content-type", "").startswith(EXCLUDED_CONTENT_TYPES)
+            )
+            return
+
+        if message["type"] != "http.response.body":
+            # http.response.pathsendなど、bodyを持たないメッセージはそのまま送る
+            if not self.started:
+                self.started = True
+                await self.send(self.initial_message)
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.started:
+            # ストリーミングレスポンスの2つ目以降のbody
+            if self.compressing:
+                message["body"] = self.compressor.compress(body, more_body=more_body)
+            await self.send(message)
+            return
+
+        self.started = True
+        if self.excluded or (len(body) < self.minimum_size and not more_body):
+            await self.send(self.initial_message)
+            await self.send(message)
+            return
+
+        headers = MutableHeaders(raw=self.initial_message["headers"])
+        headers.add_vary_header("Accept-Encoding")
+        if self.compressor is not None:
+            self.compressing = True
+            message["body"] = self.compressor.compress(body, more_body=more_body)
+            headers["Content-Encoding"] = self.compressor.encoding
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(message["body"]))
+        await self.send(self.initial_message)
+        await self.send(message)
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accepted = _accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        compressor: _GZipCompressor | _BrotliCompressor | None = None
+        if brotli is not None and "br" in accepted:
+            compressor = _BrotliCompressor(self.brotli_quality)
+        elif "gzip" in accepted:
+            compressor = _GZipCompressor(self.gzip_level)
+        await _CompressionResponder(self.app, self.minimum_size, compressor)(scope, receive, send)
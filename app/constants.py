@@ -8,6 +8,9 @@ DATABASE_USER = os.getenv("DATABASE_USER")
 DATABASE_PASSWORD = os.getenv("DATABASE_PASSWORD")
 DATABASE_HOST = os.getenv("DATABASE_HOST")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
+# 指定された場合、DATABASE_USERなどの代わりにこのURLで接続する
+# (例: ローカルでの負荷試験用に "sqlite:///./dsa.sqlite3" を指定する)
+DATABASE_URL = os.getenv("DATABASE_URL")
 
 ADMIN_USER_ID = os.getenv("INIT_ADMIN_USER_ID")
 ADMIN_USER = os.getenv("INIT_ADMIN_USER")
@@ -21,4 +24,122 @@ ENV = os.getenv("ENV")
 # --- パス関連 ---
 UPLOAD_DIR = os.getenv("UPLOAD_DIR_PATH", "/upload")
 
-RESOURCE_DIR = os.getenv("RESOURCE_DIR_PATH", "/resource")
\ No newline at end of file
+RESOURCE_DIR = os.getenv("RESOURCE_DIR_PATH", "/resource")
+
+# 課題リソースから作るZIPファイルなど、作り直せるファイルを置くディレクトリ
+CACHE_DIR = os.getenv("CACHE_DIR_PATH", "/tmp/dsa-cache")
+
+# アップロードされたファイルの実体を内容のハッシュ値で管理するストア
+# 提出ディレクトリからハードリンクで参照するため、UPLOAD_DIRと同じファイルシステム上に置くこと
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR_PATH", os.path.join(UPLOAD_DIR, ".blobs"))
+# 課題データのファイルの実体を内容のハッシュ値で管理するストア(RESOURCE_DIRと同じファイルシステム上に置くこと)
+RESOURCE_BLOB_STORE_DIR = os.getenv("RESOURCE_BLOB_STORE_DIR_PATH", os.path.join(RESOURCE_DIR, ".blobs"))
+# どこからも参照されなくなった実体を削除する間隔(秒)。0以下の場合は削除しない
+BLOB_GC_INTERVAL_SECONDS = float(os.getenv("BLOB_GC_INTERVAL_SECONDS", "3600"))
+
+# --- アップロード関連 ---
+# 単体の採点リクエストで受け付けるファイル1つあたりのサイズの上限(バイト)
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(5 * 1024 * 1024)))
+# 単体の採点リクエストで受け付けるファイルの合計サイズの上限(バイト)
+UPLOAD_MAX_TOTAL_BYTES = int(os.getenv("UPLOAD_MAX_TOTAL_BYTES", str(20 * 1024 * 1024)))
+# アップロードされたファイルを読み書きする単位(バイト)
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# 単体の採点リクエストのボディ(multipart)全体のサイズの上限(バイト)
+# multipartのパースの前に確認する。ファイルの合計サイズの上限に、multipartのヘッダなどの分を加えた値にする
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(UPLOAD_MAX_TOTAL_BYTES + 1024 * 1024)))
+
+# --- zipファイルの展開 ---
+# 提出されたzipファイル1つあたりの展開後の容量の上限(バイト)
+UNFOLD_MAX_TOTAL_BYTES = int(os.getenv("UNFOLD_MAX_TOTAL_BYTES", str(30 * 1024 * 1024)))
+# 提出されたzipファイル1つあたりのエントリ数の上限
+UNFOLD_MAX_ENTRIES = int(os.getenv("UNFOLD_MAX_ENTRIES", "1000"))
+# バッチ採点で学生ごとの提出を並列に展開するプロセスの数(0以下の場合はスレッドで展開する)
+BATCH_EXTRACT_WORKERS = int(os.getenv("BATCH_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 同時に取り込み(展開、提出エントリの登録)を実行するバッチ採点の数。これを超えたバッチ採点は順番を待つ
+BATCH_INGEST_CONCURRENCY = int(os.getenv("BATCH_INGEST_CONCURRENCY", "1"))
+# バッチ採点の結果をNDJSONで出力するときに、1回のクエリで読み込む学生の数
+BATCH_EXPORT_CHUNK_SIZE = int(os.getenv("BATCH_EXPORT_CHUNK_SIZE", "200"))
+
+# --- 課題リソースファイルのキャッシュ ---
+# 課題の説明文やテストケースの入出力ファイルをメモリに保持する容量の上限(バイト)
+RESOURCE_CACHE_MAX_BYTES = int(os.getenv("RESOURCE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# これより大きいファイルはキャッシュせず、リクエストごとに読み込む(バイト)
+RESOURCE_CACHE_MAX_FILE_BYTES = int(os.getenv("RESOURCE_CACHE_MAX_FILE_BYTES", str(4 * 1024 * 1024)))
+# キャッシュしない大きなファイルをmmapで読み込むかどうか
+RESOURCE_CACHE_USE_MMAP = os.getenv("RESOURCE_CACHE_USE_MMAP", "false").lower() in ("1", "true", "yes")
+# 課題の詳細のプレビューに含める、テストケースのstdin, stdout, stderrの先頭のバイト数
+PROBLEM_DETAIL_PREVIEW_BYTES = int(os.getenv("PROBLEM_DETAIL_PREVIEW_BYTES", str(64 * 1024)))
+# 組み立て済みの課題の詳細(/info/{lecture_id}/{assignment_id}/detail)を保持する数の上限
+PROBLEM_DETAIL_CACHE_ENTRIES = int(os.getenv("PROBLEM_DETAIL_CACHE_ENTRIES", "256"))
+# 課題リソースファイルの内容のハッシュ値(ジャッジ結果のキャッシュのキーに使う)を保持する数の上限
+RESOURCE_DIGEST_CACHE_ENTRIES = int(os.getenv("RESOURCE_DIGEST_CACHE_ENTRIES", "4096"))
+
+# --- 授業エントリ・課題エントリのキャッシュ ---
+# 他のworkerでの変更を確認する(CatalogVersionテーブルを読む)間隔(秒)。0の場合は毎回確認する
+CATALOG_VERSION_CHECK_INTERVAL_SECONDS = float(os.getenv("CATALOG_VERSION_CHECK_INTERVAL_SECONDS", "1"))
+
+# --- HTTPキャッシュ(Cache-Control) ---
+# 授業エントリの一覧など、ブラウザがサーバに問い合わせずに使い回してよい秒数(0の場合は毎回ETagで検証する)
+HTTP_CATALOG_MAX_AGE_SECONDS = int(os.getenv("HTTP_CATALOG_MAX_AGE_SECONDS", "30"))
+# 課題データのテンプレートを、ブラウザがサーバに問い合わせずに使い回してよい秒数
+HTTP_TEMPLATE_MAX_AGE_SECONDS = int(os.getenv("HTTP_TEMPLATE_MAX_AGE_SECONDS", "3600"))
+
+# --- レスポンスの圧縮 ---
+# これより小さいレスポンスは圧縮しない(バイト)
+COMPRESSION_MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+# gzipの圧縮レベル(1-9)と、brotliの品質(0-11。brotliがインストールされている場合のみ使う)
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+# --- ジャッジリクエストの流量制限 ---
+# バケットの状態の保持先
+# "memory": プロセス内で保持する(uvicornのworkerごとに独立する)
+# "sqlite": RATE_LIMIT_SQLITE_PATHのファイルに保持する(同一ホストのworker間で共有する)
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", "/tmp/dsa-rate-limit.sqlite3")
+
+# ユーザごとのトークンバケット (ロール: (容量, 1秒あたりの補充量))
+JUDGE_USER_RATE_LIMITS: dict[str, tuple[float, float]] = {
+    "student": (
+        float(os.getenv("JUDGE_STUDENT_BURST", "10")),
+        float(os.getenv("JUDGE_STUDENT_PER_MINUTE", "6")) / 60,
+    ),
+    "manager": (100, 1.0),
+    "admin": (100, 1.0),
+}
+
+# ロール全体で共有するトークンバケット (ロール: (容量, 1秒あたりの補充量))
+JUDGE_ROLE_RATE_LIMITS: dict[str, tuple[float, float]] = {
+    "student": (
+        float(os.getenv("JUDGE_STUDENT_ROLE_BURST", "300")),
+        float(os.getenv("JUDGE_STUDENT_ROLE_PER_SECOND", "5")),
+    ),
+    "manager": (1000, 10.0),
+    "admin": (1000, 10.0),
+}
+
+# ユーザごとの未完了(pending, queued, running)の提出数の上限
+JUDGE_MAX_INFLIGHT_SUBMISSIONS: dict[str, int] = {
+    "student": int(os.getenv("JUDGE_STUDENT_MAX_INFLIGHT", "10")),
+    "manager": 100,
+    "admin": 100,
+}
+
+# --- 停止したジャッジの回収 ---
+# 回収処理を実行する間隔(秒)。0以下の場合は回収処理を実行しない
+REAPER_INTERVAL_SECONDS = float(os.getenv("REAPER_INTERVAL_SECONDS", "30"))
+# 課題の制限時間から計算したタイムアウトに加える猶予(秒)
+REAPER_GRACE_SECONDS = float(os.getenv("REAPER_GRACE_SECONDS", "60"))
+# ジャッジが停止した回数がこの値に達した提出はIEとして終了させる
+REAPER_MAX_RETRIES = int(os.getenv("REAPER_MAX_RETRIES", "3"))
+# バッチ採点の取り込みのリース(秒)。取り込み中のプロセスは回収処理のたびにリースを更新し、
+# この秒数以上更新されていない取り込み中のバッチ採点は、プロセスが停止したものとして失敗させる
+# (REAPER_INTERVAL_SECONDSより十分長くすること)
+BATCH_INGEST_LEASE_SECONDS = float(os.getenv("BATCH_INGEST_LEASE_SECONDS", "120"))
+
+# --- メトリクス ---
+# /api/v1/metrics にアクセスするためのトークン(Authorization: Bearer {METRICS_TOKEN})
+# 空の場合は、メトリクスのエンドポイントを無効にする(404を返す)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# 待ち時間・ジャッジ時間のヒストグラムを集計する時間窓(秒)。直近の提出だけを集計する
+METRICS_HISTOGRAM_WINDOW_SECONDS = int(os.getenv("METRICS_HISTOGRAM_WINDOW_SECONDS", "3600"))
@@ -6,13 +6,21 @@ from datetime import datetime
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.classes.models import Base
-from app.api.api_v1.endpoints import authenticate_util
 from app import constants
 from app.crud.db.users import create_user, admin_user_exists
+from app.crud.db.catalog import ensure_catalog_version
 
-DATABASE_URL = f"mysql+pymysql://{constants.DATABASE_USER}:{constants.DATABASE_PASSWORD}@{constants.DATABASE_HOST}/{constants.DATABASE_NAME}"
+DATABASE_URL = (
+    constants.DATABASE_URL
+    if constants.DATABASE_URL
+    else f"mysql+pymysql://{constants.DATABASE_USER}:{constants.DATABASE_PASSWORD}@{constants.DATABASE_HOST}/{constants.DATABASE_NAME}"
+)
 
-engine = create_engine(DATABASE_URL)
+if DATABASE_URL.startswith("sqlite"):
+    # SQLiteの接続をスレッド間(FastAPIのスレッドプールなど)で共有できるようにする
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+else:
+    engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base.metadata.create_all(bind=engine)
@@ -20,8 +28,13 @@ logging.basicConfig(level=logging.DEBUG)
 
 
 def init_db():
+    # app.api.api_v1.endpointsはapp.crud.dbのSessionLocalをimportするため、
+    # モジュールの先頭でimportすると循環importになる(fake_workerなど、app.crud.dbを先にimportする場合)
+    from app.api.api_v1.endpoints import authenticate_util
+
     db = SessionLocal()
     try:
+        ensure_catalog_version(db)
         if admin_user_exists(db):
             db.close()
             return
@@ -1,9 +1,11 @@
-from app.classes import schemas
+from app.classes import schemas, response, mapping
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_, asc, desc, select
+from sqlalchemy import and_, or_, asc, desc, select, insert, update, literal, literal_column, func, case, bindparam
 from ...classes import models
+from . import catalog
 from typing import List, Literal, Tuple
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import Counter
 import pytz
 from pathlib import Path
 import logging
@@ -13,52 +15,14 @@ def get_lecture_list(db: Session) -> List[schemas.Lecture]:
     """
     全ての授業エントリを取得する関数
     各授業に紐づく問題のリストまで取得する
+
+    カタログのキャッシュから返す(problemsはtest_cases, required_files, arranged_files, executablesを含まない)。
     """
-    lecture_list = db.query(models.Lecture).all()
-    return [
-        # lazy loadingを防ぐために、1-N関係にあるネスト情報をなるべくアクセスしないようにする
-        schemas.Lecture(
-            id=lecture.id,
-            title=lecture.title,
-            start_date=lecture.start_date,
-            end_date=lecture.end_date,
-            problems=[
-                schemas.Problem(
-                    lecture_id=problem.lecture_id,
-                    assignment_id=problem.assignment_id,
-                    title=problem.title,
-                    description_path=problem.description_path,
-                    timeMS=problem.timeMS,
-                    memoryMB=problem.memoryMB,
-                    # problem.test_cases, required_files, arranged_files, executables
-                    # までは読み込まない
-                )
-                for problem in lecture.problems
-            ]
-        )
-        for lecture in lecture_list
-    ]
+    return list(catalog.catalog_cache.get(db).lectures.values())
 
 
 def get_lecture(db: Session, lecture_id: int) -> schemas.Lecture | None:
-    lecture = db.query(models.Lecture).filter(models.Lecture.id == lecture_id).first()
-    return schemas.Lecture(
-        id=lecture.id,
-        title=lecture.title,
-        start_date=lecture.start_date,
-        end_date=lecture.end_date,
-        problems=[
-            schemas.Problem(
-                lecture_id=problem.lecture_id,
-                assignment_id=problem.assignment_id,
-                title=problem.title,
-                description_path=problem.description_path,
-                timeMS=problem.timeMS,
-                memoryMB=problem.memoryMB,
-            )
-            for problem in lecture.problems
-        ]
-    ) if lecture is not None else None
+    return catalog.catalog_cache.get(db).lectures.get(lecture_id)
 
 
 def add_or_update_lecture(db: Session, lecture: schemas.Lecture) -> None:
@@ -70,7 +34,9 @@ def add_or_update_lecture(db: Session, lecture: schemas.Lecture) -> None:
         **lecture.model_dump(exclude={"problems"})
     )
     db.merge(lecture)
+    catalog.bump_catalog_version(db)
     db.commit()
+    catalog.catalog_cache.invalidate()
 
 
 def register_problem(db: Session, problem: schemas.Problem) -> None:
@@ -110,7 +76,9 @@ def register_problem(db: Session, problem: schemas.Problem) -> None:
         db.add(new_test_case)
     
     db.add(new_problem)
+    catalog.bump_catalog_version(db)
     db.commit()
+    catalog.catalog_cache.invalidate()
 
 
 def register_problem_zip_path(db: Session, problem_zip_path: schemas.ProblemZipPath) -> None:
@@ -122,6 +90,118 @@ def register_problem_zip_path(db: Session, problem_zip_path: schemas.ProblemZipP
     db.commit()
 
 
+def _package_relative_path(path: str | None) -> str | None:
+    """
+    RESOURCE_DIRからの相対パス(lec-{lecture_id}/problem-{assignment_id}/v-{version}/extracted/...)から、
+    課題データ内の相対パスを取り出す(バージョンが変わっただけのパスを、同じパスとして比較するため)
+    """
+    if path is None:
+        return None
+    parts = Path(path).parts
+    if "extracted" not in parts:
+        return path
+    return str(Path(*parts[len(parts) - parts[::-1].index("extracted"):]))
+
+
+def replace_problem(
+    db: Session, problem: schemas.Problem, problem_zip_path: schemas.ProblemZipPath | None = None
+) -> schemas.ProblemDiff:
+    """
+    Problemテーブルと、それらと子関係にあるテーブルの課題データを、一つのトランザクションで
+    problemの内容に置き換える(小課題が存在しない場合は新しく登録する)
+
+    Problemテーブルのレコードは削除せずに書き換えるので、更新中に小課題が存在しない時間はない。
+    TestCasesテーブルのレコードは(type, title)が同じものを書き換えて、JudgeResultテーブルから
+    参照されているidを保つ。Executables, ArrangedFiles, RequiredFilesテーブルのレコードは置き換える。
+    problem_zip_pathが指定された場合は、ProblemZipPathテーブルへの登録も同じトランザクションで行う。
+    """
+    diff = schemas.ProblemDiff()
+    child_fields = {"executables", "arranged_files", "required_files", "test_cases"}
+    try:
+        # 同じ小課題の更新が同時に行われないように、行ロックを取る
+        current_problem = (
+            db.query(models.Problem)
+            .filter(
+                models.Problem.lecture_id == problem.lecture_id,
+                models.Problem.assignment_id == problem.assignment_id,
+            )
+            .with_for_update()
+            .first()
+        )
+        problem_values = problem.model_dump(exclude=child_fields)
+        if current_problem is None:
+            diff.created = True
+            db.add(models.Problem(**problem_values))
+            # 子テーブルのレコードより先にProblemテーブルのレコードを挿入する
+            db.flush()
+        else:
+            diff.previous_version = current_problem.version
+            for key, value in problem_values.items():
+                current_value = getattr(current_problem, key)
+                if current_value == value:
+                    continue
+                setattr(current_problem, key, value)
+                if key == "description_path" and _package_relative_path(current_value) == _package_relative_path(value):
+                    continue
+                diff.changed_fields.append(key)
+
+        def filter_by_problem(model):
+            return (model.lecture_id == problem.lecture_id, model.assignment_id == problem.assignment_id)
+
+        for model, records in [
+            (models.Executables, problem.executables),
+            (models.ArrangedFiles, problem.arranged_files),
+            (models.RequiredFiles, problem.required_files),
+        ]:
+            db.query(model).filter(*filter_by_problem(model)).delete(synchronize_session=False)
+            db.add_all([model(**record.model_dump(exclude={"id"})) for record in records])
+
+        # (type, title)が同じテストケースを対応させる(同じタイトルが複数ある場合は登録順に対応させる)
+        current_test_cases: dict[tuple[str, str], list[models.TestCases]] = {}
+        for test_case in (
+            db.query(models.TestCases)
+            .filter(*filter_by_problem(models.TestCases))
+            .order_by(models.TestCases.id)
+        ):
+            current_test_cases.setdefault((test_case.type, test_case.title), []).append(test_case)
+
+        for test_case in problem.test_cases:
+            values = test_case.model_dump(exclude={"id"})
+            candidates = current_test_cases.get((values["type"], values["title"]))
+            if not candidates:
+                db.add(models.TestCases(**values))
+                diff.added_test_cases.append(test_case.title)
+                continue
+            current_test_case = candidates.pop(0)
+            changed = False
+            for key, value in values.items():
+                current_value = getattr(current_test_case, key)
+                if current_value == value:
+                    continue
+                setattr(current_test_case, key, value)
+                if key.endswith("_path") and _package_relative_path(current_value) == _package_relative_path(value):
+                    continue
+                changed = True
+            if changed:
+                diff.changed_test_cases.append(test_case.title)
+
+        for candidates in current_test_cases.values():
+            for current_test_case in candidates:
+                db.delete(current_test_case)
+                diff.removed_test_cases.append(current_test_case.title)
+
+        if problem_zip_path is not None:
+            db.add(models.ProblemZipPath(**problem_zip_path.model_dump(exclude={"id", "ts"})))
+
+        catalog.bump_catalog_version(db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    catalog.catalog_cache.invalidate()
+    return diff
+
+
 def get_problem_zip_paths(db: Session, lecture_id: int, assignment_id: int) -> List[schemas.ProblemZipPath]:
     """
     特定の授業の特定の課題に紐づくZIPファイルのパスを取得する
@@ -138,7 +218,9 @@ def delete_lecture(db: Session, lecture_id: int) -> None:
     および、それを親とするその他全てのテーブルのレコードを削除する
     """
     db.query(models.Lecture).filter(models.Lecture.id == lecture_id).delete()
+    catalog.bump_catalog_version(db)
     db.commit()
+    catalog.catalog_cache.invalidate()
 
 
 def delete_problem(db: Session, lecture_id: int, assignment_id: int) -> None:
@@ -150,7 +232,9 @@ def delete_problem(db: Session, lecture_id: int, assignment_id: int) -> None:
         models.Problem.lecture_id == lecture_id,
         models.Problem.assignment_id == assignment_id
     ).delete()
+    catalog.bump_catalog_version(db)
     db.commit()
+    catalog.catalog_cache.invalidate()
 
 
 def get_problem(
@@ -161,7 +245,16 @@ def get_problem(
     
     detailがTrueの場合、ネスト情報も全て読み込む
     evalがTrueの場合、採点用のリソースも全て含める
+    カタログのキャッシュから返す(ネスト情報を含む場合も、初めて読まれたときにキャッシュする)。
     """
+    snapshot = catalog.catalog_cache.get(db)
+    if not detail:
+        return snapshot.problems.get((lecture_id, assignment_id))
+
+    detail_key = (lecture_id, assignment_id, eval)
+    if detail_key in snapshot.problem_details:
+        return snapshot.problem_details[detail_key]
+
     problem = (
         db.query(models.Problem)
         .filter(
@@ -175,33 +268,23 @@ def get_problem(
         return None
     
     # ネスト情報も全て読み込む
-    problem_record = None
-    if detail:
-        problem_record = schemas.Problem.model_validate(problem)
-        if eval is False:
-            # 採点用のリソースをフィルタリングする
-            problem_record.executables = [
-                executable for executable in problem_record.executables
-                if executable.eval is False
-            ]
-            problem_record.arranged_files = [
-                arranged_file for arranged_file in problem_record.arranged_files
-                if arranged_file.eval is False
-            ]
-            problem_record.test_cases = [
-                test_case for test_case in problem_record.test_cases
-                if test_case.eval is False
-            ]
-    else:
-        problem_record = schemas.Problem(
-            lecture_id=problem.lecture_id,
-            assignment_id=problem.assignment_id,
-            title=problem.title,
-            description_path=problem.description_path,
-            timeMS=problem.timeMS,
-            memoryMB=problem.memoryMB,
-        )
+    problem_record = schemas.Problem.model_validate(problem)
+    if eval is False:
+        # 採点用のリソースをフィルタリングする
+        problem_record.executables = [
+            executable for executable in problem_record.executables
+            if executable.eval is False
+        ]
+        problem_record.arranged_files = [
+            arranged_file for arranged_file in problem_record.arranged_files
+            if arranged_file.eval is False
+        ]
+        problem_record.test_cases = [
+            test_case for test_case in problem_record.test_cases
+            if test_case.eval is False
+        ]
 
+    snapshot.problem_details[detail_key] = problem_record
     return problem_record
 
 
@@ -230,10 +313,13 @@ def register_submission(
     lecture_id: int,
     assignment_id: int,
     eval: bool,
-    upload_dir: str
+    upload_dir: str,
+    commit: bool = True,
 ) -> schemas.Submission:
     """
     ジャッジリクエストをSubmissionテーブルに登録する関数
+    
+    commitがFalseの場合はflushのみ行い(IDとtsは確定する)、コミットは呼び出し元に任せる
     """
     new_submission = models.Submission(
         evaluation_status_id=evaluation_status_id,
@@ -244,7 +330,10 @@ def register_submission(
         upload_dir=upload_dir,
     )
     db.add(new_submission)
-    db.commit()
+    if commit:
+        db.commit()
+    else:
+        db.flush()
     db.refresh(new_submission)
     return schemas.Submission.model_validate(new_submission)
 
@@ -281,6 +370,13 @@ def get_submission(db: Session, submission_id: int, detail: bool = False) -> sch
             score=submission.score,
             timeMS=submission.timeMS,
             memoryKB=submission.memoryKB,
+            priority=submission.priority,
+            started_at=submission.started_at,
+            finished_at=submission.finished_at,
+            cache_key=submission.cache_key,
+            heartbeat_at=submission.heartbeat_at,
+            retry_count=submission.retry_count,
+            claim_token=submission.claim_token,
         )
     
     return submission_record
@@ -294,6 +390,93 @@ def modify_submission(db: Session, submission: schemas.Submission) -> None:
         models.Submission.id == submission.id
     ).update(submission.model_dump(exclude={"judge_results", "problem"}))
     db.commit()
+    if submission.evaluation_status_id is not None and submission.progress == schemas.SubmissionProgressStatus.DONE:
+        finish_completed_batch_submissions(db, [submission.id])
+
+
+def get_cached_submission(db: Session, cache_key: str) -> schemas.Submission | None:
+    """
+    同じキャッシュキーを持つ、ジャッジが完了した提出エントリのうち最新のものを取得する関数
+    
+    IE(Internal Error)の結果は一時的な障害の可能性があるため、キャッシュとして扱わない
+    """
+    submission = (
+        db.query(models.Submission)
+        .filter(
+            models.Submission.cache_key == cache_key,
+            models.Submission.progress == schemas.SubmissionProgressStatus.DONE.value,
+            models.Submission.result.isnot(None),
+            models.Submission.result != schemas.SubmissionSummaryStatus.IE.value,
+        )
+        .order_by(desc(models.Submission.id))
+        .first()
+    )
+    
+    if submission is None:
+        return None
+    
+    return get_submission(db, submission.id)
+
+
+def complete_submission_from_cache(
+    db: Session, submission: schemas.Submission, cached_submission: schemas.Submission
+) -> schemas.Submission:
+    """
+    キャッシュされた提出エントリのジャッジ結果をコピーして、提出エントリをジャッジ完了にする関数
+    
+    JudgeResultはINSERT ... SELECTで一括してコピーする
+    """
+    judge_result_columns = [
+        "testcase_id", "result", "command", "timeMS", "memoryKB", "exit_code", "stdout", "stderr"
+    ]
+    db.execute(
+        insert(models.JudgeResult).from_select(
+            ["submission_id", *judge_result_columns],
+            select(
+                literal(submission.id),
+                *[getattr(models.JudgeResult, column) for column in judge_result_columns]
+            ).where(models.JudgeResult.submission_id == cached_submission.id)
+        )
+    )
+    
+    submission.progress = schemas.SubmissionProgressStatus.DONE
+    submission.total_task = cached_submission.total_task
+    submission.completed_task = cached_submission.completed_task
+    submission.result = cached_submission.result
+    submission.message = cached_submission.message
+    submission.detail = cached_submission.detail
+    submission.score = cached_submission.score
+    submission.timeMS = cached_submission.timeMS
+    submission.memoryKB = cached_submission.memoryKB
+    
+    db.query(models.Submission).filter(
+        models.Submission.id == submission.id
+    ).update(submission.model_dump(exclude={"judge_results", "problem"}))
+    db.commit()
+    if submission.evaluation_status_id is not None:
+        finish_completed_batch_submissions(db, [submission.id])
+    return submission
+
+
+def count_inflight_submissions(db: Session, user_id: str) -> int:
+    """
+    ユーザの未完了(pending, queued, running)の提出エントリの数を取得する関数
+    
+    バッチ採点に紐づく提出は、採点者によるものなので数えない
+    """
+    return (
+        db.query(models.Submission)
+        .filter(
+            models.Submission.user_id == user_id,
+            models.Submission.evaluation_status_id.is_(None),
+            models.Submission.progress.in_([
+                schemas.SubmissionProgressStatus.PENDING.value,
+                schemas.SubmissionProgressStatus.QUEUED.value,
+                schemas.SubmissionProgressStatus.RUNNING.value,
+            ]),
+        )
+        .count()
+    )
 
 
 def register_uploaded_dir(db: Session, submission_id: int, upload_dir: str) -> None:
@@ -307,12 +490,19 @@ def register_uploaded_dir(db: Session, submission_id: int, upload_dir: str) -> N
 
 
 def register_batch_submission(
-    db: Session, user_id: str, lecture_id: int
+    db: Session,
+    user_id: str,
+    lecture_id: int,
+    phase: schemas.BatchSubmissionPhase = schemas.BatchSubmissionPhase.JUDGING,
 ) -> schemas.BatchSubmission:
     """
     バッチ提出をBatchSubmissionテーブルに登録する関数
+
+    取り込み中(ingesting)として登録する場合は、取り込みのリース(heartbeat_at)も設定する
     """
-    new_batch_submission = models.BatchSubmission(user_id=user_id, lecture_id=lecture_id)
+    new_batch_submission = models.BatchSubmission(user_id=user_id, lecture_id=lecture_id, phase=phase.value)
+    if phase == schemas.BatchSubmissionPhase.INGESTING:
+        new_batch_submission.heartbeat_at = func.now()
     db.add(new_batch_submission)
     db.commit()
     db.refresh(new_batch_submission)
@@ -332,7 +522,7 @@ def get_submission_list(
     all_users: bool = False,
     user: str | None = None,
     result: Literal["AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN", "WJ"] | None = None
-) -> List[schemas.Submission]:
+) -> List[response.Submission]:
     """
     全ての提出の進捗状況を取得する関数
     
@@ -344,6 +534,8 @@ def get_submission_list(
     all_usersがTrueの場合、自身だけでなく全てのユーザの提出を対象とする
     userはuser_idまたはusernameの部分一致検索
     resultは提出結果の条件、"WJ"(Wait Judge)は未評価の提出を表す
+    
+    各テストケースの結果(judge_results)は含めない
     """
     # SubmissionテーブルとLectureテーブルをjoinさせる。
     submission_query = db.query(models.Submission, models.Lecture).join(
@@ -396,23 +588,9 @@ def get_submission_list(
     # limitとoffsetを設定
     submission_query = submission_query.limit(limit).offset(offset)
 
-    # クエリを実行して、SubmissionレコードとLectureレコードのタプルのリストから、Submissionレコードのリストを取得
-    query_result = submission_query.all()
-    
-    submission_list = [submission for (submission, _) in query_result]
-
-    submission_record_list = [
-        schemas.Submission.model_validate(
-            {
-                **{key: getattr(submission, key) for key in submission.__table__.columns.keys()
-                   if key not in {"problem", "judge_results"}
-                }
-            }
-        )
-        for submission in submission_list
-    ]
-
-    return submission_record_list
+    # クエリを実行して、SubmissionレコードとLectureレコードのタプルのリストから、
+    # レスポンスの提出エントリを直接組み立てる
+    return [mapping.submission(submission) for (submission, _) in submission_query.all()]
 
 
 def get_batch_submission_status(
@@ -444,94 +622,241 @@ def get_batch_submission_status(
         return batch_submission_record
     
     # 進行中の場合、complete_judgeとtotal_judgeを更新する
-    complete_judge = (
-        db.query(models.BatchSubmission, models.EvaluationStatus, models.Submission)
-        .join(
-            models.EvaluationStatus,
-            models.BatchSubmission.id == models.EvaluationStatus.batch_id
-        )
-        .join(
-            models.Submission,
-            models.EvaluationStatus.id == models.Submission.evaluation_status_id
-        )
-        .filter(
-            models.BatchSubmission.id == batch_id,
-            models.Submission.progress == schemas.SubmissionProgressStatus.DONE.value
-        )
-        .count()
+    # (ジャッジが完了していた場合は、学生ごとの結果も集計される)
+    progress = refresh_batch_submission_progress(db, batch_id)
+    if progress is not None:
+        batch_submission_record.complete_judge, batch_submission_record.total_judge = progress
+    return batch_submission_record
+
+
+def _judge_status_rank(column):
+    """
+    ジャッジ結果の文字列を、JudgeStatusOrderの順位(ACが最小)に変換するSQL式を返す
+    """
+    return case(schemas.JudgeStatusOrder, value=column)
+
+
+def _evaluation_status_query(
+    batch_id: int,
+    status: Literal["submitted", "delay", "non-submitted"] | None = None,
+    result: Literal["AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN"] | None = None,
+    user: str | None = None,
+):
+    """
+    バッチ採点の学生ごとの採点結果と、学生のユーザ名を取得するクエリを返す
+    """
+    query = (
+        select(models.EvaluationStatus, models.Users.username)
+        .outerjoin(models.Users, models.Users.user_id == models.EvaluationStatus.user_id)
+        .where(models.EvaluationStatus.batch_id == batch_id)
     )
-    
-    total_judge = (
-        db.query(models.BatchSubmission, models.EvaluationStatus, models.Submission)
-        .join(
-            models.EvaluationStatus,
-            models.BatchSubmission.id == models.EvaluationStatus.batch_id
+    if status is not None:
+        query = query.where(models.EvaluationStatus.status == status)
+    if result is not None:
+        query = query.where(models.EvaluationStatus.result == result)
+    if user is not None:
+        query = query.where(
+            or_(
+                models.EvaluationStatus.user_id.ilike(f"%{user}%"),
+                models.Users.username.ilike(f"%{user}%"),
+            )
         )
-        .join(
-            models.Submission,
-            models.EvaluationStatus.id == models.Submission.evaluation_status_id
+    return query
+
+
+def _evaluation_status_items(
+    db: Session, rows, lecture: response.Lecture
+) -> List[response.EvaluationStatus]:
+    """
+    (EvaluationStatus, username)の行から、提出エントリを含むレスポンスの採点結果を組み立てる
+
+    提出エントリは、渡された学生の分だけを1回のクエリで読み込む。
+    """
+    submissions_by_status: dict[int, List[response.Submission]] = {row[0].id: [] for row in rows}
+    if len(submissions_by_status) > 0:
+        submissions = db.scalars(
+            select(models.Submission)
+            .where(models.Submission.evaluation_status_id.in_(list(submissions_by_status)))
+            .order_by(models.Submission.id)
         )
-        .filter(
-            models.BatchSubmission.id == batch_id
+        for submission in submissions:
+            submissions_by_status[submission.evaluation_status_id].append(mapping.submission(submission))
+
+    return [
+        mapping.evaluation_status(
+            evaluation_status,
+            username=username if username is not None else "不明",
+            lecture=lecture,
+            submissions=submissions_by_status[evaluation_status.id],
         )
-        .count()
+        for evaluation_status, username in rows
+    ]
+
+
+def count_evaluation_statuses(
+    db: Session,
+    batch_id: int,
+    status: Literal["submitted", "delay", "non-submitted"] | None = None,
+    result: Literal["AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN"] | None = None,
+    user: str | None = None,
+) -> int:
+    """
+    条件に一致する、バッチ採点の学生ごとの採点結果の数を返す関数
+    """
+    query = _evaluation_status_query(batch_id, status=status, result=result, user=user)
+    return db.scalar(select(func.count()).select_from(query.subquery()))
+
+
+def get_evaluation_status_page(
+    db: Session,
+    batch_id: int,
+    lecture: response.Lecture,
+    limit: int | None = None,
+    offset: int = 0,
+    sort_by: Literal["user_id", "username", "status", "result", "submit_date"] = "user_id",
+    sort_order: Literal["asc", "desc"] = "asc",
+    status: Literal["submitted", "delay", "non-submitted"] | None = None,
+    result: Literal["AC", "WA", "TLE", "MLE", "RE", "CE", "OLE", "IE", "FN"] | None = None,
+    user: str | None = None,
+) -> Tuple[List[response.EvaluationStatus], int]:
+    """
+    バッチ採点の学生ごとの採点結果を、ページ単位で取得する関数
+
+    返り値は(採点結果のリスト, 条件に一致する採点結果の総数)
+    limitがNoneの場合は、offset以降の全ての採点結果を返す
+    statusとresultはEvaluationStatusの条件、userはuser_idまたはusernameの部分一致検索
+    sort_byが"result"の場合は、JudgeStatusOrderの順位(ACが最小)でソートする
+    ユーザ名と提出エントリは、返す学生の分だけを読み込む
+    """
+    total_count = count_evaluation_statuses(db, batch_id, status=status, result=result, user=user)
+
+    query = _evaluation_status_query(batch_id, status=status, result=result, user=user)
+    sort_column = {
+        "user_id": models.EvaluationStatus.user_id,
+        "username": models.Users.username,
+        "status": models.EvaluationStatus.status,
+        "result": _judge_status_rank(models.EvaluationStatus.result),
+        "submit_date": models.EvaluationStatus.submit_date,
+    }[sort_by]
+    direction = desc if sort_order == "desc" else asc
+    # 同じ値の行の順序をページ間で固定するため、idでもソートする
+    query = query.order_by(direction(sort_column), direction(models.EvaluationStatus.id))
+    if limit is not None:
+        query = query.limit(limit)
+    if offset > 0:
+        query = query.offset(offset)
+
+    rows = db.execute(query).all()
+    return _evaluation_status_items(db, rows, lecture), total_count
+
+
+def aggregate_evaluation_results(db: Session, batch_id: int) -> None:
+    """
+    バッチ採点の学生ごとの結果(EvaluationStatus.result)を、提出エントリの結果から集計する関数
+
+    各学生の提出のresultのうち、JudgeStatusOrderの順位が最も大きいもの(最も重大なもの)を結果とする。
+    学生ごとに最大の順位を求める導出表とJOINした、1つのUPDATE文で全ての学生の結果を更新する(コミットはしない)。
+    提出が無い学生の結果はNone(NULL)のまま。
+    """
+    worst_ranks = (
+        select(
+            models.Submission.evaluation_status_id.label("evaluation_status_id"),
+            func.max(_judge_status_rank(models.Submission.result)).label("rank"),
+        )
+        .join(models.EvaluationStatus, models.EvaluationStatus.id == models.Submission.evaluation_status_id)
+        .where(models.EvaluationStatus.batch_id == batch_id)
+        .group_by(models.Submission.evaluation_status_id)
+        .subquery()
+    )
+    result_of_rank = {rank: value for value, rank in schemas.JudgeStatusOrder.items()}
+    db.execute(
+        update(models.EvaluationStatus)
+        .where(models.EvaluationStatus.id == worst_ranks.c.evaluation_status_id)
+        .values(result=case(result_of_rank, value=worst_ranks.c.rank))
+        .execution_options(synchronize_session=False)
     )
-    
-    batch_submission_record.complete_judge = complete_judge
-    batch_submission_record.total_judge = total_judge
-    
-    modify_batch_submission(db=db, batch_submission_record=batch_submission_record)
-    return batch_submission_record
 
 
-def get_batch_submission_detail(
-    db: Session, batch_id: int
-) -> schemas.BatchSubmission | None:
+def refresh_batch_submission_progress(db: Session, batch_id: int) -> Tuple[int, int] | None:
     """
-    特定のバッチ採点の詳細を取得する関数
-    
-    詳細は、BatchSubmissionテーブルのレコードと、その中に紐づくEvaluationStatusテーブルのレコードと、その中に紐づくSubmissionテーブルのレコードを取得する
-    Submissionレコードに紐づくJudgeResultテーブルのレコードは取得しない
+    バッチ採点のcomplete_judgeとtotal_judgeを、提出エントリの進捗状況から数え直して更新する関数
+
+    ジャッジ中(judging)のバッチ採点の全ての提出のジャッジが完了していた場合は、
+    同じトランザクションで学生ごとの結果も集計する(aggregate_evaluation_results)。
+    戻り値は(complete_judge, total_judge)、バッチ採点エントリが存在しない場合はNone
     """
-    batch_submission = (
-        db.query(models.BatchSubmission)
-        .filter(models.BatchSubmission.id == batch_id)
-        .first()
+    # 同じバッチ採点の最後の提出が同時に完了した場合に、数え直しと集計を1つずつ行うため、行ロックを取る
+    phase = db.scalar(
+        select(models.BatchSubmission.phase)
+        .where(models.BatchSubmission.id == batch_id)
+        .with_for_update()
     )
-    
-    if batch_submission is None:
+    if phase is None:
+        db.rollback()
         return None
-    
-    ret = schemas.BatchSubmission.model_validate(
-        {
-            **{key: getattr(batch_submission, key) for key in batch_submission.__table__.columns.keys()
-               if key not in {"evaluation_statuses"}
-            }
-        }
+
+    total_judge, complete_judge = db.execute(
+        select(
+            func.count(models.Submission.id),
+            func.coalesce(
+                func.sum(
+                    case((models.Submission.progress == schemas.SubmissionProgressStatus.DONE.value, 1), else_=0)
+                ),
+                0,
+            ),
+        )
+        .join(models.EvaluationStatus, models.EvaluationStatus.id == models.Submission.evaluation_status_id)
+        .where(models.EvaluationStatus.batch_id == batch_id)
+    ).one()
+
+    db.execute(
+        update(models.BatchSubmission)
+        .where(models.BatchSubmission.id == batch_id)
+        .values(complete_judge=complete_judge, total_judge=total_judge)
     )
-    
-    for evaluation_status in batch_submission.evaluation_statuses:
-        evaluation_status_record = schemas.EvaluationStatus.model_validate(
-            {
-                **{key: getattr(evaluation_status, key) for key in evaluation_status.__table__.columns.keys()
-                   if key not in {"submissions", "batch_submission"}
-                    }
-            }
+    if phase == schemas.BatchSubmissionPhase.JUDGING.value and complete_judge == total_judge:
+        aggregate_evaluation_results(db, batch_id)
+    db.commit()
+    return complete_judge, total_judge
+
+
+def finish_completed_batch_submissions(db: Session, submission_ids: List[int]) -> List[int]:
+    """
+    submission_idsの提出エントリが属するバッチ採点のうち、全ての提出のジャッジが完了したものについて、
+    complete_judgeとtotal_judgeを確定し、学生ごとの結果を集計する関数
+
+    提出エントリをジャッジ完了(done)にしたトランザクションをコミットした後に呼ぶ。
+    ジャッジが完了していない提出が残っているバッチ採点は、何もしない。
+    戻り値は完了したバッチ採点のIDのリスト
+    """
+    if len(submission_ids) == 0:
+        return []
+
+    unfinished_submission = (
+        select(models.Submission.id)
+        .join(models.EvaluationStatus, models.EvaluationStatus.id == models.Submission.evaluation_status_id)
+        .where(
+            models.EvaluationStatus.batch_id == models.BatchSubmission.id,
+            models.Submission.progress != schemas.SubmissionProgressStatus.DONE.value,
         )
-        
-        for submission in evaluation_status.submissions:
-            submission_record = schemas.Submission.model_validate(
-                {
-                    **{key: getattr(submission, key) for key in submission.__table__.columns.keys()
-                       if key not in {"problem", "judge_results"}
-                    }
-                }
-            )
-            evaluation_status_record.submissions.append(submission_record)
-        
-        ret.evaluation_statuses.append(evaluation_status_record)
-    
-    return ret
+        .exists()
+    )
+    completed_batch_ids = db.scalars(
+        select(models.BatchSubmission.id).where(
+            models.BatchSubmission.id.in_(
+                select(models.EvaluationStatus.batch_id)
+                .join(models.Submission, models.Submission.evaluation_status_id == models.EvaluationStatus.id)
+                .where(models.Submission.id.in_(submission_ids))
+            ),
+            models.BatchSubmission.phase == schemas.BatchSubmissionPhase.JUDGING.value,
+            ~unfinished_submission,
+        )
+    ).all()
+    db.commit()
+
+    for batch_id in completed_batch_ids:
+        refresh_batch_submission_progress(db, batch_id)
+    return list(completed_batch_ids)
 
 
 def get_batch_submission_list(
@@ -594,50 +919,7 @@ def get_batch_submission_list(
     for batch_submission in batch_submission_list:
         if (batch_submission.complete_judge is None or batch_submission.total_judge is None) or batch_submission.complete_judge != batch_submission.total_judge:
             # complete_judgeとtotal_judgeを更新する
-            complete_judge = (
-                db.query(models.BatchSubmission, models.EvaluationStatus, models.Submission)
-                .join(
-                    models.EvaluationStatus,
-                    models.BatchSubmission.id == models.EvaluationStatus.batch_id
-                )
-                .join(
-                    models.Submission,
-                    models.EvaluationStatus.id == models.Submission.evaluation_status_id
-                )
-                .filter(
-                    models.BatchSubmission.id == batch_submission.id,
-                    models.Submission.progress == schemas.SubmissionProgressStatus.DONE.value
-                )
-                .count()
-            )
-            
-            total_judge = (
-                db.query(models.BatchSubmission, models.EvaluationStatus, models.Submission)
-                .join(
-                    models.EvaluationStatus,
-                    models.BatchSubmission.id == models.EvaluationStatus.batch_id
-                )
-                .join(
-                    models.Submission,
-                    models.EvaluationStatus.id == models.Submission.evaluation_status_id
-                )
-                .filter(
-                    models.BatchSubmission.id == batch_submission.id
-                )
-                .count()
-            )
-            
-            batch_submission_record = schemas.BatchSubmission.model_validate(
-                {
-                    **{key: getattr(batch_submission, key) for key in batch_submission.__table__.columns.keys()
-                        if key not in {"evaluation_statuses"}
-                    }
-                }
-            )
-            
-            batch_submission_record.complete_judge = complete_judge
-            batch_submission_record.total_judge = total_judge
-            modify_batch_submission(db=db, batch_submission_record=batch_submission_record)
+            refresh_batch_submission_progress(db, batch_submission.id)
         
     result = [
         schemas.BatchSubmission.model_validate(
@@ -674,25 +956,46 @@ def get_arranged_files(
     return [schemas.ArrangedFiles.model_validate(arranged_file) for arranged_file in arranged_files]
 
 
+def get_test_case(
+    db: Session, lecture_id: int, assignment_id: int, testcase_id: int
+) -> schemas.TestCases | None:
+    """
+    特定の小課題の特定のテストケースを取得する関数
+    """
+    test_case = db.query(models.TestCases).filter(
+        models.TestCases.id == testcase_id,
+        models.TestCases.lecture_id == lecture_id,
+        models.TestCases.assignment_id == assignment_id
+    ).first()
+    return schemas.TestCases.model_validate(test_case) if test_case is not None else None
+
+
 def register_evaluation_status(
-    db: Session, evaluation_status_record: schemas.EvaluationStatus
+    db: Session, evaluation_status_record: schemas.EvaluationStatus, commit: bool = True
 ) -> schemas.EvaluationStatus:
     """
     バッチ採点のジャッジ結果をBatchSubmissionSummaryテーブルに登録する関数
+    
+    commitがFalseの場合はflushのみ行い(IDは確定する)、コミットは呼び出し元に任せる
     """
     # idは自動採番されるので、モデルに渡さない
     new_evaluation_status = models.EvaluationStatus(**evaluation_status_record.model_dump(exclude={"id", "batch_submission", "submissions"}))
     db.add(new_evaluation_status)
-    db.commit()
+    if commit:
+        db.commit()
+    else:
+        db.flush()
     db.refresh(new_evaluation_status)
     return schemas.EvaluationStatus.model_validate(new_evaluation_status)
 
 
 def update_evaluation_status(
-    db: Session, evaluation_status_record: schemas.EvaluationStatus
+    db: Session, evaluation_status_record: schemas.EvaluationStatus, commit: bool = True
 ) -> None:
     """
     バッチ採点のジャッジ結果をEvaluationStatusテーブルに更新する関数
+    
+    commitがFalseの場合は、コミットは呼び出し元に任せる
     """
     db.query(models.EvaluationStatus).filter(
         models.EvaluationStatus.batch_id
@@ -700,19 +1003,125 @@ def update_evaluation_status(
         models.EvaluationStatus.user_id
         == evaluation_status_record.user_id,
     ).update(evaluation_status_record.model_dump(exclude={"batch_submission", "submissions"}))
-    db.commit()
+    if commit:
+        db.commit()
 
 
 def modify_batch_submission(
-    db: Session, batch_submission_record: schemas.BatchSubmission
+    db: Session, batch_submission_record: schemas.BatchSubmission, commit: bool = True
 ) -> None:
     """
     バッチ採点のジャッジ結果をBatchSubmissionテーブルに更新する関数
+    
+    commitがFalseの場合は、コミットは呼び出し元に任せる
     """
+    values = batch_submission_record.model_dump(exclude={"evaluation_statuses"})
+    values["phase"] = batch_submission_record.phase.value
     db.query(models.BatchSubmission).filter(
         models.BatchSubmission.id == batch_submission_record.id
-    ).update(batch_submission_record.model_dump(exclude={"evaluation_statuses"}))
+    ).update(values)
+    if commit:
+        db.commit()
+
+
+def update_batch_submission_phase(
+    db: Session,
+    batch_id: int,
+    phase: schemas.BatchSubmissionPhase,
+    message: str | None = None,
+) -> None:
+    """
+    バッチ採点の段階(取り込み中、ジャッジ中、取り込み失敗)を更新する関数
+    """
+    values = {"phase": phase.value}
+    if message is not None:
+        values["message"] = message
+    db.query(models.BatchSubmission).filter(models.BatchSubmission.id == batch_id).update(
+        values, synchronize_session=False
+    )
+    db.commit()
+
+
+def lock_ingesting_batch_submission(db: Session, batch_id: int) -> bool:
+    """
+    取り込み中のバッチ採点の行ロックを取る関数(コミットまたはロールバックするまで保持する)
+    
+    回収処理(fail_stale_batch_ingestions)はロックされた行を読み飛ばすので、取り込みの登録中に失敗させられることはない。
+    取り込み中(ingesting)でない場合(リースが切れて既に失敗させられた場合など)はFalseを返す
+    """
+    phase = db.scalar(
+        select(models.BatchSubmission.phase)
+        .where(models.BatchSubmission.id == batch_id)
+        .with_for_update()
+    )
+    return phase == schemas.BatchSubmissionPhase.INGESTING.value
+
+
+def fail_batch_ingestion(db: Session, batch_id: int, message: str) -> bool:
+    """
+    取り込み中(ingesting)のバッチ採点を失敗(failed)させる関数
+    
+    既に取り込みが完了している(judging)場合などは何もせずにFalseを返す
+    """
+    updated = db.query(models.BatchSubmission).filter(
+        models.BatchSubmission.id == batch_id,
+        models.BatchSubmission.phase == schemas.BatchSubmissionPhase.INGESTING.value,
+    ).update(
+        {"phase": schemas.BatchSubmissionPhase.FAILED.value, "message": message[:255]},
+        synchronize_session=False,
+    )
     db.commit()
+    return updated > 0
+
+
+def renew_batch_ingestion_leases(db: Session, batch_ids: List[int]) -> None:
+    """
+    取り込み中のバッチ採点のリース(heartbeat_at)を更新する関数
+    """
+    if len(batch_ids) == 0:
+        return
+    db.query(models.BatchSubmission).filter(
+        models.BatchSubmission.id.in_(batch_ids),
+        models.BatchSubmission.phase == schemas.BatchSubmissionPhase.INGESTING.value,
+    ).update({"heartbeat_at": func.now()}, synchronize_session=False)
+    db.commit()
+
+
+def fail_stale_batch_ingestions(db: Session, lease_seconds: float) -> List[Tuple[int, datetime]]:
+    """
+    取り込み中のまま、リース(heartbeat_at)がlease_seconds秒以上更新されていないバッチ採点を失敗させる関数
+    
+    取り込みを実行していたプロセスが停止した(再起動やシャットダウンで中断された)ものとみなす。
+    取り込みは途中までの結果をコミットしないので、phaseとmessageを更新するだけでよい。
+    戻り値は失敗させたバッチ採点の(ID, ts)のリスト(アップロードされたファイルの削除に使う)
+    """
+    now = get_db_current_time(db)
+    stale_batches = db.execute(
+        select(models.BatchSubmission.id, models.BatchSubmission.ts)
+        .where(
+            models.BatchSubmission.phase == schemas.BatchSubmissionPhase.INGESTING.value,
+            or_(
+                models.BatchSubmission.heartbeat_at.is_(None),
+                models.BatchSubmission.heartbeat_at < now - timedelta(seconds=lease_seconds),
+            ),
+        )
+        .order_by(models.BatchSubmission.id)
+        # 他のプロセスの回収処理と競合しないように行ロックを取る
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    if len(stale_batches) > 0:
+        db.query(models.BatchSubmission).filter(
+            models.BatchSubmission.id.in_([batch_id for batch_id, _ in stale_batches])
+        ).update(
+            {
+                "phase": schemas.BatchSubmissionPhase.FAILED.value,
+                "message": "取り込み中にサーバが停止したため、取り込みを中断しました。再度アップロードしてください",
+            },
+            synchronize_session=False,
+        )
+    db.commit()
+    return [(batch_id, ts) for batch_id, ts in stale_batches]
 
 
 def get_evaluation_status(
@@ -752,10 +1161,12 @@ def get_evaluation_status_detail(
 
 
 def modify_all_submission_statuses_of_batch_submission(
-    db: Session, batch_id: int, status: schemas.SubmissionProgressStatus
+    db: Session, batch_id: int, status: schemas.SubmissionProgressStatus, commit: bool = True
 ) -> None:
     """
     特定のバッチ採点の全ての提出の進捗状況を更新する関数
+    
+    commitがFalseの場合は、コミットは呼び出し元に任せる
     """
     # 更新対象のSubmissionのIDを取得
     subquery = select(models.Submission.id).join(
@@ -776,4 +1187,575 @@ def modify_all_submission_statuses_of_batch_submission(
         synchronize_session=False
     )
     
+    if commit:
+        db.commit()
+
+
+def _seconds_between(db: Session, start_column, end_column):
+    """
+    2つのDATETIMEカラムの差(秒)を計算するSQL式を返す
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        return (func.julianday(end_column) - func.julianday(start_column)) * 86400
+    return func.timestampdiff(literal_column("SECOND"), start_column, end_column)
+
+
+def _submission_priority_class():
+    """
+    提出エントリの優先度クラスを表すSQL式を返す
+    
+    rejudge: 一括再ジャッジされた提出(priorityが負), batch: バッチ採点に紐づく提出, single: 学生による提出
+    """
+    return case(
+        (models.Submission.priority < 0, "rejudge"),
+        (models.Submission.evaluation_status_id.is_(None), "single"),
+        else_="batch",
+    )
+
+
+def get_submission_progress_counts(db: Session) -> List[Tuple[str, str, int]]:
+    """
+    未完了(pending, queued, running)の提出エントリの数を、進捗状況と優先度クラスごとに集計する関数
+    
+    (進捗状況, 優先度クラス, 件数)のリストを返す
+    """
+    priority_class = _submission_priority_class()
+    return [
+        (progress, priority, count)
+        for progress, priority, count in (
+            db.query(models.Submission.progress, priority_class, func.count())
+            .filter(
+                models.Submission.progress.in_([
+                    schemas.SubmissionProgressStatus.PENDING.value,
+                    schemas.SubmissionProgressStatus.QUEUED.value,
+                    schemas.SubmissionProgressStatus.RUNNING.value,
+                ])
+            )
+            .group_by(models.Submission.progress, priority_class)
+            .all()
+        )
+    ]
+
+
+def _get_duration_histogram(
+    db: Session, start_column, end_column, buckets: List[float], since: datetime
+) -> Tuple[List[int], float, int]:
+    """
+    start_columnからend_columnまでの秒数のヒストグラムを集計する関数
+
+    end_columnがsince以降の提出エントリだけを集計する(end_columnのインデックスで範囲を絞る)。
+    (各バケット以下の累積件数のリスト, 秒数の合計, 件数)を返す
+    """
+    seconds = _seconds_between(db, start_column, end_column)
+    row = (
+        db.query(
+            *[func.sum(case((seconds <= bucket, 1), else_=0)) for bucket in buckets],
+            func.sum(seconds),
+            func.count(),
+        )
+        .filter(end_column >= since, start_column.isnot(None))
+        .one()
+    )
+    return [int(value or 0) for value in row[:-2]], float(row[-2] or 0), int(row[-1])
+
+
+def get_queue_wait_histogram(db: Session, buckets: List[float], since: datetime) -> Tuple[List[int], float, int]:
+    """
+    since以降にジャッジを開始した提出エントリについて、
+    提出(ts)からジャッジ開始(started_at)までの待ち時間のヒストグラムを集計する関数
+    """
+    return _get_duration_histogram(db, models.Submission.ts, models.Submission.started_at, buckets, since)
+
+
+def get_judge_duration_histogram(db: Session, buckets: List[float], since: datetime) -> Tuple[List[int], float, int]:
+    """
+    since以降にジャッジが完了した提出エントリについて、
+    ジャッジ開始(started_at)から完了(finished_at)までのジャッジ時間のヒストグラムを集計する関数
+    """
+    return _get_duration_histogram(db, models.Submission.started_at, models.Submission.finished_at, buckets, since)
+
+
+def get_db_current_time(db: Session) -> datetime:
+    """
+    DBサーバの現在時刻を取得する関数
+    
+    tsやstarted_atなどはDBのCURRENT_TIMESTAMPで設定されるので、比較にはDBの時刻を使う
+    """
+    return db.scalar(select(func.now()))
+
+
+def count_submissions_finished_since(db: Session, since: datetime) -> int:
+    """
+    since以降にジャッジが完了した提出エントリの数を取得する関数
+    """
+    return (
+        db.query(models.Submission)
+        .filter(models.Submission.finished_at >= since)
+        .count()
+    )
+
+
+def get_oldest_queued_ts(db: Session) -> datetime | None:
+    """
+    キューに積まれている提出エントリのうち、最も古いもののtsを取得する関数
+    """
+    return db.scalar(
+        select(func.min(models.Submission.ts)).where(
+            models.Submission.progress == schemas.SubmissionProgressStatus.QUEUED.value
+        )
+    )
+
+
+def get_queue_position(db: Session, submission_id: int) -> int | None:
+    """
+    キューに積まれている提出エントリのうち、指定した提出エントリより先に取り出されるものの数を取得する関数
+    
+    ジャッジワーカーと同じ(priority DESC, id ASC)の順で数える。
+    指定した提出エントリがキューに積まれていない場合はNoneを返す。
+    """
+    priority = db.scalar(
+        select(models.Submission.priority).where(
+            models.Submission.id == submission_id,
+            models.Submission.progress == schemas.SubmissionProgressStatus.QUEUED.value,
+        )
+    )
+    if priority is None:
+        return None
+    return (
+        db.query(models.Submission)
+        .filter(
+            models.Submission.progress == schemas.SubmissionProgressStatus.QUEUED.value,
+            or_(
+                models.Submission.priority > priority,
+                and_(models.Submission.priority == priority, models.Submission.id < submission_id),
+            ),
+        )
+        .count()
+    )
+
+
+def register_rejudge_request(db: Session, rejudge_request: schemas.RejudgeRequest) -> schemas.RejudgeRequest:
+    """
+    一括再ジャッジのリクエストをRejudgeRequestテーブルに登録する関数
+    """
+    new_rejudge_request = models.RejudgeRequest(
+        **rejudge_request.model_dump(exclude={"id", "ts", "result", "progress"}),
+        result=rejudge_request.result.value if rejudge_request.result is not None else None,
+        progress=rejudge_request.progress.value,
+    )
+    db.add(new_rejudge_request)
+    db.commit()
+    db.refresh(new_rejudge_request)
+    return schemas.RejudgeRequest.model_validate(new_rejudge_request)
+
+
+def get_rejudge_request(db: Session, rejudge_id: int) -> schemas.RejudgeRequest | None:
+    """
+    一括再ジャッジのリクエストを取得する関数
+    """
+    rejudge_request = db.query(models.RejudgeRequest).filter(models.RejudgeRequest.id == rejudge_id).first()
+    return schemas.RejudgeRequest.model_validate(rejudge_request) if rejudge_request is not None else None
+
+
+def update_rejudge_request_progress(
+    db: Session,
+    rejudge_id: int,
+    progress: schemas.RejudgeProgressStatus,
+    processed_increment: int = 0,
+    message: str | None = None,
+) -> None:
+    """
+    一括再ジャッジのリクエストの進捗状況を更新する関数
+    """
+    values = {
+        "progress": progress.value,
+        "processed": models.RejudgeRequest.processed + processed_increment,
+    }
+    if message is not None:
+        values["message"] = message
+    db.query(models.RejudgeRequest).filter(models.RejudgeRequest.id == rejudge_id).update(
+        values, synchronize_session=False
+    )
+    db.commit()
+
+
+def _rejudge_target_query(db: Session, rejudge_request: schemas.RejudgeRequest):
+    """
+    一括再ジャッジの対象となる(ジャッジが完了した)提出エントリのIDを取得するクエリを返す
+    """
+    query = db.query(models.Submission.id).filter(
+        models.Submission.lecture_id == rejudge_request.lecture_id,
+        models.Submission.progress == schemas.SubmissionProgressStatus.DONE.value,
+    )
+    if rejudge_request.assignment_id is not None:
+        query = query.filter(models.Submission.assignment_id == rejudge_request.assignment_id)
+    if rejudge_request.batch_id is not None:
+        query = query.join(
+            models.EvaluationStatus,
+            models.Submission.evaluation_status_id == models.EvaluationStatus.id,
+        ).filter(models.EvaluationStatus.batch_id == rejudge_request.batch_id)
+    if rejudge_request.result is not None:
+        query = query.filter(models.Submission.result == rejudge_request.result.value)
+    return query
+
+
+def count_rejudge_targets(db: Session, rejudge_request: schemas.RejudgeRequest) -> int:
+    """
+    一括再ジャッジの対象となる提出エントリの数を取得する関数
+    """
+    return _rejudge_target_query(db, rejudge_request).count()
+
+
+def get_rejudge_target_ids(
+    db: Session, rejudge_request: schemas.RejudgeRequest, after_id: int, limit: int
+) -> List[int]:
+    """
+    一括再ジャッジの対象となる提出エントリのIDを、after_idより大きいものからlimit件取得する関数
+    """
+    return [
+        submission_id
+        for (submission_id,) in _rejudge_target_query(db, rejudge_request)
+        .filter(models.Submission.id > after_id)
+        .order_by(asc(models.Submission.id))
+        .limit(limit)
+        .all()
+    ]
+
+
+def requeue_submissions_for_rejudge(db: Session, submission_ids: List[int], priority: int) -> None:
+    """
+    提出エントリのジャッジ結果を削除し、キューに積み直す関数
+    
+    1つのトランザクションでまとめてUPDATE/DELETEする。
+    バッチ採点に紐づく提出の場合、集計済みの結果とジャッジ数を未集計の状態に戻す。
+    """
+    if len(submission_ids) == 0:
+        return
+
+    db.query(models.JudgeResult).filter(
+        models.JudgeResult.submission_id.in_(submission_ids)
+    ).delete(synchronize_session=False)
+
+    evaluation_status_ids = select(models.Submission.evaluation_status_id).where(
+        models.Submission.id.in_(submission_ids),
+        models.Submission.evaluation_status_id.isnot(None),
+    )
+    db.query(models.BatchSubmission).filter(
+        models.BatchSubmission.id.in_(
+            select(models.EvaluationStatus.batch_id).where(
+                models.EvaluationStatus.id.in_(evaluation_status_ids)
+            )
+        )
+    ).update({"complete_judge": None}, synchronize_session=False)
+    db.query(models.EvaluationStatus).filter(
+        models.EvaluationStatus.id.in_(evaluation_status_ids)
+    ).update({"result": None}, synchronize_session=False)
+
+    db.query(models.Submission).filter(
+        models.Submission.id.in_(submission_ids)
+    ).update(
+        {
+            "progress": schemas.SubmissionProgressStatus.QUEUED.value,
+            "priority": priority,
+            "completed_task": 0,
+            "result": None,
+            "message": None,
+            "detail": None,
+            "score": None,
+            "timeMS": None,
+            "memoryKB": None,
+            "started_at": None,
+            "finished_at": None,
+            "heartbeat_at": None,
+            "retry_count": 0,
+            # 古い課題リソースで計算したキャッシュキーなので破棄する
+            "cache_key": None,
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def reap_stuck_submissions(db: Session, grace_seconds: float, max_retries: int) -> tuple[List[int], List[int]]:
+    """
+    running状態のまま停止した提出エントリを、キューに積み直すかIEとして終了させる関数
+    
+    最後に生存が確認された時刻(heartbeat_at、なければstarted_at)から
+    課題の制限時間 x (テストケース数 + 1) + grace_seconds 秒以上経過した提出を停止したとみなす。
+    積み直した回数がmax_retriesに達した提出は、それ以上積み直さずIEとして終了させる。
+    
+    ジャッジワーカーがclaim_queued_submissionsを使わずに直接progressをrunningにした提出は
+    started_atが設定されていないので、最初に見つけたときの時刻をstarted_atとし、そこからの経過時間で判定する。
+    
+    戻り値は(キューに積み直した提出のIDのリスト, IEとして終了させた提出のIDのリスト)
+    """
+    now = get_db_current_time(db)
+    db.query(models.Submission).filter(
+        models.Submission.progress == schemas.SubmissionProgressStatus.RUNNING.value,
+        models.Submission.started_at.is_(None),
+    ).update({"started_at": now}, synchronize_session=False)
+
+    last_seen = func.coalesce(models.Submission.heartbeat_at, models.Submission.started_at)
+    timeout_seconds = models.Problem.timeMS * (models.Submission.total_task + 1) / 1000.0 + grace_seconds
+
+    stuck_submissions = db.execute(
+        select(models.Submission.id, models.Submission.retry_count)
+        .join(
+            models.Problem,
+            and_(
+                models.Submission.lecture_id == models.Problem.lecture_id,
+                models.Submission.assignment_id == models.Problem.assignment_id,
+            ),
+        )
+        # (progress, started_at)のインデックスで候補を絞り込む
+        # タイムアウトは必ずgrace_seconds以上なので、started_atがそれより新しい提出は対象外
+        .where(
+            models.Submission.progress == schemas.SubmissionProgressStatus.RUNNING.value,
+            models.Submission.started_at <= now - timedelta(seconds=grace_seconds),
+            _seconds_between(db, last_seen, literal(now)) > timeout_seconds,
+        )
+        .order_by(models.Submission.id)
+        # ジャッジワーカーや他のプロセスの回収処理と競合しないように行ロックを取る
+        .with_for_update(of=models.Submission, skip_locked=True)
+    ).all()
+
+    requeue_ids = [id for id, retry_count in stuck_submissions if retry_count + 1 < max_retries]
+    fail_ids = [id for id, retry_count in stuck_submissions if retry_count + 1 >= max_retries]
+
+    if len(requeue_ids) > 0:
+        # 途中までのジャッジ結果は破棄してやり直す
+        db.query(models.JudgeResult).filter(
+            models.JudgeResult.submission_id.in_(requeue_ids)
+        ).delete(synchronize_session=False)
+        db.query(models.Submission).filter(
+            models.Submission.id.in_(requeue_ids)
+        ).update(
+            {
+                "progress": schemas.SubmissionProgressStatus.QUEUED.value,
+                "completed_task": 0,
+                "started_at": None,
+                "heartbeat_at": None,
+                "retry_count": models.Submission.retry_count + 1,
+            },
+            synchronize_session=False,
+        )
+
+    if len(fail_ids) > 0:
+        db.query(models.Submission).filter(
+            models.Submission.id.in_(fail_ids)
+        ).update(
+            {
+                "progress": schemas.SubmissionProgressStatus.DONE.value,
+                "result": schemas.SubmissionSummaryStatus.IE.value,
+                "message": f"ジャッジが{max_retries}回停止したため、ジャッジを中断しました",
+                "finished_at": now,
+                "retry_count": models.Submission.retry_count + 1,
+            },
+            synchronize_session=False,
+        )
+
     db.commit()
+    finish_completed_batch_submissions(db, fail_ids)
+    return requeue_ids, fail_ids
+
+
+# 1つのINSERT文でまとめて挿入するJudgeResultの行数の上限
+JUDGE_RESULT_INSERT_CHUNK_SIZE = 500
+
+
+def get_existing_submission_ids(db: Session, submission_ids: List[int]) -> set[int]:
+    """
+    submission_idsのうち、Submissionテーブルに存在するIDの集合を取得する関数
+    """
+    if len(submission_ids) == 0:
+        return set()
+    return set(
+        db.scalars(
+            select(models.Submission.id).where(models.Submission.id.in_(submission_ids))
+        ).all()
+    )
+
+
+# 提出の進捗状況の順位(pending < queued < running < done)
+_PROGRESS_ORDER = {progress.value: i for i, progress in enumerate(schemas.SubmissionProgressStatus)}
+
+
+def _coalesce_progress_updates(updates: List[schemas.SubmissionProgressUpdate]) -> dict[int, dict]:
+    """
+    同じ提出に対する複数の進捗状況の更新を1つにまとめる
+    
+    後の更新の値が優先されるが、progressは先に進んだ状態(pending < queued < running < done)を残す
+    (別のバッチで既にdoneが書き込まれた提出は、running状態ではないのでingest_judge_batchで読み飛ばされる)
+    """
+    merged: dict[int, dict] = {}
+    for progress_update in updates:
+        fields = merged.setdefault(progress_update.submission_id, {})
+        for key, value in progress_update.model_dump(exclude={"submission_id", "claim_token"}, exclude_none=True).items():
+            value = value.value if isinstance(value, (schemas.SubmissionProgressStatus, schemas.SubmissionSummaryStatus)) else value
+            if key == "progress" and "progress" in fields and _PROGRESS_ORDER[fields["progress"]] > _PROGRESS_ORDER[value]:
+                continue
+            fields[key] = value
+    return merged
+
+
+def get_claimed_submission_ids(db: Session, claim_tokens: dict[int, int]) -> set[int]:
+    """
+    claim_tokens(提出のID -> 取り出しトークン)のうち、running状態でトークンが一致する提出のIDの集合を取得する関数
+    
+    積み直しや再ジャッジと競合しないように、一致した行の行ロックを取る
+    """
+    if len(claim_tokens) == 0:
+        return set()
+    rows = db.execute(
+        select(models.Submission.id, models.Submission.claim_token)
+        .where(
+            models.Submission.id.in_(sorted(claim_tokens.keys())),
+            models.Submission.progress == schemas.SubmissionProgressStatus.RUNNING.value,
+        )
+        .with_for_update()
+    ).all()
+    return {id for id, claim_token in rows if claim_tokens[id] == claim_token}
+
+
+def ingest_judge_batch(db: Session, batch: schemas.JudgeIngestBatch) -> Tuple[int, int, List[int]]:
+    """
+    ジャッジワーカーから送られてきたテストケースの実行結果と進捗状況の更新をまとめて書き込む関数
+    
+    * running状態で、claim_tokenが一致する提出に対するものだけを書き込み、それ以外は読み飛ばす
+      (積み直された後や再ジャッジされた後に、以前取り出したワーカーから遅れて届いた結果を書き込まない)
+    * JudgeResultは複数行のINSERT文で挿入する
+    * completed_taskとheartbeat_atは、関係する全ての提出について1つのUPDATE文で更新する
+    * 同じ提出に対する進捗状況の更新は1つにまとめてから書き込む
+    * 全体を1つのトランザクションでコミットする
+    
+    戻り値は(挿入したJudgeResultの数, 更新した提出エントリの数, 読み飛ばした提出エントリのIDのリスト)
+    """
+    now = get_db_current_time(db)
+    claim_tokens = {progress_update.submission_id: progress_update.claim_token for progress_update in batch.submissions}
+    claimed_ids = get_claimed_submission_ids(db, claim_tokens)
+    skipped_ids = sorted(
+        ({judge_result.submission_id for judge_result in batch.judge_results} | set(claim_tokens.keys())) - claimed_ids
+    )
+    progress_updates = {
+        submission_id: fields
+        for submission_id, fields in _coalesce_progress_updates(batch.submissions).items()
+        if submission_id in claimed_ids
+    }
+    judge_results = [judge_result for judge_result in batch.judge_results if judge_result.submission_id in claimed_ids]
+
+    judge_result_rows = [
+        judge_result.model_dump(exclude={"id", "testcase"}) for judge_result in judge_results
+    ]
+    for i in range(0, len(judge_result_rows), JUDGE_RESULT_INSERT_CHUNK_SIZE):
+        db.execute(
+            insert(models.JudgeResult).values(judge_result_rows[i:i + JUDGE_RESULT_INSERT_CHUNK_SIZE])
+        )
+
+    # 以下のUPDATE文は、いずれもrunning状態でclaim_tokenが一致する行のみを対象とする
+    claimed = and_(
+        models.Submission.progress == schemas.SubmissionProgressStatus.RUNNING.value,
+        models.Submission.claim_token == case(claim_tokens, value=models.Submission.id, else_=None),
+    )
+
+    # 完了したテストケース数を加算し、ジャッジワーカーの生存時刻(リース)を更新する
+    completed_counts = Counter(judge_result.submission_id for judge_result in judge_results)
+    submission_ids = sorted(claimed_ids)
+    if len(submission_ids) > 0:
+        completed_task_update = {"heartbeat_at": now}
+        if len(completed_counts) > 0:
+            completed_task_update["completed_task"] = models.Submission.completed_task + case(
+                completed_counts, value=models.Submission.id, else_=0
+            )
+        db.execute(
+            update(models.Submission)
+            .where(models.Submission.id.in_(submission_ids), claimed)
+            .values(completed_task_update)
+        )
+
+    # ジャッジを開始した提出は、最初の1回だけstarted_atを設定する
+    started_ids = [
+        submission_id
+        for submission_id, fields in progress_updates.items()
+        if fields.get("progress") in {schemas.SubmissionProgressStatus.RUNNING.value, schemas.SubmissionProgressStatus.DONE.value}
+    ]
+    if len(started_ids) > 0:
+        db.execute(
+            update(models.Submission)
+            .where(models.Submission.id.in_(started_ids), models.Submission.started_at.is_(None), claimed)
+            .values(started_at=now)
+        )
+
+    # 更新するカラムの組が同じ提出ごとに、主キー指定のexecutemanyでまとめて更新する
+    submission_table = models.Submission.__table__
+    grouped_updates: dict[tuple[str, ...], List[dict]] = {}
+    for submission_id, fields in progress_updates.items():
+        if fields.get("progress") == schemas.SubmissionProgressStatus.DONE.value:
+            fields = {**fields, "finished_at": now}
+        if len(fields) == 0:
+            continue
+        row = {"b_id": submission_id, "b_claim_token": claim_tokens[submission_id], **fields}
+        grouped_updates.setdefault(tuple(sorted(fields.keys())), []).append(row)
+    for keys, rows in grouped_updates.items():
+        db.execute(
+            update(submission_table)
+            .where(
+                submission_table.c.id == bindparam("b_id"),
+                submission_table.c.progress == schemas.SubmissionProgressStatus.RUNNING.value,
+                submission_table.c.claim_token == bindparam("b_claim_token"),
+            )
+            .values({key: bindparam(key) for key in keys}),
+            rows,
+        )
+
+    db.commit()
+
+    # 最後の提出のジャッジが完了したバッチ採点は、学生ごとの結果を集計する
+    finish_completed_batch_submissions(
+        db,
+        [
+            submission_id
+            for submission_id, fields in progress_updates.items()
+            if fields.get("progress") == schemas.SubmissionProgressStatus.DONE.value
+        ],
+    )
+    return len(judge_result_rows), len(submission_ids), skipped_ids
+
+
+def claim_queued_submissions(db: Session, limit: int) -> List[schemas.Submission]:
+    """
+    キューに積まれた提出エントリを最大limit件取り出し、running状態にする関数
+    
+    (priority DESC, id ASC)の順に取り出す。複数のジャッジワーカーが同時に取り出しても
+    同じ提出を重複して取り出さないように、行ロックを取り、ロック済みの行は読み飛ばす。
+    取り出すたびにclaim_tokenを1増やす。ジャッジワーカーは、返された提出エントリのclaim_tokenを
+    ingest_judge_batchに渡す。
+    """
+    now = get_db_current_time(db)
+    submission_ids = db.scalars(
+        select(models.Submission.id)
+        .where(models.Submission.progress == schemas.SubmissionProgressStatus.QUEUED.value)
+        .order_by(models.Submission.priority.desc(), models.Submission.id.asc())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    if len(submission_ids) == 0:
+        db.commit()
+        return []
+
+    db.execute(
+        update(models.Submission)
+        .where(
+            models.Submission.id.in_(submission_ids),
+            models.Submission.progress == schemas.SubmissionProgressStatus.QUEUED.value,
+        )
+        .values(
+            progress=schemas.SubmissionProgressStatus.RUNNING.value,
+            started_at=now,
+            heartbeat_at=now,
+            claim_token=models.Submission.claim_token + 1,
+        )
+    )
+    db.commit()
+
+    return [get_submission(db, submission_id) for submission_id in submission_ids]
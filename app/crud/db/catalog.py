@@ -0,0 +1,143 @@
+from app.classes import schemas
+from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from ...classes import models
+from app import constants
+from dataclasses import dataclass, field
+import threading
+import time
+import logging
+
+"""
+授業エントリ・課題エントリ(カタログ)のプロセス内キャッシュ
+
+授業エントリと課題エントリは、ほぼ全てのリクエスト(採点リクエストを含む)で読まれるが、
+変更されるのは課題データの追加・更新・削除と授業エントリの削除のときだけである。
+そこで、CatalogVersionテーブルの1行(バージョン)をカタログの変更と同じトランザクションで1増やし、
+各uvicorn workerはバージョンが変わったときだけカタログを読み直す。
+バージョンの確認はCATALOG_VERSION_CHECK_INTERVAL_SECONDSに1回だけ行う
+(他のworkerでの変更は、最大でこの秒数だけ遅れて反映される。同じworkerでの変更はすぐに反映される)。
+
+キャッシュから返すschemasのインスタンスは全てのリクエストで共有されるので、呼び出し側で変更しないこと。
+"""
+
+CATALOG_VERSION_ID = 1
+
+
+def get_catalog_version(db: Session) -> int:
+    """
+    カタログのバージョンを取得する(行が無い場合は0)
+    """
+    version = db.scalar(select(models.CatalogVersion.version).where(models.CatalogVersion.id == CATALOG_VERSION_ID))
+    return version if version is not None else 0
+
+
+def ensure_catalog_version(db: Session) -> None:
+    """
+    CatalogVersionテーブルに行が無い場合は作成する(起動時に呼ぶ)
+    """
+    if db.get(models.CatalogVersion, CATALOG_VERSION_ID) is None:
+        db.add(models.CatalogVersion(id=CATALOG_VERSION_ID, version=0))
+        try:
+            db.commit()
+        except IntegrityError:
+            # 他のworkerが同時に作成した場合
+            db.rollback()
+
+
+def bump_catalog_version(db: Session) -> None:
+    """
+    カタログのバージョンを1増やす
+
+    カタログを変更するトランザクションの中で、commitの前に呼ぶこと。
+    commitの後には、catalog_cache.invalidate()を呼んで同じworkerのキャッシュを捨てる。
+    """
+    result = db.execute(
+        update(models.CatalogVersion)
+        .where(models.CatalogVersion.id == CATALOG_VERSION_ID)
+        .values(version=models.CatalogVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        db.add(models.CatalogVersion(id=CATALOG_VERSION_ID, version=1))
+
+
+@dataclass
+class CatalogSnapshot:
+    version: int
+    # lecture_id -> 授業エントリ(problemsは課題エントリのネスト情報を含まない)
+    lectures: dict[int, schemas.Lecture]
+    # (lecture_id, assignment_id) -> 課題エントリ(ネスト情報を含まない)
+    problems: dict[tuple[int, int], schemas.Problem]
+    # (lecture_id, assignment_id, eval) -> 課題エントリ(ネスト情報を含む)。初めて読まれたときに追加する
+    problem_details: dict[tuple[int, int, bool], schemas.Problem] = field(default_factory=dict)
+
+
+def _load_catalog(db: Session, version: int) -> CatalogSnapshot:
+    """
+    全ての授業エントリと課題エントリを読み込む(授業ごとに課題を読み込まず、2回のクエリで読み込む)
+    """
+    problems: dict[tuple[int, int], schemas.Problem] = {}
+    problems_by_lecture: dict[int, list[schemas.Problem]] = {}
+    for problem in db.scalars(select(models.Problem)):
+        problem_record = schemas.Problem(
+            lecture_id=problem.lecture_id,
+            assignment_id=problem.assignment_id,
+            title=problem.title,
+            description_path=problem.description_path,
+            timeMS=problem.timeMS,
+            memoryMB=problem.memoryMB,
+            version=problem.version,
+        )
+        problems[(problem.lecture_id, problem.assignment_id)] = problem_record
+        problems_by_lecture.setdefault(problem.lecture_id, []).append(problem_record)
+
+    lectures = {
+        lecture.id: schemas.Lecture(
+            id=lecture.id,
+            title=lecture.title,
+            start_date=lecture.start_date,
+            end_date=lecture.end_date,
+            problems=problems_by_lecture.get(lecture.id, []),
+        )
+        for lecture in db.scalars(select(models.Lecture))
+    }
+    return CatalogSnapshot(version=version, lectures=lectures, problems=problems)
+
+
+class CatalogCache:
+    def __init__(self, check_interval: float):
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot: CatalogSnapshot | None = None
+        # 最後にバージョンを確認した時刻(time.monotonic())
+        self._checked_at = 0.0
+
+    def get(self, db: Session) -> CatalogSnapshot:
+        """
+        カタログのスナップショットを返す。バージョンが変わっていれば読み直す
+        """
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self._check_interval:
+            return snapshot
+
+        # バージョンを先に読むことで、読み込み中に変更された場合も次の確認で読み直される
+        version = get_catalog_version(db)
+        if snapshot is not None and snapshot.version == version:
+            self._checked_at = now
+            return snapshot
+
+        snapshot = _load_catalog(db, version)
+        with self._lock:
+            self._snapshot = snapshot
+            self._checked_at = now
+        logging.debug(f"Loaded catalog version {version}")
+        return snapshot
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
+
+
+catalog_cache = CatalogCache(constants.CATALOG_VERSION_CHECK_INTERVAL_SECONDS)
@@ -0,0 +1,333 @@
+import io
+import multiprocessing
+import os
+import shutil
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import NamedTuple
+from app import blobstore
+from app import constants
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+"""
+提出されたzipファイルの展開処理
+
+* unfold_zip: 学生が提出したzipファイル(class{lecture_id}.zipなど)を正規化しながら展開する
+* extract_student_archive: manabaから取得したバッチ採点用のzipファイルから、
+  学生一人分の提出を(内側のzipファイルを一時ファイルに書き出さずに)展開する
+
+extract_student_archiveはプロセスプール上で学生ごとに並列に実行されるため、
+DBなどに依存しないようにしている。
+"""
+
+
+# zipファイルのメンバーを展開するときに、一度に読み込むバイト数
+UNFOLD_CHUNK_BYTES = 1024 * 1024
+
+
+def _top_level_name(name: str) -> str:
+    return name.split("/", 1)[0]
+
+
+def _member_path(dest_dir: Path, name: str) -> Path:
+    """
+    zipファイルのメンバー名nameの展開先のパスを返す
+
+    ZipFile.extractと同じく、絶対パスやドライブ名、"."や".."の要素を取り除く
+    """
+    name = os.path.splitdrive(name)[1]
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    return dest_dir.joinpath(*parts)
+
+
+def _extract_member(
+    zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo, dest_dir: Path, name: str, digests: dict[Path, str]
+) -> None:
+    """
+    zipファイルのメンバーを、dest_dir/nameに展開する
+
+    ファイルはアップロード用のストア(upload_store)に直接書き込んで、dest_dir/nameには実体へのハードリンクを置く。
+    展開したファイルの{パス: ハッシュ値}をdigestsに記録する(store_directoryで読み直さないようにする)。
+    """
+    dest_path = _member_path(dest_dir, name)
+    if info.is_dir():
+        dest_path.mkdir(parents=True, exist_ok=True)
+        return
+    if dest_path == dest_dir:
+        return
+    with zip_ref.open(info) as src, blobstore.upload_store.writer() as writer:
+        for chunk in iter(lambda: src.read(UNFOLD_CHUNK_BYTES), b""):
+            writer.write(chunk)
+        digests[dest_path] = writer.commit(dest_path)
+
+
+def _unfold_zip_archive(
+    zip_ref: zipfile.ZipFile, zip_stem: str, dest_dir: Path, digests: dict[Path, str]
+) -> str | None:
+    """
+    開いたzipファイルを、unfold_zipの正規化ルールに従ってdest_dirに展開する
+
+    展開する前にメンバーの一覧から展開先のパスを決めるので、zipファイルは一度だけ読む。
+    """
+    info_list = zip_ref.infolist()
+
+    # zipファイルのエントリ数、展開後の容量が上限を超える場合はエラー
+    if len(info_list) > constants.UNFOLD_MAX_ENTRIES:
+        return f"zipファイルに含まれるファイルの数が{constants.UNFOLD_MAX_ENTRIES}個を超えています。"
+    if sum(info.file_size for info in info_list) > constants.UNFOLD_MAX_TOTAL_BYTES:
+        return f"zipファイルの展開後の容量が{constants.UNFOLD_MAX_TOTAL_BYTES // 1024 // 1024}MBを超えています。"
+
+    # 空の場合
+    if len(info_list) == 0:
+        return "提出ファイルが空です。"
+
+    top_level_names = {_top_level_name(info.filename) for info in info_list}
+    top_level_dirs = {
+        _top_level_name(info.filename) for info in info_list
+        if "/" in info.filename.rstrip("/") or info.is_dir()
+    }
+
+    # 展開時に取り除くフォルダ
+    # * フォルダが一個しかない場合は、そのフォルダの中身をdest_dirに配置する(ex "temp_dir/dir"のみ)
+    # * フォルダが2個以上あるが、zipファイルの名前と同じ名前のフォルダが存在する場合は、
+    #   そのフォルダの中身をdest_dirに配置する(__MACOSXなどのメタ情報フォルダはそのまま残す)
+    folded_dir = None
+    if len(top_level_names) == 1 and top_level_names <= top_level_dirs:
+        folded_dir = next(iter(top_level_names))
+    elif len(top_level_names) > 1 and zip_stem in top_level_dirs:
+        folded_dir = zip_stem
+
+    targets: list[tuple[zipfile.ZipInfo, str]] = []
+    for info in info_list:
+        name = info.filename
+        if folded_dir is not None and _top_level_name(name) == folded_dir:
+            name = name[len(folded_dir):].lstrip("/")
+            if name == "":
+                continue
+            if _top_level_name(name) in top_level_names:
+                if len(top_level_names) == 1:
+                    return "zipファイル名と同じ名前のフォルダがあるため、展開時にエラーが発生しました。"
+                return "zipファイルの名前と同じ名前のフォルダがあるため、展開時にエラーが発生しました。"
+        # 'makefile', 'GNUMakefile'を見つけたら、'Makefile'にリネームする
+        if not info.is_dir() and name in ["makefile", "GNUMakefile"]:
+            name = "Makefile"
+        targets.append((info, name))
+
+    # 展開する
+    try:
+        for info, name in targets:
+            _extract_member(zip_ref, info, dest_dir, name, digests)
+    except Exception as e:
+        return f"zipファイルの展開に失敗しました: {e}"
+
+    return None
+
+
+def unfold_zip(uploaded_zip_file: Path, dest_dir: Path, digests: dict[Path, str] | None = None) -> str | None:
+    """
+    uploaded_zip_fileが以下の条件を満たすかチェックしながら、dest_dirにファイルを配置していく。
+    * 拡張子がzipであること
+    * 展開後、以下のパターンしか想定しない
+        * フォルダが存在しないパターン(zipファイルに直接ファイルを配置していたケース)
+        * フォルダが一個しかないパターン(zipファイルにフォルダごと配置していたケース)
+        * フォルダが2個以上あるが、zipファイルの名前と同じ名前のフォルダが存在するパターン
+          (__MACOSXなどのメタ情報フォルダも含めてzipファイルに配置していたケース)
+
+    何も問題が無ければNoneを返し、問題があればエラーメッセージを返す。
+    展開したファイルはストアに登録され、digestsを渡すと{パス: ハッシュ値}を記録する。
+    """
+    if digests is None:
+        digests = {}
+    # zip提出の場合
+    if not uploaded_zip_file.name.endswith(".zip"):
+        return "zipファイルを提出してください。"
+
+    try:
+        with zipfile.ZipFile(uploaded_zip_file, "r") as zip_ref:
+            return _unfold_zip_archive(zip_ref, uploaded_zip_file.stem, dest_dir, digests)
+    except Exception as e:
+        return f"zipファイルの展開に失敗しました: {e}"
+
+
+def _unfold_nested_zip(
+    outer_zip: zipfile.ZipFile, info: zipfile.ZipInfo, dest_dir: Path, digests: dict[Path, str]
+) -> str | None:
+    """
+    outer_zipに含まれるzipファイルを、一時ファイルに書き出さずにメモリ上で開いて展開する
+    """
+    if info.file_size > constants.UNFOLD_MAX_TOTAL_BYTES:
+        return f"zipファイルの容量が{constants.UNFOLD_MAX_TOTAL_BYTES // 1024 // 1024}MBを超えています。"
+    try:
+        with zipfile.ZipFile(io.BytesIO(outer_zip.read(info)), "r") as zip_ref:
+            return _unfold_zip_archive(zip_ref, PurePosixPath(info.filename).stem, dest_dir, digests)
+    except Exception as e:
+        return f"zipファイルの展開に失敗しました: {e}"
+
+
+class ManabaArchiveLayout(NamedTuple):
+    # reportlist.xlsx(またはreportlist.xls)のメンバー名
+    reportlist_member: str | None
+    # {9桁の学籍番号}@{13桁のID}のフォルダのメンバー名("/"で終わる)
+    student_dirs: list[str]
+
+
+def read_manaba_archive_layout(archive_path: Path, archive_stem: str) -> ManabaArchiveLayout:
+    """
+    manabaから取得したzipファイルのメンバーの一覧から、reportlistと学生ごとのフォルダを探す
+
+    展開後にフォルダが一個しかない場合、もしくは__MACOSXなどのメタフォルダとzipファイル名のフォルダが
+    ある場合は、そのフォルダの中を探す。
+    """
+    with zipfile.ZipFile(archive_path, "r") as zip_ref:
+        names = zip_ref.namelist()
+
+    top_level_names = {_top_level_name(name) for name in names}
+    top_level_dirs = {_top_level_name(name) for name in names if "/" in name.rstrip("/") or name.endswith("/")}
+    prefix = ""
+    if len(top_level_names) == 1 and top_level_names <= top_level_dirs:
+        prefix = next(iter(top_level_names)) + "/"
+    elif len(top_level_names) > 1 and archive_stem in top_level_dirs:
+        prefix = archive_stem + "/"
+
+    reportlist_member = None
+    for file_name in ["reportlist.xlsx", "reportlist.xls"]:
+        if prefix + file_name in names:
+            reportlist_member = prefix + file_name
+            break
+
+    student_dirs = sorted({
+        prefix + _top_level_name(name[len(prefix):]) + "/"
+        for name in names
+        if name.startswith(prefix)
+        and "/" in name[len(prefix):]
+        and "@" in _top_level_name(name[len(prefix):])
+    })
+
+    return ManabaArchiveLayout(reportlist_member=reportlist_member, student_dirs=student_dirs)
+
+
+def extract_student_archive(archive_path: str, student_dir: str, lecture_id: int, dest_dir: str) -> str:
+    """
+    manabaから取得したzipファイルから、学生一人分の提出をdest_dirに展開する
+
+    * class{lecture_id}.zipがあれば、それを展開する
+    * なければ、フォルダ直下のファイルをなるべくコピーする(zipファイルは展開する)
+    ファイルは展開しながらブロブストアに登録し、展開後に.oファイルを削除する。
+    プロセスプールで実行されるため、引数と戻り値はpickleできる値にしている。
+    エラーメッセージ(改行区切り、なければ空文字列)を返す。
+    """
+    user_id = PurePosixPath(student_dir).name.split("@")[0]
+    dest_path = Path(dest_dir)
+    dest_path.mkdir(parents=True, exist_ok=True)
+    error_message = ""
+    # 展開時にストアに登録したファイルの{パス: ハッシュ値}
+    digests: dict[Path, str] = {}
+
+    with zipfile.ZipFile(archive_path, "r") as outer_zip:
+        # フォルダ直下のファイル
+        members = [
+            info for info in outer_zip.infolist()
+            if info.filename.startswith(student_dir)
+            and not info.is_dir()
+            and "/" not in info.filename[len(student_dir):]
+        ]
+        class_zip_info = next(
+            (info for info in members if info.filename == f"{student_dir}class{lecture_id}.zip"), None
+        )
+
+        if class_zip_info is None:
+            error_message += f"{user_id}は提出済みであるにも関わらず、class{lecture_id}.zipを提出していません\n"
+            ################## important ##################
+            # もし、class{lecture_id}.zipが存在しない場合は、他のファイルをなるべく展開先のディレクトリにコピーする
+            for info in members:
+                file_name = info.filename[len(student_dir):]
+                # もしzipファイルなら、展開する
+                if file_name.endswith(".zip"):
+                    message = _unfold_nested_zip(outer_zip, info, dest_path, digests)
+                    if message is not None:
+                        error_message += f"{user_id}のZipファイルの解凍中にエラーが発生しました: {message}\n"
+                else:
+                    _extract_member(outer_zip, info, dest_path, file_name, digests)
+        else:
+            ################## important ##################
+            # class{lecture_id}.zipが存在する場合は、それを展開する
+            message = _unfold_nested_zip(outer_zip, class_zip_info, dest_path, digests)
+            if message is not None:
+                error_message += f"{user_id}のZipファイルの解凍中にエラーが発生しました: {message}\n"
+                return error_message
+
+    """
+    NOTE: .oファイルがあると、コンパイルエラーになり、本来はコンパイルできるはずのコードが
+    ジャッジされないことがあるため、.oファイルを削除しておく
+    例:
+    main_binarytree.o: file not recognized: file format not recognized
+    collect2: error: ld returned 1 exit status
+    make: *** [<builtin>: binarytree] Error 1
+    """
+    for file in dest_path.glob("*.o"):
+        file.unlink()
+
+    # 同じ内容のファイル(配布されたMakefileなど)は、学生間で実体を共有する
+    # (展開時にストアに書き込んでいるので、ここではマニフェストを作るだけ)
+    blobstore.upload_store.store_directory(dest_path, digests)
+
+    return error_message
+
+
+def extract_reportlist(archive_path: Path, member: str, dest_dir: Path) -> Path:
+    """
+    manabaから取得したzipファイルから、reportlistをdest_dirに展開する
+    """
+    dest_path = dest_dir / PurePosixPath(member).name
+    with zipfile.ZipFile(archive_path, "r") as zip_ref, zip_ref.open(member) as src, open(dest_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return dest_path
+
+
+_executor: Executor | None = None
+
+
+def get_extract_executor() -> Executor | None:
+    """
+    学生ごとの展開処理を実行するプロセスプールを返す
+
+    BATCH_EXTRACT_WORKERSが0以下の場合はNoneを返す(イベントループのデフォルトのスレッドプールで実行する)
+    """
+    global _executor
+    if constants.BATCH_EXTRACT_WORKERS <= 0:
+        return None
+    if _executor is None:
+        # uvicornのスレッドを引き継がないように、forkではなくspawnでプロセスを作る
+        _executor = ProcessPoolExecutor(
+            max_workers=constants.BATCH_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+def _noop() -> None:
+    return None
+
+
+def start_extract_executor() -> None:
+    """
+    プロセスプールのプロセスを起動しておく
+
+    spawnで起動したプロセスはモジュールの読み込みに時間がかかるため、
+    最初のバッチ採点リクエストを待たせないように、アプリケーションの起動時に呼び出す。
+    """
+    executor = get_extract_executor()
+    if executor is None:
+        return
+    for _ in range(constants.BATCH_EXTRACT_WORKERS):
+        executor.submit(_noop)
+
+
+def shutdown_extract_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
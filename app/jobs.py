@@ -0,0 +1,74 @@
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+from app import constants
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+HTTPリクエストの処理が終わった後に、時間のかかる処理を実行するジョブランナー
+
+FastAPIのBackgroundTasksと異なり、同時に実行するジョブの数を制限する
+(大きなバッチ採点が同時にアップロードされても、CPUを使い切らないようにする)。
+ジョブはuvicornのworkerのプロセス内で実行されるため、workerが終了すると実行中のジョブも中断される。
+中断されたバッチ採点の取り込みは、リース(BatchSubmission.heartbeat_at)が切れた後に回収処理(app.reaper)が失敗させる。
+"""
+
+
+class JobRunner:
+    def __init__(self, max_concurrency: int):
+        self._max_concurrency = max(1, max_concurrency)
+        self._semaphore: asyncio.Semaphore | None = None
+        # 実行中・待機中のジョブ(ガベージコレクションで消えないように参照を保持する)
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, job: Callable[..., Awaitable[Any]], *args: Any) -> asyncio.Task:
+        """
+        ジョブを登録する。同時に実行されているジョブが上限に達している場合は、空くまで待ってから実行する
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        task = asyncio.create_task(self._run(job, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, job: Callable[..., Awaitable[Any]], *args: Any) -> None:
+        async with self._semaphore:
+            try:
+                await job(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Background job {getattr(job, '__name__', job)} failed: {e}")
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def shutdown(self) -> None:
+        """
+        実行中・待機中のジョブを中断する
+        """
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+
+# バッチ採点の取り込み(zipファイルの展開、提出エントリの登録)を実行するジョブランナー
+batch_ingest_runner = JobRunner(constants.BATCH_INGEST_CONCURRENCY)
+
+# このプロセスで取り込み中(実行待ちを含む)のバッチ採点のID
+# 回収処理(app.reaper)が、これらのバッチ採点の取り込みのリースを更新する
+ingesting_batch_ids: set[int] = set()
+
+
+def get_batch_dir(batch_id: int, ts: datetime) -> Path:
+    """
+    バッチ採点でアップロードされたファイルを置くディレクトリ({UPLOAD_DIR}/batch/{ts}-{batch_id})を返す
+    """
+    return Path(constants.UPLOAD_DIR) / "batch" / f"{ts.strftime('%Y-%m-%d-%H-%M-%S')}-{batch_id}"
@@ -0,0 +1,112 @@
+import logging
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, FileResponse
+from app.api.api_v1.endpoints import api_router
+from app.crud.db import init_db
+from app.reaper import run_reaper, run_blob_collector
+from app.extract import start_extract_executor, shutdown_extract_executor
+from app.jobs import batch_ingest_runner
+from app import constants
+from app.compression import CompressionMiddleware
+from app.request_limit import RequestBodyLimitMiddleware
+from app.responses import FastJSONResponse
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timedelta
+from app.dependencies import get_db
+import asyncio
+import os
+
+# ロギング設定
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # アプリケーションの起動時に実行される処理
+    init_db()
+    start_extract_executor()
+    background_tasks = []
+    if constants.REAPER_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(run_reaper(constants.REAPER_INTERVAL_SECONDS)))
+    if constants.BLOB_GC_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(run_blob_collector(constants.BLOB_GC_INTERVAL_SECONDS)))
+    yield
+    # アプリケーションの終了時に実行される処理
+    for task in background_tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await batch_ingest_runner.shutdown()
+    shutdown_extract_executor()
+
+def create_app() -> FastAPI:
+    app = FastAPI(
+        title="DSA Backend Server",
+        version="0.1.0",
+        lifespan=lifespan,
+        # orjsonがインストールされている場合は、orjsonでJSONに変換する
+        default_response_class=FastJSONResponse)
+
+    # カスタムHTTPExceptionハンドラー
+    @app.exception_handler(HTTPException)
+    async def custom_http_exception_handler(request: Request, exc: HTTPException):
+        logger.error(f"HTTPException: {exc.detail} - Path: {request.url.path}")
+        return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=exc.headers)
+
+    # 一般的な例外ハンドラー（オプション）
+    @app.exception_handler(Exception)
+    async def custom_exception_handler(request: Request, exc: Exception):
+        logger.error(f"Unexpected error: {str(exc)} - Path: {request.url.path}")
+        return JSONResponse(
+            status_code=500,
+            content={"detail": "An unexpected error occurred. Please try again later."},
+        )
+
+    # 一時ファイルを削除するミドルウェア
+    # @app.middleware("http")
+    # async def remove_temp_file(request: Request, call_next):
+    #     response = await call_next(request)
+    #     if isinstance(response, FileResponse):
+    #         try:
+    #             os.remove(response.path)
+    #         except Exception as e:
+    #             logger.error(f"Error deleting temporary file: {str(e)}")
+    #     return response
+
+    app.include_router(api_router, prefix="/api/v1")
+    return app
+
+
+# ゲートウェイサーバ(オリジン: http://localhost:80)からのアクセスを許可するための
+# CORS設定
+origins = [
+    "http://localhost:80",
+]
+
+app = create_app()
+
+# 単体の採点リクエストのボディのサイズを、multipartのパースの前に制限する
+# (413エラーのレスポンスにもCORSのヘッダが付くように、CORSMiddlewareより内側に置く)
+app.add_middleware(
+    RequestBodyLimitMiddleware,
+    limits=[("POST", r"/api/v1/assignments/judge/\d+/\d+", constants.UPLOAD_MAX_REQUEST_BYTES)],
+)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["content-disposition"]
+)
+
+# Accept-Encodingに応じて、レスポンスをbr(brotliがインストールされている場合)またはgzipで圧縮する
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=constants.COMPRESSION_MINIMUM_SIZE,
+    gzip_level=constants.COMPRESSION_GZIP_LEVEL,
+    brotli_quality=constants.COMPRESSION_BROTLI_QUALITY,
+)
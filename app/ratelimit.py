@@ -0,0 +1,138 @@
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+import time
+from pathlib import Path
+from app import constants
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+"""
+トークンバケット方式の流量制限
+
+バケットの状態(残りトークン数, 最終更新時刻)はRateLimitStoreに保持する。
+* MemoryRateLimitStore: プロセス内で保持する(uvicornのworkerごとに独立したバケットになる)
+* SQLiteRateLimitStore: 同一ホスト上のSQLiteファイルに保持する(複数のuvicorn workerで共有できる)
+"""
+
+
+# (バケットのキー, 容量, 1秒あたりの補充量, 消費するトークン数)
+BucketRequest = tuple[str, float, float, float]
+
+
+class RateLimitStore(ABC):
+    @abstractmethod
+    def consume(self, requests: list[BucketRequest]) -> float:
+        """
+        全てのバケットからトークンを消費する。
+
+        全てのバケットにトークンが足りている場合のみ消費して0.0を返す。
+        どれか一つでも足りない場合は、どのバケットからも消費せず、
+        全てのバケットにトークンが溜まるまでの秒数を返す。
+        """
+
+
+def _refill(tokens: float, updated_at: float, capacity: float, refill_rate: float, now: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated_at) * refill_rate)
+
+
+def _retry_after(tokens: float, cost: float, refill_rate: float) -> float:
+    if tokens >= cost:
+        return 0.0
+    if refill_rate <= 0:
+        return float("inf")
+    return (cost - tokens) / refill_rate
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (残りトークン数, 最終更新時刻)
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def consume(self, requests: list[BucketRequest]) -> float:
+        now = time.monotonic()
+        with self._lock:
+            refilled = {}
+            retry_after = 0.0
+            for key, capacity, refill_rate, cost in requests:
+                tokens, updated_at = self._buckets.get(key, (capacity, now))
+                tokens = _refill(tokens, updated_at, capacity, refill_rate, now)
+                refilled[key] = tokens
+                retry_after = max(retry_after, _retry_after(tokens, cost, refill_rate))
+
+            if retry_after > 0:
+                return retry_after
+
+            for key, _, _, cost in requests:
+                self._buckets[key] = (refilled[key] - cost, now)
+            return 0.0
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    def __init__(self, path: Path):
+        self._path = path
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bucket ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=Noneにして、トランザクションを明示的に制御する
+        return sqlite3.connect(self._path, timeout=5.0, isolation_level=None)
+
+    def consume(self, requests: list[BucketRequest]) -> float:
+        # worker間で共有するため、壁時計時刻を使う
+        now = time.time()
+        conn = self._connect()
+        try:
+            # 他のworkerと競合しないように、書き込みロックを取ってから読み込む
+            conn.execute("BEGIN IMMEDIATE")
+            refilled = {}
+            retry_after = 0.0
+            for key, capacity, refill_rate, cost in requests:
+                row = conn.execute(
+                    "SELECT tokens, updated_at FROM bucket WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated_at = row if row is not None else (capacity, now)
+                tokens = _refill(tokens, updated_at, capacity, refill_rate, now)
+                refilled[key] = tokens
+                retry_after = max(retry_after, _retry_after(tokens, cost, refill_rate))
+
+            if retry_after > 0:
+                conn.execute("ROLLBACK")
+                return retry_after
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)",
+                [(key, refilled[key] - cost, now) for key, _, _, cost in requests],
+            )
+            conn.execute("COMMIT")
+            return 0.0
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+
+_store: RateLimitStore | None = None
+
+
+def get_rate_limit_store() -> RateLimitStore:
+    """
+    constants.RATE_LIMIT_STOREの設定に応じたRateLimitStoreを返す
+    """
+    global _store
+    if _store is None:
+        if constants.RATE_LIMIT_STORE == "sqlite":
+            _store = SQLiteRateLimitStore(Path(constants.RATE_LIMIT_SQLITE_PATH))
+        else:
+            if constants.RATE_LIMIT_STORE != "memory":
+                logging.warning(f"unknown RATE_LIMIT_STORE: {constants.RATE_LIMIT_STORE}, use memory store")
+            _store = MemoryRateLimitStore()
+    return _store
@@ -0,0 +1,91 @@
+import asyncio
+import shutil
+from app import blobstore
+from app import constants
+from app.jobs import ingesting_batch_ids, get_batch_dir
+from app.crud.db import SessionLocal
+from app.crud.db import assignments
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+"""
+running状態のまま停止したジャッジの回収処理
+
+ジャッジワーカーが異常終了すると、提出エントリがrunning状態のまま残り、
+バッチ採点のcomplete_judgeがtotal_judgeに到達しなくなる。
+アプリケーションの起動中、一定間隔でそのような提出を探し、キューに積み直すかIEとして終了させる。
+
+バッチ採点の取り込みについても、このプロセスで取り込み中のもののリースを更新し、
+リースが切れた(取り込みを実行していたプロセスが停止した)ものを失敗させて、アップロードされたファイルを削除する。
+アプリケーションの起動直後にも1回実行するので、再起動前に中断された取り込みも、リースが切れた後に回収される。
+
+あわせて、ブロブストアのどこからも参照されなくなった実体の削除も、別の間隔で定期的に実行する。
+"""
+
+
+def reap_once() -> tuple[int, int]:
+    """
+    停止した提出の回収を1回実行し、(積み直した数, IEとして終了させた数)を返す
+
+    バッチ採点の取り込みのリースの更新と、停止した取り込みの回収もあわせて行う。
+    """
+    db = SessionLocal()
+    try:
+        assignments.renew_batch_ingestion_leases(db, list(ingesting_batch_ids))
+        stale_batches = assignments.fail_stale_batch_ingestions(db, constants.BATCH_INGEST_LEASE_SECONDS)
+        requeue_ids, fail_ids = assignments.reap_stuck_submissions(
+            db,
+            grace_seconds=constants.REAPER_GRACE_SECONDS,
+            max_retries=constants.REAPER_MAX_RETRIES,
+        )
+    finally:
+        db.close()
+
+    for batch_id, ts in stale_batches:
+        # 展開途中のファイルとアップロードされたzipファイル(.upload.zip)を削除する
+        shutil.rmtree(get_batch_dir(batch_id, ts), ignore_errors=True)
+    if len(stale_batches) > 0:
+        logger.warning(f"failed interrupted batch ingestions: {[batch_id for batch_id, _ in stale_batches]}")
+    if len(requeue_ids) > 0:
+        logger.warning(f"requeued stuck submissions: {requeue_ids}")
+    if len(fail_ids) > 0:
+        logger.warning(f"marked stuck submissions as IE: {fail_ids}")
+    return len(requeue_ids), len(fail_ids)
+
+
+async def run_reaper(interval_seconds: float) -> None:
+    """
+    interval_seconds秒ごとに回収処理を実行する(キャンセルされるまで終了しない)
+    """
+    while True:
+        try:
+            # DBアクセスは同期処理なので、イベントループを止めないように別スレッドで実行する
+            await asyncio.to_thread(reap_once)
+        except Exception as e:
+            logger.error(f"Error while reaping stuck submissions: {e}")
+        await asyncio.sleep(interval_seconds)
+
+
+def collect_blob_garbage() -> int:
+    """
+    アップロード用と課題データ用のストアから、参照されなくなった実体を削除し、削除した数を返す
+    """
+    removed = blobstore.upload_store.collect_garbage() + blobstore.resource_store.collect_garbage()
+    if removed > 0:
+        logger.info(f"removed {removed} unreferenced blobs")
+    return removed
+
+
+async def run_blob_collector(interval_seconds: float) -> None:
+    """
+    interval_seconds秒ごとに、ブロブストアの参照されなくなった実体を削除する(キャンセルされるまで終了しない)
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            # 全ての実体のstatを取るので、イベントループを止めないように別スレッドで実行する
+            await asyncio.to_thread(collect_blob_garbage)
+        except Exception as e:
+            logger.error(f"Error while collecting unreferenced blobs: {e}")
@@ -0,0 +1,124 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterator, NamedTuple
+import openpyxl
+import xlrd
+
+"""
+manabaから取得したreportlist.xlsx(またはreportlist.xls)の読み込み
+
+reportlistは以下のような構成になっている。"# 内部コースID"で始まる行をヘッダとし、
+"#end"で始まる行の手前までを学生ごとの行として読み込む。
+
+    (コース名などのメタ情報)
+    # 内部コースID, # 学籍番号, # ロール, # 提出, # 提出日時, ...
+    xxxx, 202211479, 履修生, 提出済, 2024-10-01 12:34:56, ...
+    ...
+    #end
+
+シート全体を読み込まずに、1行ずつ読みながら必要な列だけを取り出す。
+"""
+
+HEADER_PREFIX = "# 内部コースID"
+END_PREFIX = "#end"
+SUBMIT_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ReportListRow(NamedTuple):
+    index: int  # ヘッダの次の行を0とした行番号
+    user_id: str | None  # 9桁の学籍番号
+    role: str | None  # 履修生など
+    submission_status: str | None  # 提出済/受付終了後提出/未提出
+    submit_date: datetime | None
+
+
+def _iter_xlsx_rows(path: Path) -> Iterator[tuple[Any, ...]]:
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _iter_xls_rows(path: Path) -> Iterator[tuple[Any, ...]]:
+    workbook = xlrd.open_workbook(path, on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(0)
+        for row_index in range(sheet.nrows):
+            yield tuple(
+                xlrd.xldate_as_datetime(cell.value, workbook.datemode)
+                if cell.ctype == xlrd.XL_CELL_DATE
+                else (None if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK) else cell.value)
+                for cell in sheet.row(row_index)
+            )
+    finally:
+        workbook.release_resources()
+
+
+def _to_str(value: Any) -> str | None:
+    if value is None:
+        return None
+    # 学籍番号などが数値のセルになっている場合に、"202211479.0"とならないようにする
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    return text if text != "" else None
+
+
+def _to_datetime(value: Any) -> datetime | None:
+    if isinstance(value, datetime):
+        return value
+    text = _to_str(value)
+    if text is None:
+        return None
+    return datetime.strptime(text, SUBMIT_DATE_FORMAT)
+
+
+def iter_report_list(report_list_path: Path) -> Iterator[ReportListRow]:
+    """
+    reportlist.xlsx(またはreportlist.xls)を1行ずつ読み込み、
+    "# 学籍番号", "# ロール", "# 提出", "# 提出日時"の4列を取り出した行を返す
+
+    ヘッダの行や必要な列が見つからない場合はValueErrorを送出する。
+    """
+    if report_list_path.suffix == ".xls":
+        rows = _iter_xls_rows(report_list_path)
+    else:
+        rows = _iter_xlsx_rows(report_list_path)
+
+    columns: dict[str, int] | None = None
+    index = 0
+    for row in rows:
+        first_cell = _to_str(row[0]) if len(row) > 0 else None
+
+        if columns is None:
+            # "# 内部コースID"で始まる行までは読み飛ばす
+            if first_cell is None or not first_cell.startswith(HEADER_PREFIX):
+                continue
+            header = [_to_str(value) for value in row]
+            columns = {}
+            for column_name in ["# 学籍番号", "# ロール", "# 提出", "# 提出日時"]:
+                if column_name not in header:
+                    raise ValueError(f"reportlistに\"{column_name}\"の列がありません")
+                columns[column_name] = header.index(column_name)
+            continue
+
+        # "#end"で始まる行以降は読まない
+        if first_cell is not None and first_cell.startswith(END_PREFIX):
+            break
+
+        def cell(column_name: str) -> Any:
+            column = columns[column_name]
+            return row[column] if column < len(row) else None
+
+        yield ReportListRow(
+            index=index,
+            user_id=_to_str(cell("# 学籍番号")),
+            role=_to_str(cell("# ロール")),
+            submission_status=_to_str(cell("# 提出")),
+            submit_date=_to_datetime(cell("# 提出日時")),
+        )
+        index += 1
+
+    if columns is None:
+        raise ValueError(f"reportlistに\"{HEADER_PREFIX}\"で始まる行がありません")
@@ -0,0 +1,57 @@
+import re
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+"""
+リクエストのボディのサイズの制限
+
+multipartのパース(UploadFileへの書き込み)はエンドポイントの処理より前に行われるので、
+エンドポイントの中で確認するサイズの上限(UPLOAD_MAX_TOTAL_BYTESなど)では、
+受信するデータ量や一時ファイルの容量を制限できない。
+このミドルウェアで、パースの前にContent-Lengthを確認し、受信中もボディのサイズを数えて、
+上限を超えた時点で413エラーを返す。
+"""
+
+
+class RequestBodyLimitMiddleware:
+    def __init__(self, app: ASGIApp, limits: list[tuple[str, str, int]]) -> None:
+        """
+        limitsは(メソッド, パスの正規表現, ボディのサイズの上限(バイト))のリスト(最初に一致したものを使う)
+        """
+        self.app = app
+        self.limits = [(method, re.compile(pattern), max_bytes) for method, pattern, max_bytes in limits]
+
+    def _limit_for(self, scope: Scope) -> int | None:
+        for method, pattern, max_bytes in self.limits:
+            if scope["method"] == method and pattern.fullmatch(scope["path"]):
+                return max_bytes
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        max_bytes = self._limit_for(scope) if scope["type"] == "http" else None
+        if max_bytes is None:
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"リクエストのサイズが上限({max_bytes}バイト)を超えています"
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+            response = JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, content={"detail": detail})
+            await response(scope, receive, send)
+            return
+
+        received_bytes = 0
+
+        async def receive_with_limit() -> Message:
+            # Content-Lengthがない(chunked)場合や、Content-Lengthより多く送られた場合も、受信しながら数える
+            nonlocal received_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                received_bytes += len(message.get("body", b""))
+                if received_bytes > max_bytes:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            return message
+
+        await self.app(scope, receive_with_limit, send)
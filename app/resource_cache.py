@@ -0,0 +1,194 @@
+import codecs
+import mmap
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Hashable, NamedTuple
+from app import constants
+from app.blobstore import compute_file_digest
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+"""
+課題リソースファイル(課題の説明文、テストケースのstdin/stdout/stderr)のメモリ上のキャッシュ
+
+授業の開始時には、全ての学生が同時に同じ課題の詳細を取得するため、同じファイルを何度も読み込むことになる。
+* ResourceFileCache: ファイルの内容を(パス, 更新時刻, サイズ)をキーとして保持する、容量で制限したLRUキャッシュ
+* ProblemDetailCache: 組み立て済みの課題の詳細を(lecture_id, assignment_id, ...)をキーとして保持するLRUキャッシュ
+* ResourceDigestCache: ファイル内容のsha256ハッシュ値をパスをキーとして保持する、件数で制限したLRUキャッシュ
+
+どちらもuvicornのworkerのプロセス内で保持する(workerごとに独立する)。
+"""
+
+
+def _decode(data: bytes | mmap.mmap) -> str:
+    # open(path, "r")で読み込んだ場合と同じく、改行コードを"\n"に揃える
+    return str(data, "utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def read_text_head(path: Path, max_bytes: int) -> str:
+    """
+    ファイルの先頭max_bytesバイトを文字列で返す(途中で切れたマルチバイト文字は含めない)
+    """
+    with open(path, "rb") as f:
+        data = f.read(max_bytes)
+    text = codecs.getincrementaldecoder("utf-8")().decode(data, final=False)
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class _CachedFile(NamedTuple):
+    mtime_ns: int
+    size: int
+    text: str
+
+
+class ResourceFileCache:
+    def __init__(self, max_bytes: int, max_file_bytes: int, use_mmap: bool = False):
+        self._max_bytes = max_bytes
+        self._max_file_bytes = max_file_bytes
+        self._use_mmap = use_mmap
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _CachedFile] = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def read_text(self, path: Path) -> str:
+        """
+        ファイルの内容を文字列で返す
+
+        更新時刻とサイズがキャッシュした時から変わっていなければ、ファイルを読み込まずにキャッシュから返す。
+        max_file_bytesより大きいファイルはキャッシュしない(use_mmapがTrueの場合はmmapで読み込む)。
+        ファイルが存在しない場合はFileNotFoundErrorを送出する。
+        """
+        stat_result = path.stat()
+        key = str(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime_ns == stat_result.st_mtime_ns and entry.size == stat_result.st_size:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.text
+            self.misses += 1
+
+        if stat_result.st_size > self._max_file_bytes:
+            return self._read_uncached(path, stat_result.st_size)
+
+        with open(path, "rb") as f:
+            text = _decode(f.read())
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous.size
+            self._entries[key] = _CachedFile(stat_result.st_mtime_ns, stat_result.st_size, text)
+            self._total_bytes += stat_result.st_size
+            # 容量を超えた分は、最も長く使われていないファイルから捨てる
+            while self._total_bytes > self._max_bytes and len(self._entries) > 0:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.size
+        return text
+
+    def _read_uncached(self, path: Path, size: int) -> str:
+        with open(path, "rb") as f:
+            if self._use_mmap and size > 0:
+                # ページキャッシュから直接デコードし、読み込み用のバッファを確保しない
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return _decode(mapped)
+            return _decode(f.read())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+
+class ProblemDetailCache:
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # キーの先頭2つは(lecture_id, assignment_id)とする
+        self._entries: OrderedDict[tuple[Hashable, ...], Any] = OrderedDict()
+
+    def get(self, key: tuple[Hashable, ...]) -> Any | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: tuple[Hashable, ...], value: Any) -> None:
+        if self._max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_problem(self, lecture_id: int, assignment_id: int) -> None:
+        """
+        小課題のエントリを全て削除する(課題データの更新時、削除時に呼ぶ)
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[:2] == (lecture_id, assignment_id)]:
+                del self._entries[key]
+
+
+class _CachedDigest(NamedTuple):
+    mtime_ns: int
+    size: int
+    digest: str
+
+
+class ResourceDigestCache:
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _CachedDigest] = OrderedDict()
+
+    def digest(self, path: Path) -> str:
+        """
+        ファイルの内容のsha256ハッシュ値を返す
+
+        更新時刻とサイズがキャッシュした時から変わっていなければ、ファイルを読み込まずにキャッシュから返す。
+        ファイルが更新された場合は、同じパスの古いエントリを置き換える。
+        """
+        stat_result = path.stat()
+        key = str(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime_ns == stat_result.st_mtime_ns and entry.size == stat_result.st_size:
+                self._entries.move_to_end(key)
+                return entry.digest
+
+        digest = compute_file_digest(path)
+        if self._max_entries <= 0:
+            return digest
+        with self._lock:
+            self._entries[key] = _CachedDigest(stat_result.st_mtime_ns, stat_result.st_size, digest)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return digest
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+resource_file_cache = ResourceFileCache(
+    constants.RESOURCE_CACHE_MAX_BYTES,
+    constants.RESOURCE_CACHE_MAX_FILE_BYTES,
+    constants.RESOURCE_CACHE_USE_MMAP,
+)
+problem_detail_cache = ProblemDetailCache(constants.PROBLEM_DETAIL_CACHE_ENTRIES)
+resource_digest_cache = ResourceDigestCache(constants.RESOURCE_DIGEST_CACHE_ENTRIES)
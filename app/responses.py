@@ -0,0 +1,39 @@
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjsonがインストールされていない場合は、標準のjsonモジュールを使う
+    orjson = None
+
+"""
+APIのレスポンスクラス
+
+FastJSONResponseをFastAPIのdefault_response_classとして、全てのエンドポイントで使う。
+"""
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    orjsonがインストールされている場合は、orjsonでJSONに変換するレスポンス
+
+    インストールされていない場合は、JSONResponseと同じ(json.dumps)。
+    """
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def jsonable(content: Any) -> Any:
+    """
+    contentをJSONに変換できる値(dict, listなど)にする
+
+    pydanticのモデルはmodel_dump(mode="json")で変換し、jsonable_encoderによる再帰的な変換を行わない。
+    """
+    if isinstance(content, BaseModel):
+        return content.model_dump(mode="json")
+    return jsonable_encoder(content)
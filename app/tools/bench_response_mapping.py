@@ -0,0 +1,106 @@
+"""
+DBの行からレスポンス(JSON)を作るまでの、1行あたりの処理時間を計測するベンチマーク
+
+提出エントリ(Submission)の行をメモリ上に作り、次の2つの方法でJSONに変換できる値にするまでの時間を比べる。
+DBへの接続は不要。
+
+* validate: 以前の方法。カラムのdictからschemas.Submissionを検証して作り、model_dumpしたdictから
+            response.Submissionを検証して作り、FastAPIのresponse_modelと同じくもう一度検証してから変換する
+* mapping:  app.classes.mappingでresponse.Submissionを検証せずに1回だけ組み立て、TypeAdapterで変換する
+
+使い方:
+    python -m app.tools.bench_response_mapping --rows 1000 --repeat 20
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from app.classes import models, schemas, response, mapping
+
+
+def make_rows(count: int) -> list[models.Submission]:
+    results = ["AC", "WA", "TLE", "RE", None]
+    base_ts = datetime(2025, 4, 1, 9, 0, 0)
+    return [
+        models.Submission(
+            id=i + 1,
+            ts=base_ts + timedelta(seconds=i),
+            evaluation_status_id=None,
+            user_id=f"student{i % 300:03d}",
+            lecture_id=1,
+            assignment_id=i % 5 + 1,
+            eval=False,
+            upload_dir=f"/upload/{i + 1}",
+            progress="done",
+            total_task=10,
+            completed_task=10,
+            result=results[i % len(results)],
+            message=None,
+            detail=None,
+            score=100,
+            timeMS=120,
+            memoryKB=4096,
+            priority=0,
+            started_at=base_ts,
+            finished_at=base_ts,
+            cache_key=None,
+            heartbeat_at=None,
+            retry_count=0,
+            claim_token=0,
+        )
+        for i in range(count)
+    ]
+
+
+def convert_by_validation(rows: list[models.Submission], response_adapter: TypeAdapter) -> list:
+    records = [
+        schemas.Submission.model_validate(
+            {key: getattr(row, key) for key in row.__table__.columns.keys()}
+        )
+        for row in rows
+    ]
+    submissions = [
+        response.Submission.model_validate(record.model_dump(exclude={"problem", "judge_results"}))
+        for record in records
+    ]
+    # FastAPIのresponse_modelは、返り値をdictに変換してから検証し直す
+    validated = response_adapter.validate_python([submission.model_dump() for submission in submissions])
+    return jsonable_encoder(validated)
+
+
+def convert_by_mapping(rows: list[models.Submission]) -> list:
+    submissions = [mapping.submission(row) for row in rows]
+    return mapping.submission_list_adapter.dump_python(submissions, mode="json")
+
+
+def measure(label: str, func, repeat: int, rows: int) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    per_row_us = min(elapsed) / rows * 1e6
+    print(f"{label:>10}: {per_row_us:8.2f} us/row (best of {repeat})")
+    return per_row_us
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="DBの行からレスポンスへの変換のベンチマーク")
+    parser.add_argument("--rows", type=int, default=1000, help="1回あたりに変換する行数")
+    parser.add_argument("--repeat", type=int, default=20, help="計測の繰り返し回数")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    response_adapter = TypeAdapter(list[response.Submission])
+
+    # 両者の出力が一致することを確認する
+    assert convert_by_validation(rows, response_adapter) == convert_by_mapping(rows)
+
+    before = measure("validate", lambda: convert_by_validation(rows, response_adapter), args.repeat, args.rows)
+    after = measure("mapping", lambda: convert_by_mapping(rows), args.repeat, args.rows)
+    print(f"{'speedup':>10}: {before / after:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+負荷試験用の疑似ジャッジワーカー
+
+実際のサンドボックス(ジャッジワーカー)の代わりに、キューに積まれた提出を取り出し、
+指定した分布に従った疑似的なジャッジ結果を、指定した遅延の後に書き込む。
+DBに直接接続するため、DATABASE_URL(またはDATABASE_USERなど)でバックエンドと同じDBを指定すること。
+
+使い方:
+    DATABASE_URL=sqlite:///./dsa.sqlite3 python -m app.tools.fake_worker --concurrency 4 --latency-ms 500
+"""
+import argparse
+import random
+import threading
+import time
+from app.crud.db import SessionLocal
+from app.crud.db import assignments
+from app.classes import schemas
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_result_distribution(text: str) -> dict[schemas.SingleJudgeStatus, float]:
+    """
+    "AC=0.8,WA=0.15,TLE=0.05"のような文字列を、テストケースの結果ごとの重みに変換する
+    """
+    distribution: dict[schemas.SingleJudgeStatus, float] = {}
+    for item in text.split(","):
+        result, weight = item.split("=")
+        distribution[schemas.SingleJudgeStatus(result.strip())] = float(weight)
+    if sum(distribution.values()) <= 0:
+        raise ValueError(f"invalid result distribution: {text}")
+    return distribution
+
+
+class FakeJudgeWorker:
+    """
+    キューに積まれた提出を取り出して、疑似的なジャッジ結果を書き込むワーカー
+
+    concurrency個のスレッドで並行して提出を処理する。
+    1つの提出のジャッジにかかる時間は、latency_ms ± jitter_ms の一様分布に従う。
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 1,
+        latency_ms: float = 500,
+        jitter_ms: float = 0,
+        result_distribution: dict[schemas.SingleJudgeStatus, float] | None = None,
+        poll_interval: float = 0.2,
+        seed: int | None = None,
+    ):
+        self.concurrency = concurrency
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.result_distribution = (
+            result_distribution
+            if result_distribution is not None
+            else {schemas.SingleJudgeStatus.AC: 1.0}
+        )
+        self.poll_interval = poll_interval
+        self.judged = 0
+        self._random = random.Random(seed)
+        self._stop_event = threading.Event()
+        # SQLiteはSKIP LOCKEDに対応していないため、プロセス内で取り出しを直列化する
+        self._claim_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f"fake-judge-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _sample_result(self) -> schemas.SingleJudgeStatus:
+        results = list(self.result_distribution.keys())
+        weights = list(self.result_distribution.values())
+        return self._random.choices(results, weights=weights)[0]
+
+    def _sample_latency_seconds(self) -> float:
+        latency_ms = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, latency_ms) / 1000
+
+    def _run(self) -> None:
+        db = SessionLocal()
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    with self._claim_lock:
+                        submissions = assignments.claim_queued_submissions(db, limit=1)
+                    if len(submissions) == 0:
+                        self._stop_event.wait(self.poll_interval)
+                        continue
+                    for submission in submissions:
+                        self._judge(db, submission)
+                except Exception as e:
+                    logger.error(f"Error in fake judge worker: {e}")
+                    db.rollback()
+                    self._stop_event.wait(self.poll_interval)
+        finally:
+            db.close()
+
+    def _judge(self, db, submission: schemas.Submission) -> None:
+        problem = assignments.get_problem(
+            db,
+            lecture_id=submission.lecture_id,
+            assignment_id=submission.assignment_id,
+            eval=submission.eval,
+            detail=True,
+        )
+        test_cases = problem.test_cases if problem is not None else []
+
+        assignments.ingest_judge_batch(
+            db,
+            schemas.JudgeIngestBatch(
+                submissions=[
+                    schemas.SubmissionProgressUpdate(
+                        submission_id=submission.id,
+                        claim_token=submission.claim_token,
+                        total_task=len(test_cases),
+                    )
+                ]
+            ),
+        )
+
+        # 実際のジャッジにかかる時間の代わりに待つ
+        time.sleep(self._sample_latency_seconds())
+
+        judge_results = []
+        for test_case in test_cases:
+            # ビルドは常に成功させる
+            result = (
+                schemas.SingleJudgeStatus.AC
+                if test_case.type == schemas.EvaluationType.Built
+                else self._sample_result()
+            )
+            judge_results.append(
+                schemas.JudgeResult(
+                    submission_id=submission.id,
+                    testcase_id=test_case.id,
+                    result=result,
+                    command=test_case.command,
+                    timeMS=self._random.randint(1, max(1, problem.timeMS // 10)),
+                    memoryKB=self._random.randint(1024, 4096),
+                    exit_code=0 if result == schemas.SingleJudgeStatus.AC else 1,
+                    stdout="",
+                    stderr="",
+                )
+            )
+
+        summary_result = max(
+            (schemas.SubmissionSummaryStatus(judge_result.result.value) for judge_result in judge_results),
+            default=schemas.SubmissionSummaryStatus.AC,
+        )
+        assignments.ingest_judge_batch(
+            db,
+            schemas.JudgeIngestBatch(
+                judge_results=judge_results,
+                submissions=[
+                    schemas.SubmissionProgressUpdate(
+                        submission_id=submission.id,
+                        claim_token=submission.claim_token,
+                        progress=schemas.SubmissionProgressStatus.DONE,
+                        result=summary_result,
+                        score=sum(
+                            test_case.score
+                            for test_case, judge_result in zip(test_cases, judge_results)
+                            if judge_result.result == schemas.SingleJudgeStatus.AC
+                        ),
+                        timeMS=max((judge_result.timeMS for judge_result in judge_results), default=0),
+                        memoryKB=max((judge_result.memoryKB for judge_result in judge_results), default=0),
+                    )
+                ],
+            ),
+        )
+        with self._count_lock:
+            self.judged += 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="負荷試験用の疑似ジャッジワーカー")
+    parser.add_argument("--concurrency", type=int, default=1, help="並行して処理する提出の数")
+    parser.add_argument("--latency-ms", type=float, default=500, help="1つの提出のジャッジにかかる時間(ミリ秒)")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="ジャッジにかかる時間のばらつき(ミリ秒)")
+    parser.add_argument("--results", default="AC=1.0", help='テストケースの結果の分布(例: "AC=0.8,WA=0.15,TLE=0.05")')
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="キューが空のときのポーリング間隔(秒)")
+    parser.add_argument("--seed", type=int, default=None, help="乱数のシード")
+    args = parser.parse_args()
+
+    worker = FakeJudgeWorker(
+        concurrency=args.concurrency,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        result_distribution=parse_result_distribution(args.results),
+        poll_interval=args.poll_interval,
+        seed=args.seed,
+    )
+    worker.start()
+    logger.info(f"fake judge worker started (concurrency: {args.concurrency})")
+    try:
+        while True:
+            time.sleep(10)
+            logger.info(f"judged {worker.judged} submissions")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
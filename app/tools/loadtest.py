@@ -0,0 +1,318 @@
+"""
+ジャッジパイプラインのエンドツーエンドの負荷試験
+
+single_judge(単体の採点), judge_all_by_lecture(授業単位の採点), batch_judge(バッチ採点)の
+いずれかのエンドポイントに、指定したレートでリクエストを送り、
+リクエストを受け付けるまでの時間と、ジャッジが完了するまでの時間のパーセンタイルを出力する。
+
+--base-urlを指定しない場合は、バックエンドをこのプロセス内で起動し(ASGI)、
+疑似ジャッジワーカー(app.tools.fake_worker)も同じプロセス内で動かす。
+DBはDATABASE_URL(またはDATABASE_USERなど)で指定する。
+
+使い方:
+    # SQLiteを使って、プロセス内で完結させる
+    DATABASE_URL=sqlite:///./dsa.sqlite3 python -m app.tools.loadtest \\
+        --mode single --lecture-id 1 --assignment-id 1 --rate 5 --duration 30 --workers 4
+
+    # 起動済みのバックエンド(ローカルのMySQLなど)に対して実行する
+    # (疑似ジャッジワーカーは別途 python -m app.tools.fake_worker で起動する)
+    python -m app.tools.loadtest --base-url http://localhost:8000 --mode batch --lecture-id 1 --students 50
+"""
+import argparse
+import asyncio
+import io
+import time
+import uuid
+import zipfile
+from dataclasses import dataclass, field
+from pathlib import Path
+import httpx
+import openpyxl
+from app import constants
+
+API_PREFIX = "/api/v1"
+
+
+@dataclass
+class LoadTestResult:
+    sent: int = 0
+    accepted: int = 0
+    # 流量制限(429)で拒否されたリクエストの数
+    rejected: int = 0
+    errors: int = 0
+    # ジャッジが完了しなかった(タイムアウトした)リクエストの数
+    timed_out: int = 0
+    # リクエストを送ってからレスポンスが返るまでの時間(秒)
+    accept_latencies: list[float] = field(default_factory=list)
+    # リクエストを送ってからジャッジが完了するまでの時間(秒)
+    end_to_end_latencies: list[float] = field(default_factory=list)
+    error_messages: dict[str, int] = field(default_factory=dict)
+
+    def add_error(self, message: str) -> None:
+        self.errors += 1
+        self.error_messages[message] = self.error_messages.get(message, 0) + 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    最近傍法でpパーセンタイル(0 <= p <= 100)を計算する
+    """
+    if len(values) == 0:
+        return float("nan")
+    sorted_values = sorted(values)
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def format_latencies(name: str, values: list[float]) -> str:
+    return (
+        f"{name:<12} n={len(values):<6} "
+        + " ".join(f"p{p}={percentile(values, p) * 1000:.1f}ms" for p in [50, 90, 95, 99])
+        + (f" max={max(values) * 1000:.1f}ms" if len(values) > 0 else "")
+    )
+
+
+def make_source_files(files: list[Path]) -> list[tuple[str, bytes]]:
+    """
+    提出するファイルの(ファイル名, 内容)のリストを作る
+
+    ジャッジ結果のキャッシュに当たらないように、毎回異なるコメントを末尾に付ける
+    """
+    nonce = f"\n// loadtest {uuid.uuid4().hex}\n".encode()
+    if len(files) == 0:
+        return [("main.c", b"int main(void) { return 0; }\n" + nonce)]
+    return [(file.name, file.read_bytes() + nonce) for file in files]
+
+
+def make_lecture_zip(files: list[Path]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for filename, content in make_source_files(files):
+            zip_file.writestr(filename, content)
+    return buffer.getvalue()
+
+
+def make_batch_zip(lecture_id: int, student_ids: list[str], files: list[Path]) -> bytes:
+    """
+    manabaからダウンロードできる形式の、バッチ採点用のzipファイルを作る
+    """
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["# 内部コースID", "# 学籍番号", "# ロール", "# 提出", "# 提出日時"])
+    for student_id in student_ids:
+        sheet.append(["loadtest", student_id, "履修生", "提出済", "2025-01-01 00:00:00"])
+    sheet.append(["#end"])
+    report_list = io.BytesIO()
+    workbook.save(report_list)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr("reportlist.xlsx", report_list.getvalue())
+        for i, student_id in enumerate(student_ids):
+            zip_file.writestr(
+                f"{student_id}@{i:013d}/class{lecture_id}.zip",
+                make_lecture_zip(files),
+            )
+    return buffer.getvalue()
+
+
+async def login(client: httpx.AsyncClient, user_id: str, password: str) -> None:
+    response = await client.post(
+        f"{API_PREFIX}/authorize/token", data={"username": user_id, "password": password}
+    )
+    response.raise_for_status()
+    client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+
+async def register_students(client: httpx.AsyncClient, num_students: int) -> list[str]:
+    """
+    バッチ採点の対象にする学生ユーザを登録する(既に登録されている場合はそのまま使う)
+    """
+    student_ids = [f"loadtest{i:05d}" for i in range(num_students)]
+    for student_id in student_ids:
+        await client.post(
+            f"{API_PREFIX}/users/register",
+            json={
+                "user_id": student_id,
+                "username": student_id,
+                "email": f"{student_id}@example.com",
+                "plain_password": uuid.uuid4().hex,
+                "role": "student",
+            },
+        )
+    return student_ids
+
+
+async def wait_until(predicate, client: httpx.AsyncClient, url: str, poll_interval: float, deadline: float) -> bool:
+    while time.monotonic() < deadline:
+        response = await client.get(url)
+        if response.status_code == 200 and predicate(response.json()):
+            return True
+        await asyncio.sleep(poll_interval)
+    return False
+
+
+async def run_one(client: httpx.AsyncClient, args: argparse.Namespace, student_ids: list[str], result: LoadTestResult) -> None:
+    """
+    1回分のリクエストを送り、ジャッジが完了するまで待つ
+    """
+    start = time.monotonic()
+    result.sent += 1
+    try:
+        if args.mode == "single":
+            response = await client.post(
+                f"{API_PREFIX}/assignments/judge/{args.lecture_id}/{args.assignment_id}",
+                params={"eval": args.eval},
+                files=[("file_list", (name, content, "text/plain")) for name, content in make_source_files(args.files)],
+            )
+        elif args.mode == "lecture":
+            response = await client.post(
+                f"{API_PREFIX}/assignments/judge/{args.lecture_id}",
+                params={"eval": args.eval},
+                files={"uploaded_zip_file": (f"class{args.lecture_id}.zip", make_lecture_zip(args.files), "application/zip")},
+            )
+        else:
+            response = await client.post(
+                f"{API_PREFIX}/assignments/batch/{args.lecture_id}",
+                params={"eval": args.eval},
+                files={"uploaded_zip_file": ("batch.zip", make_batch_zip(args.lecture_id, student_ids, args.files), "application/zip")},
+            )
+    except httpx.HTTPError as e:
+        result.add_error(type(e).__name__)
+        return
+
+    result.accept_latencies.append(time.monotonic() - start)
+    if response.status_code == 429:
+        result.rejected += 1
+        return
+    if response.status_code != 200:
+        result.add_error(f"HTTP {response.status_code}")
+        return
+    result.accepted += 1
+
+    deadline = start + args.timeout
+    body = response.json()
+    if args.mode == "batch":
+        done = await wait_until(
+            lambda batch: batch["status"] in ("done", "failed"),
+            client,
+            f"{API_PREFIX}/assignments/status/batch/id/{body['id']}",
+            args.poll_interval,
+            deadline,
+        )
+    else:
+        submissions = body if isinstance(body, list) else [body]
+        done = True
+        for submission in submissions:
+            done = done and await wait_until(
+                lambda submission: submission["progress"] == "done",
+                client,
+                f"{API_PREFIX}/assignments/status/submissions/id/{submission['id']}",
+                args.poll_interval,
+                deadline,
+            )
+
+    if done:
+        result.end_to_end_latencies.append(time.monotonic() - start)
+    else:
+        result.timed_out += 1
+
+
+async def run_load_test(client: httpx.AsyncClient, args: argparse.Namespace) -> LoadTestResult:
+    await login(client, args.user, args.password)
+    student_ids = await register_students(client, args.students) if args.mode == "batch" else []
+
+    result = LoadTestResult()
+    tasks: list[asyncio.Task] = []
+    start = time.monotonic()
+    num_requests = int(args.rate * args.duration)
+    for i in range(num_requests):
+        # 前のリクエストの完了を待たずに、一定間隔でリクエストを送る(open loop)
+        await asyncio.sleep(max(0.0, start + i / args.rate - time.monotonic()))
+        tasks.append(asyncio.create_task(run_one(client, args, student_ids, result)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+
+    print(f"mode={args.mode} rate={args.rate}/s duration={args.duration}s elapsed={elapsed:.1f}s")
+    print(
+        f"sent={result.sent} accepted={result.accepted} rejected(429)={result.rejected} "
+        f"errors={result.errors} timed_out={result.timed_out}"
+    )
+    for message, count in result.error_messages.items():
+        print(f"  error {message}: {count}")
+    print(format_latencies("accept", result.accept_latencies))
+    print(format_latencies("end-to-end", result.end_to_end_latencies))
+    print(f"completed throughput: {len(result.end_to_end_latencies) / elapsed:.2f}/s")
+    return result
+
+
+async def run_in_process(args: argparse.Namespace) -> LoadTestResult:
+    """
+    バックエンドと疑似ジャッジワーカーをこのプロセス内で動かして負荷試験を行う
+    """
+    from app import app
+    from app.crud.db import init_db
+    from app.tools.fake_worker import FakeJudgeWorker, parse_result_distribution
+
+    init_db()
+    if args.no_rate_limit:
+        # 負荷試験のリクエストが流量制限で拒否されないようにする
+        for limits in [constants.JUDGE_USER_RATE_LIMITS, constants.JUDGE_ROLE_RATE_LIMITS]:
+            for role in limits:
+                limits[role] = (float("inf"), float("inf"))
+        for role in constants.JUDGE_MAX_INFLIGHT_SUBMISSIONS:
+            constants.JUDGE_MAX_INFLIGHT_SUBMISSIONS[role] = 1 << 30
+
+    worker = FakeJudgeWorker(
+        concurrency=args.workers,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        result_distribution=parse_result_distribution(args.results),
+        poll_interval=args.poll_interval,
+    )
+    worker.start()
+    try:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=args.timeout
+        ) as client:
+            return await run_load_test(client, args)
+    finally:
+        worker.stop()
+
+
+async def run_remote(args: argparse.Namespace) -> LoadTestResult:
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout) as client:
+        return await run_load_test(client, args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ジャッジパイプラインのエンドツーエンドの負荷試験")
+    parser.add_argument("--mode", choices=["single", "lecture", "batch"], default="single", help="負荷をかけるエンドポイント")
+    parser.add_argument("--lecture-id", type=int, required=True)
+    parser.add_argument("--assignment-id", type=int, default=1, help="--mode singleで提出する課題のID")
+    parser.add_argument("--eval", action="store_true", help="採点用のリソースでジャッジする")
+    parser.add_argument("--files", type=Path, nargs="*", default=[], help="提出するファイル(省略時はmain.cを生成する)")
+    parser.add_argument("--students", type=int, default=10, help="--mode batchで1回のバッチ採点に含める学生の数")
+    parser.add_argument("--rate", type=float, default=1.0, help="1秒あたりのリクエスト数")
+    parser.add_argument("--duration", type=float, default=10.0, help="リクエストを送り続ける時間(秒)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="1回のリクエストでジャッジの完了を待つ時間(秒)")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="ジャッジの完了を確認する間隔(秒)")
+    parser.add_argument("--user", default=constants.ADMIN_USER_ID, help="ログインするユーザのID")
+    parser.add_argument("--password", default=constants.ADMIN_PASSWORD, help="ログインするユーザのパスワード")
+    parser.add_argument("--base-url", default=None, help="起動済みのバックエンドのURL(省略時はプロセス内で起動する)")
+    # 以下はプロセス内で起動する場合のみ有効
+    parser.add_argument("--workers", type=int, default=4, help="疑似ジャッジワーカーの並行数")
+    parser.add_argument("--latency-ms", type=float, default=200, help="疑似ジャッジワーカーが1つの提出にかける時間(ミリ秒)")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="疑似ジャッジワーカーのジャッジ時間のばらつき(ミリ秒)")
+    parser.add_argument("--results", default="AC=0.8,WA=0.15,TLE=0.05", help="疑似ジャッジワーカーのテストケースの結果の分布")
+    parser.add_argument("--no-rate-limit", action="store_true", help="ジャッジリクエストの流量制限を無効にする")
+    args = parser.parse_args()
+
+    if args.base_url is None:
+        asyncio.run(run_in_process(args))
+    else:
+        asyncio.run(run_remote(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import csv
+import io
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO
+import openpyxl
+
+"""
+ユーザの一括登録(/users/register/multiple)で使う、ユーザ一覧のcsv/xlsxの読み書き
+
+1行目をヘッダ(列名)とし、2行目以降を列名をキーとしたdictとして読み込む。
+空のセルはNoneとし、すべてのセルが空の行は読み飛ばす。
+"""
+
+
+def to_str(value: Any) -> str | None:
+    if value is None:
+        return None
+    # 学籍番号などが数値のセルになっている場合に、"202211479.0"とならないようにする
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    return text if text != "" else None
+
+
+def to_datetime(value: Any) -> datetime | None:
+    """
+    セルの値(datetime、または"2025-04-01"や"2025/04/01 09:00:00"のような文字列)をdatetimeに変換する
+
+    変換できない文字列の場合はValueErrorを送出する。
+    """
+    if isinstance(value, datetime):
+        return value
+    text = to_str(value)
+    if text is None:
+        return None
+    return datetime.fromisoformat(text.replace("/", "-"))
+
+
+def read_user_list_csv(file: BinaryIO) -> tuple[list[str], list[dict[str, Any]]]:
+    """
+    ユーザ一覧のcsvを読み込み、ヘッダの列名と行のリストを返す
+    """
+    text_file = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(text_file)
+        header = [column.strip() for column in next(reader, [])]
+        rows = [
+            {column: (values[i] if i < len(values) and values[i] != "" else None) for i, column in enumerate(header)}
+            for values in reader
+            if any(value != "" for value in values)
+        ]
+    finally:
+        # UploadFileのファイルを閉じないように、ラッパーから切り離す
+        text_file.detach()
+    return header, rows
+
+
+def read_user_list_xlsx(file: BinaryIO) -> tuple[list[str], list[dict[str, Any]]]:
+    """
+    ユーザ一覧のxlsxの最初のシートを読み込み、ヘッダの列名と行のリストを返す
+    """
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        values_iter = workbook.worksheets[0].iter_rows(values_only=True)
+        header_cells = [to_str(value) for value in next(values_iter, ())]
+        columns = [(i, column) for i, column in enumerate(header_cells) if column is not None]
+        rows = [
+            {column: (values[i] if i < len(values) else None) for i, column in columns}
+            for values in values_iter
+            if any(value is not None for value in values)
+        ]
+    finally:
+        workbook.close()
+    return [column for _, column in columns], rows
+
+
+def write_user_list_xlsx(file_path: Path, header: list[str], rows: list[dict[str, Any]]) -> None:
+    """
+    read_user_list_csv/read_user_list_xlsxで読み込んだ表を、xlsxに書き出す
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append([row.get(column) for column in header])
+    workbook.save(file_path)
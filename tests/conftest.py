@@ -0,0 +1,33 @@
+import os
+import tempfile
+import pytest
+
+# app.crud.dbはimport時に接続先のDBにテーブルを作るので、テストでは一時ディレクトリのSQLiteを使う
+# (.envなどで本番のDBやディレクトリが指定されていても、そちらは使わない)
+_test_dir = tempfile.mkdtemp(prefix="dsa-back-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_test_dir}/test.sqlite3"
+os.environ["UPLOAD_DIR_PATH"] = os.path.join(_test_dir, "upload")
+os.environ["RESOURCE_DIR_PATH"] = os.path.join(_test_dir, "resource")
+# エンドポイントのモジュールはimport時に認証の設定を読むので、未設定の場合はテスト用の値を入れる
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("REFRESH_TOKEN_EXPIRE_HOURS", "24")
+
+
+@pytest.fixture
+def db():
+    """
+    テスト用のDBのセッション(テストの終了時に全てのテーブルを空にする)
+    """
+    from app.classes.models import Base
+    from app.crud.db import SessionLocal, engine
+
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        with engine.begin() as connection:
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(table.delete())
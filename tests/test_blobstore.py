@@ -0,0 +1,97 @@
+import os
+import time
+from pathlib import Path
+from app import blobstore
+from app.blobstore import BlobStore, compute_file_digest
+
+
+def write_through_store(store: BlobStore, dest_path: Path, content: bytes, mode: int = 0o644) -> str:
+    with store.writer() as writer:
+        writer.write(content[:3])
+        writer.write(content[3:])
+        return writer.commit(dest_path, mode)
+
+
+def test_writer_shares_one_readonly_object(tmp_path):
+    store = BlobStore(tmp_path / "store")
+    first = tmp_path / "a" / "main.c"
+    second = tmp_path / "b" / "main.c"
+
+    digest = write_through_store(store, first, b"int main(){}")
+    assert write_through_store(store, second, b"int main(){}") == digest
+    assert digest == compute_file_digest(first)
+
+    # 同じ内容のファイルは、ストアの実体と同じinodeを共有し、書き込み権限を持たない
+    object_path = store._object_path(digest)
+    assert first.stat().st_ino == second.stat().st_ino == object_path.stat().st_ino
+    assert first.stat().st_mode & 0o777 == 0o444
+    # 一時ファイルは残らない
+    assert list((store.root / "tmp").iterdir()) == []
+
+
+def test_writer_does_not_share_objects_with_different_mode(tmp_path):
+    store = BlobStore(tmp_path / "store")
+    script = tmp_path / "a" / "run.sh"
+    text = tmp_path / "b" / "run.sh"
+
+    write_through_store(store, script, b"echo hello", 0o755)
+    write_through_store(store, text, b"echo hello", 0o644)
+
+    assert script.stat().st_mode & 0o777 == 0o555
+    assert text.stat().st_mode & 0o777 == 0o444
+    assert script.stat().st_ino != text.stat().st_ino
+
+
+def test_store_directory_uses_known_digests(tmp_path):
+    store = BlobStore(tmp_path / "store")
+    written_dir = tmp_path / "written"
+    digests = {
+        written_dir / "main.c": write_through_store(store, written_dir / "main.c", b"int main(){}"),
+        written_dir / "sub" / "Makefile": write_through_store(store, written_dir / "sub" / "Makefile", b"all:"),
+    }
+    copied_dir = tmp_path / "copied"
+    (copied_dir / "sub").mkdir(parents=True)
+    (copied_dir / "main.c").write_bytes(b"int main(){}")
+    (copied_dir / "sub" / "Makefile").write_bytes(b"all:")
+
+    # 書き込み時のハッシュ値を使っても、読み直して登録しても、同じマニフェストになる
+    assert store.store_directory(written_dir, digests) == store.store_directory(copied_dir)
+    assert (copied_dir / "main.c").stat().st_ino == (written_dir / "main.c").stat().st_ino
+
+
+def test_collect_garbage_removes_unreferenced_objects_and_stale_temp_files(tmp_path):
+    store = BlobStore(tmp_path / "store")
+    kept = tmp_path / "kept.c"
+    removed = tmp_path / "removed.c"
+    kept_digest = write_through_store(store, kept, b"kept")
+    removed_digest = write_through_store(store, removed, b"removed")
+    removed.unlink()
+
+    stale_writer = store.writer()
+    stale_writer.write(b"interrupted")
+    stale_writer._file.close()
+    stale_time = time.time() - blobstore.STALE_TEMP_SECONDS - 1
+    os.utime(stale_writer._temp_path, (stale_time, stale_time))
+    fresh_writer = store.writer()
+
+    assert store.collect_garbage() == 1
+    assert store._object_path(kept_digest).exists()
+    assert not store._object_path(removed_digest).exists()
+    assert not stale_writer._temp_path.exists()
+    assert fresh_writer._temp_path.exists()
+    fresh_writer.discard()
+
+
+def test_manifest_digest_depends_on_mode(tmp_path):
+    store = BlobStore(tmp_path / "store")
+    package_dir = tmp_path / "package"
+    package_dir.mkdir()
+    (package_dir / "test.sh").write_bytes(b"echo hello")
+    (package_dir / "test.sh").chmod(0o644)
+    before = store.store_directory(package_dir)
+
+    # 実行権限だけを変えた課題データは、別のバージョンになる
+    (package_dir / "test.sh").chmod(0o755)
+    after = store.store_directory(package_dir)
+    assert before != after
+    assert store.read_manifest(after)["test.sh"]["mode"] == 0o555
@@ -0,0 +1,76 @@
+import gzip
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from app import compression
+from app.compression import CompressionMiddleware
+
+BODY = "0123456789" * 200
+
+
+def make_client() -> TestClient:
+    async def text(request):
+        return PlainTextResponse(BODY)
+
+    async def small(request):
+        return PlainTextResponse("small")
+
+    async def stream(request):
+        async def chunks():
+            for _ in range(4):
+                yield BODY
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    async def archive(request):
+        return Response(BODY.encode(), media_type="application/zip")
+
+    async def partial(request):
+        return Response(BODY.encode(), status_code=206, headers={"Content-Range": f"bytes 0-{len(BODY) - 1}/{len(BODY) * 2}"})
+
+    app = Starlette(routes=[
+        Route("/text", text),
+        Route("/small", small),
+        Route("/stream", stream),
+        Route("/archive", archive),
+        Route("/partial", partial),
+    ])
+    app.add_middleware(CompressionMiddleware, minimum_size=1024)
+    return TestClient(app)
+
+
+def get_raw(client: TestClient, path: str, accept_encoding: str):
+    # TestClient(httpx)による自動的な展開を避けて、送られたバイト列のまま受け取る
+    with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+@pytest.mark.parametrize("path, expected", [("/text", BODY), ("/stream", BODY * 4)])
+def test_gzip(path, expected):
+    response, raw = get_raw(make_client(), path, "gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "accept-encoding" in response.headers["vary"].lower()
+    assert gzip.decompress(raw).decode() == expected
+    if path == "/text":
+        assert response.headers["content-length"] == str(len(raw))
+
+
+@pytest.mark.skipif(compression.brotli is None, reason="brotliがインストールされていない")
+def test_brotli_is_preferred():
+    response, raw = get_raw(make_client(), "/stream", "gzip, br")
+    assert response.headers["content-encoding"] == "br"
+    assert compression.brotli.decompress(raw).decode() == BODY * 4
+
+
+@pytest.mark.parametrize("path, accept_encoding", [
+    ("/text", "identity"),
+    ("/text", "gzip;q=0"),
+    ("/small", "gzip"),
+    ("/archive", "gzip"),
+    ("/partial", "gzip"),
+])
+def test_not_compressed(path, accept_encoding):
+    response, raw = get_raw(make_client(), path, accept_encoding)
+    assert "content-encoding" not in response.headers
+    assert raw.decode() in (BODY, "small")
@@ -0,0 +1,118 @@
+from app.classes import models, schemas
+from app.crud.db import assignments
+
+
+def add_queued_submission(db) -> int:
+    submission = models.Submission(
+        user_id="student",
+        lecture_id=1,
+        assignment_id=1,
+        eval=False,
+        upload_dir="/upload/1",
+        progress=schemas.SubmissionProgressStatus.QUEUED.value,
+    )
+    db.add(submission)
+    db.commit()
+    return submission.id
+
+
+def requeue(db, submission_id: int) -> None:
+    # reap_stuck_submissionsと同じく、途中までの結果を破棄してキューに積み直す
+    db.query(models.JudgeResult).filter(models.JudgeResult.submission_id == submission_id).delete()
+    db.query(models.Submission).filter(models.Submission.id == submission_id).update(
+        {
+            "progress": schemas.SubmissionProgressStatus.QUEUED.value,
+            "completed_task": 0,
+            "started_at": None,
+            "heartbeat_at": None,
+            "retry_count": models.Submission.retry_count + 1,
+        }
+    )
+    db.commit()
+
+
+def judge_batch(submission: schemas.Submission, result: schemas.SingleJudgeStatus) -> schemas.JudgeIngestBatch:
+    return schemas.JudgeIngestBatch(
+        judge_results=[
+            schemas.JudgeResult(
+                submission_id=submission.id,
+                testcase_id=testcase_id,
+                result=result,
+                command="./a.out",
+                timeMS=1,
+                memoryKB=1024,
+                exit_code=0,
+                stdout="",
+                stderr="",
+            )
+            for testcase_id in (1, 2)
+        ],
+        submissions=[
+            schemas.SubmissionProgressUpdate(
+                submission_id=submission.id,
+                claim_token=submission.claim_token,
+                progress=schemas.SubmissionProgressStatus.DONE,
+                total_task=2,
+                result=schemas.SubmissionSummaryStatus(result.value),
+            )
+        ],
+    )
+
+
+def count_judge_results(db, submission_id: int) -> int:
+    return db.query(models.JudgeResult).filter(models.JudgeResult.submission_id == submission_id).count()
+
+
+def test_results_from_stale_claim_are_skipped(db):
+    submission_id = add_queued_submission(db)
+    [stale] = assignments.claim_queued_submissions(db, limit=1)
+    requeue(db, submission_id)
+    [current] = assignments.claim_queued_submissions(db, limit=1)
+    assert current.claim_token == stale.claim_token + 1
+
+    # 積み直される前に取り出したワーカーの結果は書き込まない
+    assert assignments.ingest_judge_batch(db, judge_batch(stale, schemas.SingleJudgeStatus.WA)) == (0, 0, [submission_id])
+    assert assignments.ingest_judge_batch(db, judge_batch(current, schemas.SingleJudgeStatus.AC)) == (2, 1, [])
+
+    # 後から届いても、積み直された後のワーカーの結果を上書きしない
+    assert assignments.ingest_judge_batch(db, judge_batch(stale, schemas.SingleJudgeStatus.WA)) == (0, 0, [submission_id])
+
+    submission = assignments.get_submission(db, submission_id)
+    assert submission.progress == schemas.SubmissionProgressStatus.DONE
+    assert submission.result == schemas.SubmissionSummaryStatus.AC
+    assert (submission.completed_task, submission.total_task) == (2, 2)
+    assert count_judge_results(db, submission_id) == 2
+
+
+def test_results_after_done_are_skipped(db):
+    submission_id = add_queued_submission(db)
+    [claimed] = assignments.claim_queued_submissions(db, limit=1)
+    assignments.ingest_judge_batch(db, judge_batch(claimed, schemas.SingleJudgeStatus.AC))
+
+    # 同じワーカーから重複して届いた結果も、doneになった後は書き込まない
+    late_running = schemas.JudgeIngestBatch(
+        submissions=[
+            schemas.SubmissionProgressUpdate(
+                submission_id=submission_id,
+                claim_token=claimed.claim_token,
+                progress=schemas.SubmissionProgressStatus.RUNNING,
+            )
+        ]
+    )
+    assert assignments.ingest_judge_batch(db, late_running) == (0, 0, [submission_id])
+    assert assignments.ingest_judge_batch(db, judge_batch(claimed, schemas.SingleJudgeStatus.AC)) == (0, 0, [submission_id])
+
+    submission = assignments.get_submission(db, submission_id)
+    assert submission.progress == schemas.SubmissionProgressStatus.DONE
+    assert submission.completed_task == 2
+    assert count_judge_results(db, submission_id) == 2
+
+
+def test_judge_results_without_claim_token_are_skipped(db):
+    submission_id = add_queued_submission(db)
+    [claimed] = assignments.claim_queued_submissions(db, limit=1)
+    batch = judge_batch(claimed, schemas.SingleJudgeStatus.AC)
+    batch.submissions = []
+
+    assert assignments.ingest_judge_batch(db, batch) == (0, 0, [submission_id])
+    assert count_judge_results(db, submission_id) == 0
@@ -0,0 +1,39 @@
+from app.classes import models, schemas
+from app.crud.db import assignments
+
+
+def add_submission(db, priority: int = 0, progress: schemas.SubmissionProgressStatus = schemas.SubmissionProgressStatus.QUEUED) -> int:
+    submission = models.Submission(
+        user_id="student",
+        lecture_id=1,
+        assignment_id=1,
+        eval=False,
+        upload_dir="/upload/1",
+        progress=progress.value,
+        priority=priority,
+    )
+    db.add(submission)
+    db.commit()
+    return submission.id
+
+
+def test_queue_position_follows_claim_order(db):
+    rejudge_id = add_submission(db, priority=-1)
+    first_id = add_submission(db)
+    running_id = add_submission(db, progress=schemas.SubmissionProgressStatus.RUNNING)
+    second_id = add_submission(db)
+    urgent_id = add_submission(db, priority=1)
+
+    # 再ジャッジ(priorityが負)の提出は、後から積まれた通常の提出より後に取り出される
+    assert assignments.get_queue_position(db, urgent_id) == 0
+    assert assignments.get_queue_position(db, first_id) == 1
+    assert assignments.get_queue_position(db, second_id) == 2
+    assert assignments.get_queue_position(db, rejudge_id) == 3
+
+    claimed = assignments.claim_queued_submissions(db, limit=4)
+    assert [submission.id for submission in claimed] == [urgent_id, first_id, second_id, rejudge_id]
+
+    # キューに積まれていない提出はNone
+    assert assignments.get_queue_position(db, running_id) is None
+    assert assignments.get_queue_position(db, urgent_id) is None
+    assert assignments.get_queue_position(db, 999) is None
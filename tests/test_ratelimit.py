@@ -0,0 +1,94 @@
+import pytest
+from app import ratelimit
+from app.ratelimit import MemoryRateLimitStore, SQLiteRateLimitStore, RateLimitStore
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    # MemoryRateLimitStoreはtime.monotonic, SQLiteRateLimitStoreはtime.timeを使う
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    monkeypatch.setattr(ratelimit.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path) -> RateLimitStore:
+    if request.param == "sqlite":
+        return SQLiteRateLimitStore(tmp_path / "rate-limit.sqlite3")
+    return MemoryRateLimitStore()
+
+
+def test_refill_is_capped_by_capacity():
+    assert ratelimit._refill(0.0, 0.0, 10.0, 2.0, 3.0) == 6.0
+    assert ratelimit._refill(5.0, 0.0, 10.0, 2.0, 100.0) == 10.0
+    # 時刻が巻き戻っても減らさない
+    assert ratelimit._refill(5.0, 10.0, 10.0, 2.0, 0.0) == 5.0
+
+
+def test_retry_after():
+    assert ratelimit._retry_after(1.0, 1.0, 0.5) == 0.0
+    assert ratelimit._retry_after(0.25, 1.0, 0.5) == pytest.approx(1.5)
+    assert ratelimit._retry_after(0.0, 1.0, 0.0) == float("inf")
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        RateLimitStore()
+
+
+def test_burst_then_reject(store, clock):
+    # 容量3のバケットは、連続した3回までを受け付け、4回目を拒否する
+    for _ in range(3):
+        assert store.consume([("user", 3, 0.5, 1)]) == 0.0
+    assert store.consume([("user", 3, 0.5, 1)]) == pytest.approx(2.0)
+
+
+def test_refill_after_wait(store, clock):
+    for _ in range(3):
+        store.consume([("user", 3, 0.5, 1)])
+
+    clock.now += 1.0
+    assert store.consume([("user", 3, 0.5, 1)]) == pytest.approx(1.0)
+
+    clock.now += 1.0
+    assert store.consume([("user", 3, 0.5, 1)]) == 0.0
+    assert store.consume([("user", 3, 0.5, 1)]) > 0
+
+    # 長く待っても容量を超えては溜まらない
+    clock.now += 3600
+    for _ in range(3):
+        assert store.consume([("user", 3, 0.5, 1)]) == 0.0
+    assert store.consume([("user", 3, 0.5, 1)]) > 0
+
+
+def test_rejection_consumes_no_bucket(store, clock):
+    # ロールのバケットが空の場合は、ユーザのバケットからも消費しない
+    assert store.consume([("user", 2, 1.0, 1), ("role", 1, 0.1, 1)]) == 0.0
+    assert store.consume([("user", 2, 1.0, 1), ("role", 1, 0.1, 1)]) == pytest.approx(10.0)
+    assert store.consume([("user", 2, 1.0, 1)]) == 0.0
+    assert store.consume([("user", 2, 1.0, 1)]) > 0
+
+
+def test_buckets_are_independent(store, clock):
+    assert store.consume([("alice", 1, 1.0, 1)]) == 0.0
+    assert store.consume([("alice", 1, 1.0, 1)]) > 0
+    assert store.consume([("bob", 1, 1.0, 1)]) == 0.0
+
+
+def test_sqlite_store_is_shared_between_instances(tmp_path, clock):
+    # 同じファイルを使うstore(別のuvicorn worker)同士で、バケットを共有する
+    path = tmp_path / "rate-limit.sqlite3"
+    first = SQLiteRateLimitStore(path)
+    second = SQLiteRateLimitStore(path)
+    assert first.consume([("user", 2, 1.0, 1)]) == 0.0
+    assert second.consume([("user", 2, 1.0, 1)]) == 0.0
+    assert first.consume([("user", 2, 1.0, 1)]) == pytest.approx(1.0)
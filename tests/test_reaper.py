@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+from app.classes import models, schemas
+from app.crud.db import assignments
+
+
+def add_running_submission(db, started_at: datetime | None, retry_count: int = 0) -> int:
+    db.merge(
+        models.Problem(
+            lecture_id=1, assignment_id=1, title="p", description_path="p/desc.md", timeMS=1000, memoryMB=256
+        )
+    )
+    submission = models.Submission(
+        user_id="student",
+        lecture_id=1,
+        assignment_id=1,
+        eval=False,
+        upload_dir="/upload/1",
+        progress=schemas.SubmissionProgressStatus.RUNNING.value,
+        total_task=2,
+        started_at=started_at,
+        retry_count=retry_count,
+    )
+    db.add(submission)
+    db.commit()
+    return submission.id
+
+
+def move_back(db, submission_id: int, seconds: float) -> None:
+    # 時間が経過したことにする
+    submission = db.get(models.Submission, submission_id)
+    submission.started_at = submission.started_at - timedelta(seconds=seconds)
+    db.commit()
+
+
+def test_stuck_submission_is_requeued(db):
+    now = assignments.get_db_current_time(db)
+    # 制限時間 1秒 x (テストケース数2 + 1) + 猶予10秒 = 13秒
+    stuck_id = add_running_submission(db, now - timedelta(seconds=14))
+    alive_id = add_running_submission(db, now - timedelta(seconds=12))
+
+    assert assignments.reap_stuck_submissions(db, grace_seconds=10, max_retries=3) == ([stuck_id], [])
+    db.expire_all()
+    assert db.get(models.Submission, stuck_id).progress == schemas.SubmissionProgressStatus.QUEUED.value
+    assert db.get(models.Submission, stuck_id).retry_count == 1
+    assert db.get(models.Submission, alive_id).progress == schemas.SubmissionProgressStatus.RUNNING.value
+
+
+def test_stuck_submission_exceeding_retries_is_failed(db):
+    now = assignments.get_db_current_time(db)
+    submission_id = add_running_submission(db, now - timedelta(seconds=60), retry_count=2)
+
+    assert assignments.reap_stuck_submissions(db, grace_seconds=10, max_retries=3) == ([], [submission_id])
+    submission = assignments.get_submission(db, submission_id)
+    assert submission.progress == schemas.SubmissionProgressStatus.DONE
+    assert submission.result == schemas.SubmissionSummaryStatus.IE
+
+
+def test_submission_set_running_without_started_at_is_reaped(db):
+    # ジャッジワーカーが直接progressをrunningにした提出(started_atがNULL)
+    submission_id = add_running_submission(db, None)
+
+    # 最初に見つけたときは、その時刻をstarted_atとするだけで回収しない
+    assert assignments.reap_stuck_submissions(db, grace_seconds=10, max_retries=3) == ([], [])
+    db.expire_all()
+    assert db.get(models.Submission, submission_id).started_at is not None
+
+    move_back(db, submission_id, 14)
+    assert assignments.reap_stuck_submissions(db, grace_seconds=10, max_retries=3) == ([submission_id], [])
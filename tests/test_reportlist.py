@@ -0,0 +1,64 @@
+from datetime import datetime
+import openpyxl
+import pytest
+from app.reportlist import ReportListRow, iter_report_list
+
+
+def write_report_list(path, rows) -> None:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+HEADER = ["# 内部コースID", "# 学籍番号", "# 氏名", "# ロール", "# 提出", "# 提出日時"]
+
+
+def test_reads_rows_between_header_and_end(tmp_path):
+    path = tmp_path / "reportlist.xlsx"
+    write_report_list(path, [
+        ["コース名", "データ構造とアルゴリズム"],
+        [],
+        HEADER,
+        ["c1", 202211479, "学生A", "履修生", "提出済", "2024-10-01 12:34:56"],
+        ["c1", "202211480", "学生B", "履修生", "受付終了後提出", datetime(2024, 10, 2, 9, 0, 0)],
+        ["c1", 202211481.0, "学生C", "履修生", "未提出", None],
+        ["#end"],
+        ["c1", 999999999, "読まない", "履修生", "提出済", None],
+    ])
+
+    assert list(iter_report_list(path)) == [
+        ReportListRow(0, "202211479", "履修生", "提出済", datetime(2024, 10, 1, 12, 34, 56)),
+        ReportListRow(1, "202211480", "履修生", "受付終了後提出", datetime(2024, 10, 2, 9, 0, 0)),
+        # 数値のセルの学籍番号は"202211481.0"にならない
+        ReportListRow(2, "202211481", "履修生", "未提出", None),
+    ]
+
+
+def test_short_rows_have_missing_cells_as_none(tmp_path):
+    path = tmp_path / "reportlist.xlsx"
+    write_report_list(path, [
+        HEADER,
+        ["c1", 202211479, "学生A", "履修生"],
+    ])
+
+    assert list(iter_report_list(path)) == [
+        ReportListRow(0, "202211479", "履修生", None, None),
+    ]
+
+
+def test_missing_header_raises(tmp_path):
+    path = tmp_path / "reportlist.xlsx"
+    write_report_list(path, [["コース名"], ["c1", 202211479]])
+
+    with pytest.raises(ValueError):
+        list(iter_report_list(path))
+
+
+def test_missing_column_raises(tmp_path):
+    path = tmp_path / "reportlist.xlsx"
+    write_report_list(path, [[column for column in HEADER if column != "# 提出日時"]])
+
+    with pytest.raises(ValueError, match="# 提出日時"):
+        list(iter_report_list(path))
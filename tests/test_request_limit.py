@@ -0,0 +1,52 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from app.request_limit import RequestBodyLimitMiddleware
+
+
+def make_client() -> tuple[TestClient, list[int]]:
+    received = []
+    app = FastAPI()
+
+    @app.post("/upload/{item_id}")
+    async def upload(item_id: int, request: Request):
+        body = await request.body()
+        received.append(len(body))
+        return {"size": len(body)}
+
+    @app.post("/other")
+    async def other(request: Request):
+        return {"size": len(await request.body())}
+
+    app.add_middleware(RequestBodyLimitMiddleware, limits=[("POST", r"/upload/\d+", 100)])
+    return TestClient(app), received
+
+
+def test_body_within_limit_is_accepted():
+    client, received = make_client()
+    assert client.post("/upload/1", content=b"x" * 100).json() == {"size": 100}
+    assert received == [100]
+
+
+def test_content_length_over_limit_is_rejected_before_reading():
+    client, received = make_client()
+    response = client.post("/upload/1", content=b"x" * 101)
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_streamed_body_over_limit_is_rejected():
+    client, received = make_client()
+
+    def chunks():
+        # Content-Lengthのない(chunked)リクエスト
+        for _ in range(5):
+            yield b"x" * 30
+
+    response = client.post("/upload/1", content=chunks())
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_other_paths_are_not_limited():
+    client, _ = make_client()
+    assert client.post("/other", content=b"x" * 1000).json() == {"size": 1000}
@@ -0,0 +1,87 @@
+import os
+
+from app.api.api_v1.endpoints.assignments.util import hash_problem_resources
+from app.blobstore import compute_file_digest
+from app.classes import schemas
+from app.resource_cache import ResourceDigestCache
+
+
+def test_digest_cache_evicts_least_recently_used(tmp_path):
+    cache = ResourceDigestCache(max_entries=2)
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / name
+        path.write_text(name)
+        paths.append(path)
+
+    cache.digest(paths[0])
+    cache.digest(paths[1])
+    cache.digest(paths[0])
+    cache.digest(paths[2])
+
+    assert len(cache) == 2
+    assert set(cache._entries) == {str(paths[0]), str(paths[2])}
+
+
+def test_digest_cache_replaces_entry_when_file_changes(tmp_path):
+    cache = ResourceDigestCache(max_entries=8)
+    path = tmp_path / "stdout.txt"
+    path.write_text("1\n")
+    assert cache.digest(path) == compute_file_digest(path)
+
+    path.write_text("22\n")
+    stat_result = path.stat()
+    os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1))
+
+    # 同じパスの古いエントリは置き換えられ、件数は増えない
+    assert cache.digest(path) == compute_file_digest(path)
+    assert len(cache) == 1
+
+
+def make_problem(**updates) -> schemas.Problem:
+    test_case = schemas.TestCases(
+        id=1,
+        lecture_id=1,
+        assignment_id=1,
+        eval=False,
+        type=schemas.EvaluationType.Judge,
+        score=1,
+        title="case1",
+        description=None,
+        message_on_fail="失敗しました",
+        command="./main",
+        args=None,
+        stdin_path=None,
+        stdout_path=None,
+        stderr_path=None,
+        exit_code=0,
+    )
+    problem = schemas.Problem(
+        lecture_id=1,
+        assignment_id=1,
+        title="課題1",
+        description_path="s1/description.md",
+        timeMS=1000,
+        memoryMB=256,
+        version="v1",
+        executables=[schemas.Executables(lecture_id=1, assignment_id=1, eval=False, name="main")],
+        required_files=[schemas.RequiredFiles(lecture_id=1, assignment_id=1, name="main.c")],
+        test_cases=[test_case],
+    )
+    return problem.model_copy(update=updates)
+
+
+def test_hash_covers_judge_relevant_settings():
+    base = make_problem()
+    test_case = base.test_cases[0]
+    variants = [
+        make_problem(test_cases=[test_case.model_copy(update={"score": 2})]),
+        make_problem(test_cases=[test_case.model_copy(update={"message_on_fail": "別のメッセージ"})]),
+        make_problem(required_files=[schemas.RequiredFiles(lecture_id=1, assignment_id=1, name="sub.c")]),
+        make_problem(executables=[schemas.Executables(lecture_id=1, assignment_id=1, eval=False, name="sub")]),
+    ]
+
+    base_hash = hash_problem_resources(base)
+    assert hash_problem_resources(make_problem()) == base_hash
+    for variant in variants:
+        assert hash_problem_resources(variant) != base_hash
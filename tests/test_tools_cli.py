@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.mark.parametrize("module", ["app.tools.fake_worker", "app.tools.loadtest", "app.tools.bench_response_mapping"])
+def test_tool_cli_help(module, tmp_path):
+    # app.crud.dbを最初にimportする場合も、循環importにならずに起動できる
+    env = {
+        "PATH": os.environ.get("PATH", ""),
+        "DATABASE_URL": f"sqlite:///{tmp_path}/dsa.sqlite3",
+        "UPLOAD_DIR_PATH": str(tmp_path / "upload"),
+        "RESOURCE_DIR_PATH": str(tmp_path / "resource"),
+    }
+    result = subprocess.run(
+        [sys.executable, "-m", module, "--help"],
+        cwd=REPO_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "usage:" in result.stdout
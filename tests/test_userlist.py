@@ -0,0 +1,47 @@
+import io
+from datetime import datetime
+import openpyxl
+from app.userlist import read_user_list_csv, read_user_list_xlsx, to_datetime, write_user_list_xlsx
+
+
+def test_read_csv_keeps_file_open_and_uses_none_for_empty_cells():
+    file = io.BytesIO(
+        "\ufeffuser_id,username,password,active_start_date\n"
+        "202211479,学生A,,2025/04/01\n"
+        ",,,\n"
+        "202211480,学生B,secret,\n".encode("utf-8")
+    )
+
+    header, rows = read_user_list_csv(file)
+
+    assert header == ["user_id", "username", "password", "active_start_date"]
+    assert rows == [
+        {"user_id": "202211479", "username": "学生A", "password": None, "active_start_date": "2025/04/01"},
+        {"user_id": "202211480", "username": "学生B", "password": "secret", "active_start_date": None},
+    ]
+    assert not file.closed
+
+
+def test_xlsx_round_trip(tmp_path):
+    source = tmp_path / "users.xlsx"
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["user_id", "username", "active_start_date"])
+    workbook.active.append([202211479, "学生A", datetime(2025, 4, 1)])
+    workbook.save(source)
+
+    with open(source, "rb") as file:
+        header, rows = read_user_list_xlsx(file)
+    rows[0]["password"] = "generated"
+    header.append("password")
+    output = tmp_path / "output.xlsx"
+    write_user_list_xlsx(output, header, rows)
+
+    with open(output, "rb") as file:
+        assert read_user_list_xlsx(file) == (header, rows)
+
+
+def test_to_datetime():
+    assert to_datetime(None) is None
+    assert to_datetime("2025-04-01") == datetime(2025, 4, 1)
+    assert to_datetime("2025/04/01 09:30:00") == datetime(2025, 4, 1, 9, 30)
+    assert to_datetime(datetime(2025, 4, 1)) == datetime(2025, 4, 1)